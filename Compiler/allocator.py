@@ -9,6 +9,8 @@ import Compiler.graph
 import Compiler.program
 import heapq, itertools
 import operator
+import bisect
+import copy
 import sys
 from functools import reduce
 
@@ -103,23 +105,96 @@ class AllocRange:
                           (len(regs), self.top - size - base, base))
                 break
 
+class IntervalRange(AllocRange):
+    """ Register range keeping the free registers as coalesced
+    intervals. Allocation uses the smallest interval that fits (best
+    fit) and extends a free interval at the top before growing. Unlike
+    :py:class:`AllocRange`, registers freed by vectors can be reused by
+    vectors of different sizes. """
+    def __init__(self, base=0):
+        super(IntervalRange, self).__init__(base)
+        self.free_start = {}
+        self.free_end = {}
+        self.by_size = defaultdict(set)
+        self.sizes = []
+
+    def add_free(self, base, size):
+        self.free_start[base] = size
+        self.free_end[base + size] = base
+        if not self.by_size[size]:
+            bisect.insort(self.sizes, size)
+        self.by_size[size].add(base)
+
+    def remove_free(self, base):
+        size = self.free_start.pop(base)
+        del self.free_end[base + size]
+        self.by_size[size].remove(base)
+        if not self.by_size[size]:
+            del self.sizes[bisect.bisect_left(self.sizes, size)]
+        return size
+
+    def alloc(self, size):
+        i = bisect.bisect_left(self.sizes, size)
+        if i < len(self.sizes):
+            block_size = self.sizes[i]
+            res = next(iter(self.by_size[block_size]))
+            self.remove_free(res)
+            if block_size > size:
+                self.add_free(res + size, block_size - size)
+            return res
+        start = self.free_end.get(self.top)
+        if start is not None:
+            if not (self.grow or start + size <= self.limit):
+                return
+            self.remove_free(start)
+            self.top = start
+        return super(IntervalRange, self).alloc(size)
+
+    def free(self, base, size):
+        assert self.base <= base < self.top
+        start = self.free_end.get(base)
+        if start is not None:
+            self.remove_free(start)
+            size += base - start
+            base = start
+        if base + size in self.free_start:
+            size += self.remove_free(base + size)
+        self.add_free(base, size)
+
+    def consolidate(self):
+        start = self.free_end.get(self.top)
+        if start is not None:
+            self.remove_free(start)
+            self.top = start
+
 class AllocPool:
+    range_types = dict(size=AllocRange, interval=IntervalRange)
+
     def __init__(self, parent=None):
-        self.ranges = defaultdict(lambda: [AllocRange()])
+        self.range_type = self.range_types[
+            program.Program.prog.options.register_allocation]
+        self.ranges = defaultdict(lambda: [self.range_type()])
         self.by_base = {}
         self.parent = parent
+        # registers allocated at the same time
+        self.used = defaultdict(lambda: 0)
+        self.max_used = defaultdict(lambda: 0)
 
     def alloc(self, reg_type, size):
         for r in self.ranges[reg_type]:
             res = r.alloc(size)
             if res is not None:
                 self.by_base[reg_type, res] = r
+                self.used[reg_type] += size
+                self.max_used[reg_type] = max(self.max_used[reg_type],
+                                              self.used[reg_type])
                 return res
 
     def free(self, reg):
         try:
             r = self.by_base.pop((reg.reg_type, reg.i))
             r.free(reg.i, reg.size)
+            self.used[reg.reg_type] -= reg.size
         except KeyError:
             try:
                 self.parent.free(reg)
@@ -135,7 +210,7 @@ class AllocPool:
             assert (n >= r.limit)
             if r.limit < n:
                 r.stop_growing()
-                self.ranges[t].append(AllocRange(n))
+                self.ranges[t].append(self.range_type(n))
 
     def consolidate(self):
         for r in self.ranges.values():
@@ -148,6 +223,14 @@ class AllocPool:
         else:
             return 0
 
+    def n_wasted(self):
+        """ Number of registers per type in the ranges of this pool
+        beyond the maximum allocated at the same time. """
+        res = {}
+        for t, r in self.ranges.items():
+            res[t] = sum(x.limit - x.base for x in r) - self.max_used[t]
+        return res
+
 class StraightlineAllocator:
     """Allocate variables in a straightline program using n registers.
     It is based on the precondition that every register is only defined once."""
@@ -338,6 +421,9 @@ def determine_scope(block, options):
     block.used_from_scope = used_from_scope
 
 class Merger:
+    # minimum block size for using the array-based graph
+    compact_graph_threshold = 100000
+
     def __init__(self, block, options, merge_classes):
         self.block = block
         self.instructions = block.instructions
@@ -346,9 +432,22 @@ class Merger:
             self.max_parallel_open = int(options.max_parallel_open)
         else:
             self.max_parallel_open = float('inf')
+        program = block.parent.program
+        self.max_round_bytes = int(options.max_round_bytes or 0)
+        # bytes per round are only needed for the limit or reporting
+        self.weigh_rounds = bool(self.max_round_bytes or program.verbose)
+        self.element_bytes = {}
         self.counter = defaultdict(lambda: 0)
         self.rounds = defaultdict(lambda: 0)
-        self.dependency_graph(merge_classes)
+        # type and bytes per round after merging
+        self.round_profile = []
+        self.oversized = 0
+        # record of changes for replaying them on another copy
+        self.merged = []
+        self.eliminated = []
+        with program.phase("dependency_graph", block.parent.name,
+                           len(block.instructions)):
+            self.dependency_graph(merge_classes)
 
     def do_merge(self, merges_iter):
         """ Merge an iterable of nodes in G, returning the number of merged
@@ -356,6 +455,7 @@ class Merger:
         # sort merges, necessary for inputb
         merge = list(merges_iter)
         merge.sort()
+        self.merged.append(merge)
         merges_iter = iter(merge)
         instructions = self.instructions
         mergecount = 0
@@ -372,6 +472,75 @@ class Merger:
 
         return mergecount, n
 
+    def communication(self, instr):
+        """ Estimated number of bytes sent by an instruction in its
+        round. This is the number of register elements read or
+        written, whichever is larger, times the bytes per element of
+        the register type. For example, an opening reads and writes
+        one element per value, and a multiplication reads two
+        elements for the two values opened with a triple. Memory
+        access is merged without communication. """
+        if isinstance(instr, (ReadMemoryInstruction, WriteMemoryInstruction)):
+            return 0
+        program = self.block.parent.program
+        res = []
+        for regs in (instr.get_used(), instr.get_def()):
+            n_bytes = 0
+            for reg in regs:
+                if reg.reg_type not in self.element_bytes:
+                    self.element_bytes[reg.reg_type] = \
+                        program.element_bytes(reg.reg_type)
+                # size is unknown in vectorized templates
+                n_bytes += (reg.size or 1) * self.element_bytes[reg.reg_type]
+            res.append(n_bytes)
+        return max(res[0], res[1])
+
+    def attribute(self):
+        """ Preprocessing, estimated bytes, and rounds on the critical
+        path by call site (see :py:mod:`Compiler.attribution`) before
+        merging. A merged instruction on the critical path is
+        attributed the rounds between it and the previous one.
+
+        :returns: :py:class:`Compiler.program.Tape.ReqNum` by call
+          site and metric
+        """
+        from Compiler.attribution import metric
+        Tape = Compiler.program.Tape
+        instructions = self.instructions
+        depths = self.depths
+        G = self.G
+        res = Tape.ReqNum()
+        req_node = Tape.ReqNode("")
+        site = lambda inst: inst.caller if isinstance(inst.caller, int) else 0
+        for i, inst in enumerate(instructions):
+            if inst is None:
+                continue
+            req_node.num = Tape.ReqNum()
+            inst.add_usage(req_node)
+            for key, num in req_node.num.items():
+                res[site(inst), metric(key)] += num
+            if i in self.open_nodes:
+                res[site(inst), "bytes"] += self.communication(inst)
+        if not self.open_nodes:
+            return res
+        if isinstance(G, Compiler.graph.CompactDiGraph):
+            G.finalize()
+        last = None
+        for i in self.open_nodes:
+            if last is None or depths[i] > depths[last]:
+                last = i
+        while last is not None:
+            pred = None
+            for i in G.pred[last]:
+                if instructions[i] is not None and \
+                   (pred is None or depths[i] > depths[pred]):
+                    pred = i
+            if last in self.open_nodes:
+                res[site(instructions[last]), "rounds"] += depths[last] - \
+                    (0 if pred is None else depths[pred])
+            last = pred
+        return res
+
     def longest_paths_merge(self):
         """ Attempt to merge instructions of type instruction_type (which are given in
         merge_nodes) using longest paths algorithm.
@@ -401,6 +570,7 @@ class Merger:
             t = type(self.instructions[merge[0]])
             self.counter[t] += len(merge)
             self.rounds[t] += 1
+            self.round_profile.append((t.__name__, self.round_bytes[i]))
             if len(merge) > 10000:
                 print('Merging %d %s in round %d/%d' % \
                     (len(merge), t.__name__, i, len(merges)))
@@ -411,7 +581,9 @@ class Merger:
 
         if len(instructions) > 1000000:
             print("Topological sort ...")
-        order = Compiler.graph.topological_sort(G, preorder)
+        with self.block.parent.program.phase(
+                "topological_sort", self.block.parent.name, len(instructions)):
+            order = Compiler.graph.topological_sort(G, preorder)
         instructions[:] = [instructions[i] for i in order if instructions[i] is not None]
         if len(instructions) > 1000000:
             print("Done at", time.asctime())
@@ -430,7 +602,10 @@ class Merger:
                                 triple='green', square='green', bit='green',\
                                 asm_input='lightgreen')
 
-        G = Compiler.graph.SparseDiGraph(len(block.instructions))
+        if len(block.instructions) >= self.compact_graph_threshold:
+            G = Compiler.graph.CompactDiGraph(len(block.instructions))
+        else:
+            G = Compiler.graph.SparseDiGraph(len(block.instructions))
         self.G = G
 
         reg_nodes = {}
@@ -449,6 +624,9 @@ class Merger:
         depths = [0] * len(block.instructions)
         self.depths = depths
         parallel_open = defaultdict(lambda: 0)
+        self.round_bytes = defaultdict(lambda: 0)
+        round_bytes = self.round_bytes
+        max_round_bytes = self.max_round_bytes
         next_available_depth = {}
         self.sources = []
         self.real_depths = [0] * len(block.instructions)
@@ -667,21 +845,43 @@ class Merger:
                 self.real_depths[n] += 1
                 depth = depths[n] + 1
 
+                n_bytes = self.communication(instr) \
+                    if self.weigh_rounds else 0
+
                 # find first depth that has the right type and isn't full
                 skipped_depths = set()
-                while (depth in round_type and \
-                       round_type[depth] != instr.merge_id()) or \
-                      (int(options.max_parallel_open) > 0 and \
-                      parallel_open[depth] >= int(options.max_parallel_open)):
-                    skipped_depths.add(depth)
-                    depth = next_available_depth.get((type(instr), depth), \
-                                                     depth + 1)
+                first_fitting = None
+                while True:
+                    if (depth in round_type and \
+                        round_type[depth] != instr.merge_id()) or \
+                       (int(options.max_parallel_open) > 0 and \
+                        parallel_open[depth] >= \
+                        int(options.max_parallel_open)) or \
+                       (max_round_bytes and \
+                        round_bytes[depth] >= max_round_bytes):
+                        skipped_depths.add(depth)
+                        depth = next_available_depth.get(
+                            (type(instr), depth), depth + 1)
+                    elif max_round_bytes and round_bytes[depth] and \
+                         round_bytes[depth] + n_bytes > max_round_bytes:
+                        # not full but no space for this instruction
+                        if first_fitting is None:
+                            first_fitting = depth
+                        depth += 1
+                    else:
+                        break
                 for d in skipped_depths:
-                    next_available_depth[type(instr), d] = depth
+                    if first_fitting is not None and d < first_fitting:
+                        next_available_depth[type(instr), d] = first_fitting
+                    else:
+                        next_available_depth[type(instr), d] = depth
 
                 round_type[depth] = instr.merge_id()
                 if int(options.max_parallel_open) > 0:
                     parallel_open[depth] += len(instr.args) * instr.get_size()
+                round_bytes[depth] += n_bytes
+                if max_round_bytes and n_bytes > max_round_bytes:
+                    self.oversized += 1
                 depths[n] = depth
 
             if isinstance(instr, ReadMemoryInstruction):
@@ -727,18 +927,21 @@ class Merger:
 
     def merge_nodes(self, i, j):
         """ Merge node j into i, removing node j """
-        G = self.G
-        if j in G[i]:
-            G.remove_edge(i, j)
-        if i in G[j]:
-            G.remove_edge(j, i)
-        G.add_edges_from(list(zip(itertools.cycle([i]), G[j], [G.weights[(j,k)] for k in G[j]])))
-        G.add_edges_from(list(zip(G.pred[j], itertools.cycle([i]), [G.weights[(k,j)] for k in G.pred[j]])))
-        G.get_attr(i, 'merges').append(j)
-        G.remove_node(j)
-
-    def eliminate_dead_code(self, only_ldint=False):
+        self.G.merge_nodes(i, j)
+
+    def eliminate_dead_code(self, only_ldint=False, live=None):
+        """ Eliminate instructions whose results are not used.
+
+        :param only_ldint: only consider :py:class:`ldint` instructions
+          (and clear arithmetic with constant propagation)
+        :param live: set of ids of registers used after the block
+        """
         instructions = self.instructions
+        if self.options.constant_propagation:
+            constants = ldint_class, ldi_class, movc_class, addc_class, \
+                subc_class, mulc_class, ClearImmediate
+        else:
+            constants = ldint_class
         G = self.G
         merge_nodes = self.open_nodes
         count = 0
@@ -747,7 +950,11 @@ class Merger:
         for i,inst in zip(range(len(instructions) - 1, -1, -1), reversed(instructions)):
             if inst is None:
                 continue
-            if only_ldint and not isinstance(inst, ldint_class):
+            if only_ldint and not isinstance(inst, constants):
+                continue
+            if live and any(id(reg) in live for reg in
+                            itertools.chain(*(itertools.chain((x,), x.vector)
+                                              for x in inst.get_def()))):
                 continue
             can_eliminate_defs = True
             for reg in inst.get_def():
@@ -765,6 +972,7 @@ class Merger:
                 G.remove_node(i)
                 merge_nodes.discard(i)
                 stats[type(instructions[i]).__name__] += 1
+                self.eliminated.append(i)
                 for reg in instructions[i].get_def():
                     self.block.parent.program.base_addresses.pop(reg)
                 instructions[i] = None
@@ -791,7 +999,643 @@ class Merger:
             print('%d: %s' % (self.depths[i], self.instructions[i]), file=f)
         f.close()
 
+class MergeWindow:
+    """ Consecutive instructions of a basic block to be merged on
+    their own. """
+    def __init__(self, block, start, stop):
+        self.parent = block.parent
+        self.warn_about_mem = block.warn_about_mem
+        self.instructions = block.instructions[start:stop]
+
+class WindowMerger:
+    """ Merge instructions in consecutive windows of a basic block
+    separately. This limits the size of the dependency graph at the
+    cost of more rounds because all instructions in a window stay
+    before the instructions in the next window. The interface is the
+    same as :py:class:`Merger` except that :py:func:`run` replaces
+    calling :py:func:`Merger.eliminate_dead_code` and
+    :py:func:`Merger.longest_paths_merge`. """
+
+    def __init__(self, block, options, merge_classes, size):
+        self.block = block
+        self.options = options
+        self.merge_classes = merge_classes
+        self.size = size
+        self.counter = defaultdict(lambda: 0)
+        self.rounds = defaultdict(lambda: 0)
+        self.req_num = defaultdict(lambda: 0)
+        self.round_profile = []
+        self.oversized = 0
+        self.site_usage = None
+        self.merged = []
+        self.eliminated = []
+        self.n_to_merge = 0
+        self.n_windows = 0
+        self.max_window_rounds = 0
+
+    def run(self, eliminate=True, only_ldint=False):
+        """ Eliminate dead code and merge instructions window by
+        window. The windows are processed starting with the last so
+        that dead-code elimination knows the registers used later.
+
+        :param eliminate: whether to eliminate dead code
+        :param only_ldint: only eliminate :py:class:`ldint` instructions
+        :returns: number of rounds
+        """
+        instructions = self.block.instructions
+        live = set()
+        n_rounds = 0
+        done = []
+        if self.options.attribution:
+            self.site_usage = Compiler.program.Tape.ReqNum()
+        for start in reversed(range(0, len(instructions), self.size)):
+            window = MergeWindow(self.block, start, start + self.size)
+            merger = Merger(window, self.options, self.merge_classes)
+            if eliminate:
+                merger.eliminate_dead_code(only_ldint, live)
+            self.n_to_merge += len(merger.open_nodes)
+            if self.site_usage is not None:
+                self.site_usage += merger.attribute()
+            window_rounds = merger.longest_paths_merge()
+            n_rounds += window_rounds
+            self.n_windows += 1
+            self.max_window_rounds = max(self.max_window_rounds,
+                                         window_rounds)
+            for t, n in merger.counter.items():
+                self.counter[t] += n
+            for t, n in merger.rounds.items():
+                self.rounds[t] += n
+            for x, n in merger.req_num.items():
+                self.req_num[x] += n
+            self.round_profile[:0] = merger.round_profile
+            self.oversized += merger.oversized
+            self.merged += [[start + i for i in merge]
+                            for merge in merger.merged]
+            self.eliminated += [start + i for i in merger.eliminated]
+            for inst in window.instructions:
+                if inst is not None:
+                    for reg in inst.get_used():
+                        for x in itertools.chain((reg,), reg.vector):
+                            live.update(id(dup) for dup in x.duplicates)
+            done.append(window.instructions)
+        instructions[:] = itertools.chain(*reversed(done))
+        return n_rounds
+
+class CommonSubexpressionEliminator:
+    """ Replace instructions computing the same as an earlier
+    instruction in the same basic block by moves from the earlier
+    results. Only deterministic instructions are considered: local
+    arithmetic, opening, multiplication, and CISC instructions such
+    as comparisons and bit decomposition. The latter three save
+    communication and preprocessing. Instructions producing randomness
+    (random bits, probabilistic truncation etc.), inputs, memory
+    access, and I/O are never replaced.
+
+    Two instructions compute the same if they have the same type,
+    size, and immediate arguments, and the inputs hold the same
+    values. Inputs hold the same value if they are the same register
+    without a write in-between or if they are the results of
+    instructions computing the same (value numbering). The earlier
+    results must not be overwritten before the later instruction. """
+
+    pure = (AddBase, SubBase, MulBase, ClearImmediate, SharedImmediate,
+            ClearShiftInstruction, IntegerInstruction,
+            UnaryComparisonInstruction, InvertInstruction, floordivc_class,
+            modc_class, legendrec_class, andc_class, orc_class, xorc_class,
+            notc_class, shlc_class, shrc_class, convint_class,
+            asm_open_class, muls_class)
+    # only used for value numbering because moves are not cheaper
+    constants = (ldi_class, ldsi_class, ldint_class)
+    moves = (movc_class, movs_class, movint_class)
+    commutative = (addc_class, adds_class, mulc_class, muls_class,
+                   addint_class, mulint_class, eqc_class, andc_class,
+                   orc_class, xorc_class)
+    # CISC instructions with deterministic output
+    cisc = ('LTZ', 'Trunc', 'Mod2m', 'EQZ', 'BitDecRing', 'BitDecField',
+            'Pow2', 'TruncInRing')
+    move_classes = dict(s=movs, c=movc, ci=movint, sg=gmovs, cg=gmovc)
+
+    def __init__(self, block, count=True):
+        """
+        :param count: whether to count the saved communication and
+          preprocessing (not possible in CISC templates)
+        """
+        self.block = block
+        self.count = count
+        self.saved = Compiler.program.Tape.ReqNode('')
+        self.saved.num = Compiler.program.Tape.ReqNum()
+        self.stats = defaultdict(lambda: 0)
+        self.n_replaced = 0
+
+    @classmethod
+    def is_cisc(cls, inst):
+        return isinstance(inst, Mergeable) and hasattr(inst, 'function') \
+            and inst.function.__name__.split('(')[0] in cls.cisc \
+            and len(inst.calls) == 1
+
+    def run(self):
+        """ :returns: number of replaced instructions """
+        Register = Compiler.program.Tape.Register
+        last_def = defaultdict_by_id(lambda: -1)
+        values = dict_by_id()
+        numbers = {}
+        seen = {}
+        res = []
+
+        def regs(reg):
+            return itertools.chain(*(x.duplicates for x in
+                                     itertools.chain((reg,), reg.vector)))
+
+        def simple(reg):
+            return not reg.vector and reg.vectorbase is reg and \
+                len(reg.duplicates) == 1
+
+        def value(reg):
+            try:
+                return values[reg]
+            except KeyError:
+                return id(reg), tuple(last_def[x] for x in regs(reg))
+
+        def get_key(inst, defs):
+            if not (isinstance(inst, self.pure + self.constants) or
+                    self.is_cisc(inst)):
+                return
+            if not defs or len(set(id(x) for x in defs)) < len(defs) or \
+               any(x.reg_type not in self.move_classes for x in defs) or \
+               set(id(x) for x in defs) & set(id(x) for x in inst.get_used()):
+                return
+            args = []
+            for arg in inst.args:
+                if any(arg is x for x in defs):
+                    args.append(None)
+                elif isinstance(arg, Register):
+                    args.append(value(arg))
+                elif isinstance(arg, (int, str, type(None))):
+                    args.append(arg)
+                else:
+                    return
+            if isinstance(inst, self.commutative) and \
+               isinstance(args[-1], tuple) and isinstance(args[-2], tuple):
+                args[-2:] = sorted(args[-2:], key=repr)
+            if isinstance(inst, Mergeable):
+                if not all(isinstance(x, (int, str, type(None)))
+                           for x in inst.kwargs.values()):
+                    return
+                args.append(inst.merge_id())
+            return type(inst), inst.get_size(), tuple(args)
+
+        for n, inst in enumerate(self.block.instructions):
+            defs = list(inst.get_def())
+            key = get_key(inst, defs)
+            new = [inst]
+            if key in seen and not isinstance(inst, self.constants):
+                first, first_defs = seen[key]
+                if all(last_def[x] == first for reg in first_defs
+                       for x in regs(reg)):
+                    if self.count:
+                        inst.add_usage(self.saved)
+                    self.stats[inst.name() if isinstance(inst, Mergeable)
+                               else type(inst).__name__] += 1
+                    self.n_replaced += 1
+                    new = []
+                    for dest, source in zip(defs, first_defs):
+                        move = self.move_classes[dest.reg_type](
+                            dest, source, add_to_prog=False)
+                        move.caller = inst.caller
+                        new.append(move)
+            if isinstance(inst, self.moves) and simple(inst.args[0]):
+                source = value(inst.args[1])
+            else:
+                source = None
+            for reg in defs:
+                for x in regs(reg):
+                    last_def[x] = n
+                    values.pop(x)
+            if source:
+                values[inst.args[0]] = source
+            if key:
+                number = numbers.setdefault(key, len(numbers))
+                if new[0] is inst:
+                    seen[key] = n, defs
+                for i, reg in enumerate(defs):
+                    if simple(reg):
+                        values[reg] = 'value', number, i
+            res += new
+        self.block.instructions[:] = res
+        if self.n_replaced and self.block.parent.program.verbose:
+            print('Replaced %d common subexpressions: %s' %
+                  (self.n_replaced, dict(self.stats)))
+        return self.n_replaced
+
+class LoopInvariantHoister:
+    """ Move instructions that compute the same in every iteration of
+    a run-time loop to the block preceding the loop. This covers
+    local computation (clear arithmetic, comparisons, and conversion,
+    local secret arithmetic, and constants) whose inputs are not
+    written within the loop as well as loads from fixed memory
+    addresses that are not written within the loop. The results have
+    to be written only once in the whole tape. Instructions that might
+    fail such as division are not moved because the loop might not
+    run at all.
+
+    Loops containing function calls or function definitions are left
+    alone. Inner loops are processed first, so instructions can move
+    through several levels. """
+
+    pure = (AddBase, SubBase, MulBase, ClearImmediate, SharedImmediate,
+            ClearShiftInstruction, IntegerInstruction,
+            UnaryComparisonInstruction, legendrec_class, andc_class,
+            orc_class, xorc_class, notc_class, shlc_class, shrc_class,
+            convint_class, convmodp_class, ldi_class, ldsi_class,
+            ldint_class, movc_class, movs_class, movint_class)
+    # might fail at run time
+    unsafe = (InvertInstruction, modci_class, divint_class)
+    memory_types = ('s', 'c', 'ci', 'sg', 'cg')
+    loads = (ldmc_class, ldms_class, ldmint_class)
+
+    def __init__(self, tape):
+        self.tape = tape
+        # number of instructions moved per loop
+        self.hoisted = []
+
+    @staticmethod
+    def roots(reg):
+        """ Identifiers covering all registers overlapping with
+        :py:obj:`reg`. """
+        for dup in reg.duplicates:
+            while dup.vectorbase is not dup:
+                dup = dup.vectorbase
+            yield id(dup)
+
+    def loops(self):
+        """ Loops as pairs of first and last block index, innermost
+        first. """
+        blocks = self.tape.basicblocks
+        index = dict((id(block), i) for i, block in enumerate(blocks))
+        res = []
+        for i, block in enumerate(blocks):
+            target = index.get(id(block.exit_block))
+            if target is not None and 0 < target <= i:
+                res.append((target, i))
+        return sorted(res, key=lambda x: x[1] - x[0])
+
+    def movable(self, start, end):
+        """ Whether the blocks of a loop are self-contained and
+        preceded by a block falling through to the start. """
+        blocks = self.tape.basicblocks
+        pre = blocks[start - 1]
+        if pre.exit_condition is not None or pre.exit_block is not None:
+            return False
+        for block in blocks[start:end + 1]:
+            if block.previous_block is not None or \
+               block in self.tape.function_basicblocks or \
+               isinstance(block.exit_condition, jmpi):
+                return False
+        for i, block in enumerate(blocks):
+            if block.exit_block is blocks[start] and i != end:
+                return False
+        return True
+
+    def run(self):
+        """ :returns: total number of moved instructions """
+        blocks = self.tape.basicblocks
+        n_defs = defaultdict(lambda: 0)
+        barrier = False
+        for block in blocks:
+            for inst in block.instructions:
+                for reg in inst.get_def():
+                    for root in self.roots(reg):
+                        n_defs[root] += 1
+                if isinstance(inst, run_tape):
+                    barrier = True
+        total = 0
+        for start, end in self.loops():
+            if self.movable(start, end):
+                n = self.hoist(blocks[start - 1], blocks[start:end + 1],
+                               n_defs, barrier)
+                if n:
+                    self.hoisted.append((blocks[start].name, n))
+                    total += n
+        return total
+
+    def hoist(self, pre, loop, n_defs, barrier):
+        defined = set()
+        writes = defaultdict(list)
+        for block in loop:
+            for inst in block.instructions:
+                for reg in inst.get_def():
+                    defined.update(self.roots(reg))
+                if isinstance(inst, WriteMemoryInstruction) and \
+                   isinstance(inst.args[0], Compiler.program.Tape.Register) \
+                   and inst.args[0].reg_type in self.memory_types:
+                    if isinstance(inst, DirectMemoryInstruction):
+                        writes[inst.args[0].reg_type].append(
+                            (inst.args[1], inst.args[1] + inst.get_size()))
+                    else:
+                        writes[inst.args[0].reg_type].append(None)
+                elif isinstance(inst, (WriteMemoryInstruction, call_tape,
+                                       join_tape, run_tape)):
+                    barrier = True
+        n = 0
+        for block in loop:
+            remaining = []
+            for inst in block.instructions:
+                if self.invariant(inst, defined, n_defs, writes, barrier):
+                    pre.instructions.append(inst)
+                    for reg in inst.get_def():
+                        defined.difference_update(self.roots(reg))
+                    n += 1
+                else:
+                    remaining.append(inst)
+            block.instructions[:] = remaining
+        return n
+
+    def invariant(self, inst, defined, n_defs, writes, barrier):
+        if isinstance(inst, self.loads):
+            reg_type = inst.args[0].reg_type
+            if barrier or reg_type not in self.memory_types:
+                return False
+            address = inst.args[1]
+            end = address + inst.get_size()
+            for interval in writes[reg_type]:
+                if interval is None or \
+                   (interval[0] < end and address < interval[1]):
+                    return False
+        elif not isinstance(inst, self.pure) or \
+             isinstance(inst, self.unsafe):
+            return False
+        defs = list(inst.get_def())
+        if not defs:
+            return False
+        for reg in defs:
+            for root in self.roots(reg):
+                if n_defs[root] != 1:
+                    return False
+        for reg in inst.get_used():
+            if not defined.isdisjoint(self.roots(reg)):
+                return False
+        return True
+
+
+class LoopPipeliner:
+    """ Software pipelining of a straight-line loop body. The body is
+    split into stages of consecutive communication rounds according
+    to the round depths in its dependency graph. Step :math:`j` of the
+    pipelined loop runs stage :math:`s` of iteration :math:`j-s` for
+    all stages in descending order, which keeps the order of
+    instructions depending on each other via registers with two
+    stages. The merger then combines the last rounds of one iteration
+    with the first rounds of the next within the step.
+
+    Values crossing stages are passed in registers linked to the first
+    definition as with :py:func:`update`. Values crossing more than
+    one stage are additionally moved along a chain of such registers
+    at the start of every step.
+
+    The merger only keeps the order of memory accesses with different
+    address registers with ``-M``. Without it, a body writing memory
+    of a type also accessed by another instruction is therefore not
+    pipelined. With more than two stages, stage :math:`s` of an
+    iteration runs before stage :math:`s+2` of the previous one, so
+    the body is limited to two stages if it writes to memory of a type
+    accessed in stages that far apart. """
+
+    move_classes = CommonSubexpressionEliminator.move_classes
+
+    def __init__(self, block, instructions, index, n_stages):
+        """
+        :param block: basic block the body has been compiled in
+        :param instructions: instructions of the loop body
+        :param index: placeholder register for the loop index
+        :param n_stages: maximal number of stages
+        """
+        self.program = block.parent.program
+        self.instructions = instructions
+        self.index = index
+        self.reason = None
+        template = copy.copy(block)
+        template.instructions = list(instructions)
+        depths = Merger(template, self.program.options,
+                        tuple(self.program.to_merge)).real_depths
+        self.n_rounds = max(depths + [0])
+        self.n_stages = max(1, min(n_stages, self.n_rounds))
+        self.stages = self.split(depths)
+        self.limitation = None
+        # stage of definition and maximal distance of use by root id
+        self.def_stage = {}
+        self.distance = {}
+        self.families = {}
+        if self.n_stages > 1 and self.memory_conflict(0) and \
+           not self.program.options.preserve_mem_order:
+            self.reason = 'memory read and written without -M'
+        else:
+            if self.n_stages > 2 and self.memory_conflict(2):
+                self.limitation = \
+                    'memory accesses across more than two stages'
+                self.n_stages = 2
+                self.stages = self.split(depths)
+            self.analyze()
+        if self.reason:
+            self.n_stages = 1
+            self.stages = [0] * len(instructions)
+
+    def split(self, depths):
+        return [max(depth - 1, 0) * self.n_stages // self.n_rounds
+                if self.n_rounds else 0 for depth in depths]
+
+    def memory_conflict(self, distance):
+        """ Whether memory of a type written by an instruction might
+        be accessed by another one at least :py:obj:`distance` stages
+        apart. Addresses are not compared. """
+        accesses = defaultdict(list)
+        writes = defaultdict(list)
+        for inst, stage in zip(self.instructions, self.stages):
+            if isinstance(inst, matmulsm_class):
+                accesses['s'].append(stage)
+            elif isinstance(inst, (ReadMemoryInstruction,
+                                   WriteMemoryInstruction)):
+                reg_type = inst.args[0].reg_type
+                accesses[reg_type].append(stage)
+                if isinstance(inst, WriteMemoryInstruction):
+                    writes[reg_type].append(stage)
+        if not distance:
+            return any(len(accesses[reg_type]) > 1 for reg_type in writes)
+        return any(max(stages) - min(accesses[reg_type]) >= distance or
+                   max(accesses[reg_type]) - min(stages) >= distance
+                   for reg_type, stages in writes.items())
+
+    @staticmethod
+    def root(reg):
+        while reg.vectorbase is not reg:
+            reg = reg.vectorbase
+        return reg
+
+    def analyze(self):
+        roots = {}
+        defs = defaultdict(list)
+        for inst, stage in zip(self.instructions, self.stages):
+            for reg in inst.get_def():
+                root = self.root(reg)
+                key = id(root)
+                if len(reg.duplicates) > 1 or len(root.duplicates) > 1:
+                    self.reason = 'linked registers'
+                    return
+                if self.def_stage.setdefault(key, stage) != stage:
+                    self.reason = 'vector defined in several stages'
+                    return
+                roots[key] = root
+                defs[key].append(reg)
+        for inst, stage in zip(self.instructions, self.stages):
+            for reg in inst.get_used():
+                key = id(self.root(reg))
+                if key in self.def_stage and stage > self.def_stage[key]:
+                    if reg is not roots[key]:
+                        self.reason = 'vector elements used across stages'
+                        return
+                    self.distance[key] = max(self.distance.get(key, 0),
+                                             stage - self.def_stage[key])
+        for key, distance in self.distance.items():
+            root = roots[key]
+            if any(reg is not root for reg in defs[key]):
+                self.reason = 'vector elements used across stages'
+                return
+            if distance > 1 and root.reg_type not in self.move_classes:
+                self.reason = 'no move for %s registers' % root.reg_type
+                return
+
+    def new_register(self, reg):
+        """ Fresh register of the same type and size as :py:obj:`reg`. """
+        res = type(reg).__new__(type(reg))
+        Compiler.program.Tape.Register.__init__(res, reg.reg_type,
+                                                reg.program, size=reg.size)
+        res.reg_type = reg.reg_type
+        return res
+
+    def family(self, key, distance, reg=None):
+        """ Register holding the value defined :py:obj:`distance`
+        steps ago, or linking :py:obj:`reg` to it. """
+        if reg is None:
+            return self.families[key, distance]
+        family = self.families.setdefault((key, distance), reg)
+        if reg is not family:
+            reg.link(family)
+        return family
+
+    def substitute(self, reg, regs):
+        root = self.root(reg)
+        new = regs[id(root)]
+        if reg is root:
+            return new
+        return new.get_vector(reg.i - root.i, reg.size)
+
+    @staticmethod
+    def copy_instruction(inst):
+        # copy.copy() fails for slots shadowed by class attributes
+        res = type(inst).__new__(type(inst))
+        for cls in type(inst).__mro__:
+            slots = cls.__dict__.get('__slots__', ())
+            for name in [slots] if isinstance(slots, str) else slots:
+                try:
+                    cls.__dict__[name].__set__(
+                        res, cls.__dict__[name].__get__(inst))
+                except AttributeError:
+                    pass
+        if hasattr(inst, '__dict__'):
+            res.__dict__.update(inst.__dict__)
+        return res
+
+    def copy(self, inst, stage, index, regs, pipelined):
+        Register = Compiler.program.Tape.Register
+        defs = set(id(reg) for reg in inst.get_def())
+        def convert(arg):
+            if not isinstance(arg, Register):
+                return arg
+            if arg is self.index:
+                return index
+            key = id(self.root(arg))
+            if key not in self.def_stage:
+                return arg
+            if id(arg) in defs:
+                if key not in regs:
+                    regs[key] = self.new_register(self.root(arg))
+                return self.substitute(arg, regs)
+            distance = stage - self.def_stage[key]
+            if pipelined and distance:
+                return self.family(key, distance - 1)
+            return self.substitute(arg, regs)
+        res = self.copy_instruction(inst)
+        if isinstance(inst, Mergeable) and hasattr(inst, 'calls'):
+            res.args = tuple(convert(arg) for arg in inst.args)
+            res.calls = [(res.args, inst.kwargs)]
+            res.used = [convert(arg) for arg in inst.used]
+        else:
+            res.args = [convert(arg) for arg in inst.args]
+        return res
+
+    def emit(self, instructions, index, pipelined):
+        """ Append copies of the body instructions given with their
+        stages to the current block.
+
+        :param index: stage-indexed loop index registers
+        """
+        regs = {}
+        block = self.program.curr_block
+        for inst, stage in instructions:
+            block.instructions.append(
+                self.copy(inst, stage, index[stage], regs, pipelined))
+        return regs
+
+    def iteration(self, index):
+        """ Whole body for one iteration without pipelining. """
+        self.emit(zip(self.instructions, self.stages),
+                  [index] * self.n_stages, False)
+
+    def step(self, step, index):
+        """ Step of the pipelined loop running the stages in
+        :py:obj:`index`.
+
+        :param step: step number if known at compile time
+        :param index: dictionary from stage to loop index register
+        """
+        body = list(zip(self.instructions, self.stages))
+        regs = self.emit([(inst, stage) for s in sorted(index, reverse=True)
+                          for inst, stage in body if stage == s],
+                         [index.get(i) for i in range(self.n_stages)], True)
+        for key, distance in self.distance.items():
+            moves = [(i, self.family(key, i - 1))
+                     for i in range(distance - 1, 0, -1)
+                     if step is None or step >= self.def_stage[key] + i]
+            if key in regs:
+                moves.append((0, regs[key]))
+            for i, source in moves:
+                dest = self.new_register(source)
+                self.family(key, i, dest)
+                self.move_classes[dest.reg_type](dest, source)
+
 class RegintOptimizer:
+    """ Constant propagation and folding for clear registers. With
+    --constant-propagation, this covers cint and cgf2n arithmetic
+    in addition to regint, and operations on secret registers with
+    constant clear operands are replaced by operations with immediate
+    values or moves, which leaves the constants unused. """
+
+    clear_ops = {
+        addc_class: '__add__', subc_class: '__sub__', mulc_class: '__mul__',
+        andc_class: '__and__', orc_class: '__or__', xorc_class: '__xor__'}
+    functions = {
+        '__add__': operator.add, '__sub__': operator.sub,
+        '__rsub__': lambda x, y: y - x, '__mul__': operator.mul,
+        '__lshift__': operator.lshift, '__rshift__': operator.rshift,
+        '__and__': operator.and_, '__or__': operator.or_,
+        '__xor__': operator.xor}
+    # operations depending on the representative in the clear domain
+    bitwise_ops = ('__rshift__', '__and__', '__or__', '__xor__')
+    # addition and subtraction is XOR in GF(2^n)
+    gf2n_ops = {
+        '__add__': operator.xor, '__sub__': operator.xor,
+        '__rsub__': operator.xor, '__and__': operator.and_,
+        '__or__': operator.or_, '__xor__': operator.xor}
+
     def __init__(self):
         self.cache = util.dict_by_id()
         self.offset_cache = util.dict_by_id()
@@ -803,12 +1647,139 @@ class RegintOptimizer:
         if (new_base.i, new_offset, multiplier) not in self.rev_offset_cache:
             self.rev_offset_cache[new_base.i, new_offset, multiplier] = res
 
+    @staticmethod
+    def new(inst, name, *args):
+        """ New instruction in the same domain as :py:obj:`inst`. """
+        if inst.args[0].reg_type in ('cg', 'sg'):
+            name = 'g' + name
+        return getattr(Compiler.instructions, name)(*args, add_to_prog=False)
+
+    def fold_clear(self, inst, op, x, y, program):
+        """ Fold clear operation with register operand :py:obj:`x`
+        and register or immediate operand :py:obj:`y`. """
+        res = inst.args[0]
+        gf2n = res.reg_type == 'cg'
+        a = self.cache[x] if x in self.cache else None
+        if isinstance(y, int):
+            b = y
+        else:
+            b = self.cache[y] if y in self.cache else None
+        if op in ('__lshift__', '__rshift__') and b is not None and \
+           not 0 <= b < program.bit_length:
+            # left to the virtual machine
+            return inst
+        if a is not None and b is not None:
+            if gf2n:
+                if op not in self.gf2n_ops or a < 0 or b < 0:
+                    return inst
+                value = self.gf2n_ops[op](a, b)
+            elif op in self.bitwise_ops and not (
+                    self.exact(a, program) and
+                    (op == '__rshift__' or self.exact(b, program))):
+                return inst
+            else:
+                value = self.functions[op](a, b)
+            self.cache[res] = value
+            if 0 <= value < 2 ** 31 or (not gf2n and abs(value) < 2 ** 31):
+                return self.new(inst, 'ldi', res, value)
+            return inst
+        if op == '__mul__' and 0 in (a, b):
+            self.cache[res] = 0
+            return self.new(inst, 'ldi', res, 0)
+        if op == '__mul__' and a == 1 and not isinstance(y, int):
+            return self.new(inst, 'movc', res, y)
+        if b == 0 and op in ('__add__', '__sub__', '__lshift__',
+                             '__rshift__') or \
+           b == 1 and op == '__mul__':
+            return self.new(inst, 'movc', res, x)
+        if a == 0 and op == '__add__' and not isinstance(y, int):
+            return self.new(inst, 'movc', res, y)
+        return inst
+
+    @staticmethod
+    def exact(value, program):
+        """ Whether a clear value is its own representative in the
+        virtual machine. """
+        return 0 <= value < 2 ** program.bit_length
+
+    def fold_mixed(self, inst, secret, clear):
+        """ Replace operation of secret and constant clear register
+        by operation with immediate value or move. """
+        res = inst.args[0]
+        value = self.cache[clear]
+        if isinstance(inst, submr_class):
+            if abs(value) < 2 ** 31 and \
+               (value >= 0 or res.reg_type == 's'):
+                return self.new(inst, 'subsfi', res, secret, value)
+            return inst
+        if value == 0:
+            if isinstance(inst, mulm_class):
+                return self.new(inst, 'ldsi', res, 0)
+            return self.new(inst, 'movs', res, secret)
+        if value == 1 and isinstance(inst, mulm_class):
+            return self.new(inst, 'movs', res, secret)
+        if abs(value) < 2 ** 31 and (value >= 0 or res.reg_type == 's'):
+            name = {addm_class: 'addsi', subml_class: 'subsi',
+                    mulm_class: 'mulsi'}
+            for cls in name:
+                if isinstance(inst, cls):
+                    return self.new(inst, name[cls], res, secret, value)
+        return inst
+
+    def invalidate(self, reg, before):
+        """ Remove cached information on a register that has been
+        overwritten unless it has just been updated. """
+        for cache, entry in zip((self.cache, self.offset_cache,
+                                 self.range_cache), before):
+            if entry is not None and cache.content.get(id(reg)) is entry:
+                cache.pop(reg)
+            for x in itertools.chain(reg.vector, (reg.vectorbase,)):
+                if x is not reg:
+                    cache.pop(x)
+
     def run(self, instructions, program):
         changed = defaultdict(int)
+        fold = program.options.constant_propagation
         for i, inst in enumerate(instructions):
             pre = inst
+            if fold:
+                defs = list(inst.get_def())
+                before = [[cache.content.get(id(reg)) for cache in (
+                    self.cache, self.offset_cache, self.range_cache)]
+                          for reg in defs]
             if isinstance(inst, ldint_class):
                 self.cache[inst.args[0]] = inst.args[1]
+            elif fold and isinstance(inst, ldi_class):
+                self.cache[inst.args[0]] = inst.args[1]
+            elif fold and isinstance(inst, tuple(self.clear_ops)):
+                op = next(self.clear_ops[cls] for cls in type(inst).__mro__
+                          if cls in self.clear_ops)
+                instructions[i] = self.fold_clear(
+                    inst, op, inst.args[1], inst.args[2], program)
+            elif fold and isinstance(inst, ClearImmediate) and \
+                 inst.args[0].reg_type in ('c', 'cg') and \
+                 getattr(inst, 'op', None) in self.functions:
+                instructions[i] = self.fold_clear(
+                    inst, inst.op, inst.args[1], inst.args[2], program)
+            elif fold and type(inst) == convmodp_class and \
+                 inst.args[1] in self.cache:
+                value = self.cache[inst.args[1]]
+                bit_length = inst.args[3]
+                if self.exact(value, program) and \
+                   (not bit_length or value < 2 ** (bit_length - 1)):
+                    self.cache[inst.args[0]] = value
+                    if value < 2 ** 31:
+                        instructions[i] = ldint(inst.args[0], value,
+                                                add_to_prog=False)
+            elif fold and isinstance(inst, submr_class) and \
+                 inst.args[1] in self.cache:
+                instructions[i] = self.fold_mixed(inst, inst.args[2],
+                                                  inst.args[1])
+            elif fold and isinstance(inst, (addm_class, subml_class,
+                                            mulm_class)) and \
+                 inst.args[2] in self.cache:
+                instructions[i] = self.fold_mixed(inst, inst.args[1],
+                                                  inst.args[2])
             elif isinstance(inst, incint):
                 if inst.args[2] == 1 and inst.args[3] == 1 and \
                    inst.args[4] == len(inst.args[0]) and \
@@ -817,8 +1788,11 @@ class RegintOptimizer:
                         len(inst.args[0]), self.cache[inst.args[1]]
             elif isinstance(inst, IntegerInstruction):
                 if inst.args[1] in self.cache and inst.args[2] in self.cache:
-                    res = inst.op(self.cache[inst.args[1]],
-                                  self.cache[inst.args[2]])
+                    try:
+                        res = inst.op(self.cache[inst.args[1]],
+                                      self.cache[inst.args[2]])
+                    except ZeroDivisionError:
+                        res = float('inf')
                     if abs(res) < 2 ** 31:
                         self.cache[inst.args[0]] = res
                         instructions[i] = ldint(inst.args[0], res,
@@ -889,6 +1863,9 @@ class RegintOptimizer:
                     cond = self.cache[inst.args[0]]
                     if not cond:
                         instructions[i] = None
+            if fold:
+                for reg, entries in zip(defs, before):
+                    self.invalidate(reg, entries)
             if pre != instructions[i]:
                 changed[type(inst).__name__] += 1
         pre = len(instructions)
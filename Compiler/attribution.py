@@ -0,0 +1,168 @@
+"""
+Attribution of preprocessing, communication, and rounds to the
+source code as activated by ``compile.py --attribution``. Every
+instruction records the call site in the program source where it
+was created. The numbers are collected per call site when merging
+instructions and multiplied along the same tree as the totals
+output by the compiler, that is, with the number of loop iterations
+and threads. The same call sites provide tracebacks with
+``compile.py --trace-frames``.
+"""
+
+import collections
+import linecache
+import os
+import sys
+
+
+def metric(key):
+    """ Name of a metric for a key in :py:class:`Compiler.program.Tape.ReqNum`.
+
+    :param key: tuple such as :py:obj:`('modp', 'triple')`
+    """
+    domain, kind = key[0], key[1]
+    if domain in ("edabit", "sedabit"):
+        return "strict-edabits" if domain == "sedabit" else "edabits"
+    elif domain == "matmul":
+        return "matrix-multiplications"
+    if domain == "modp":
+        domain = "integer"
+    return "%s-%ss" % (domain, kind.replace(" ", "-"))
+
+
+class CallSites:
+    """ Table of interned call sites. A call site is the stack of
+    frames outside the compiler package when an instruction is
+    created, given by file name, line number, and function name from
+    the outermost frame. Identifier 0 is used for instructions created
+    by the compiler itself. Using :py:func:`sys._getframe` and
+    interning makes this much cheaper than storing
+    :py:func:`inspect.stack` for every instruction.
+
+    :param n_frames: number of innermost frames to record in addition
+      even if they are in the compiler package
+    """
+
+    compiler_dir = os.path.dirname(os.path.abspath(__file__))
+    driver = os.path.join(compiler_dir, "compilerLib.py")
+
+    def __init__(self, n_frames=0):
+        self.n_frames = n_frames
+        self.sites = [()]
+        self.ids = {(): 0}
+        # 0 for source, 1 for compiler, 2 for compiler driver by file name
+        self.kinds = {}
+
+    def kind(self, filename):
+        try:
+            return self.kinds[filename]
+        except KeyError:
+            path = os.path.abspath(filename)
+            if path == self.driver:
+                res = 2
+            elif path.startswith(self.compiler_dir + os.sep):
+                res = 1
+            else:
+                res = 0
+            self.kinds[filename] = res
+            return res
+
+    def capture(self, depth=2):
+        """ Identifier of the call site of the caller's caller.
+
+        :param depth: number of frames to skip
+        """
+        frame = sys._getframe(depth)
+        stack = []
+        n_frames = self.n_frames
+        while frame is not None:
+            code = frame.f_code
+            kind = self.kind(code.co_filename)
+            if kind == 2:
+                break
+            elif kind == 0 or len(stack) < n_frames:
+                stack.append((code.co_filename, frame.f_lineno, code.co_name))
+            frame = frame.f_back
+        stack = tuple(reversed(stack))
+        try:
+            return self.ids[stack]
+        except KeyError:
+            self.ids[stack] = len(self.sites)
+            self.sites.append(stack)
+            return self.ids[stack]
+
+    def trace(self, site):
+        """ Call site in the format of :py:func:`inspect.stack` without
+        the frame objects (innermost first). """
+        return [(filename, lineno, name,
+                 [linecache.getline(filename, lineno)])
+                for filename, lineno, name in reversed(self.sites[site])]
+
+    @staticmethod
+    def label(frame):
+        filename, lineno, name = frame
+        return "%s (%s:%d)" % (name, os.path.basename(filename), lineno)
+
+    def source(self, site):
+        """ Frames of a call site outside the compiler package. """
+        return [frame for frame in self.sites[site]
+                if self.kind(frame[0]) == 0]
+
+    def folded(self, site):
+        """ Call site as semicolon-separated source frames. """
+        source = self.source(site)
+        if source:
+            return ";".join(self.label(frame) for frame in source)
+        else:
+            return "[compiler]"
+
+    def line(self, site):
+        """ Innermost source line of a call site. """
+        source = self.source(site)
+        if source:
+            return self.label(source[-1])
+        else:
+            return "[compiler]"
+
+    def write(self, usage, prefix):
+        """ Write one file of folded stacks per metric as used by
+        flame graph tools and output the source lines with the most
+        rounds and bytes. Entries in loops with an unknown number of
+        iterations are omitted.
+
+        :param usage: numbers by call site and metric
+        :param prefix: file name prefix
+        :returns: list of file names
+        """
+        by_metric = collections.defaultdict(dict)
+        n_unknown = 0
+        for (site, name), num in usage.items():
+            if num == float("inf") or num < 0:
+                n_unknown += 1
+            elif num:
+                by_metric[name][site] = num
+        filenames = []
+        for name, nums in sorted(by_metric.items()):
+            filename = "%s-%s.folded" % (prefix, name)
+            stacks = collections.defaultdict(lambda: 0)
+            for site, num in nums.items():
+                stacks[self.folded(site)] += num
+            with open(filename, "w") as out:
+                for stack, num in sorted(stacks.items()):
+                    print("%s %d" % (stack, round(num)), file=out)
+            filenames.append(filename)
+        print("Writing attribution to", ", ".join(filenames))
+        if n_unknown:
+            print("Omitted %d entries in loops with unknown number of "
+                  "iterations" % n_unknown)
+        for name in "rounds", "bytes":
+            lines = collections.defaultdict(lambda: 0)
+            for site, num in by_metric[name].items():
+                lines[self.line(site)] += num
+            top = sorted(lines.items(), key=lambda x: -x[1])[:5]
+            if top:
+                total = sum(lines.values())
+                print("Most %s (%d in total): %s" % (
+                    name, total, ", ".join("%s %d" % (line, num)
+                                           for line, num in top)))
+        return filenames
@@ -0,0 +1,385 @@
+"""
+Content-addressed caches for the output of ``compile.py``.
+
+The key of :py:class:`CompilationCache` covers the source file, the
+content of the compiler package, the command-line options, and the
+program arguments. A hit restores the bytecode and schedule files
+without executing the source. Files read by the source at compile
+time (other than Python modules in the compiler package) are not part
+of the key.
+
+:py:class:`TemplateCache` stores the optimized instruction templates
+of CISC instructions such as fixed-point multiplication and
+comparison across compilations.
+"""
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+# options without effect on the output
+ignored_options = "cache", "profile", "papers", "verbose", "hostfile", \
+    "tidy_output", "phase_profile", "cisc_cache"
+
+
+def package_hash():
+    """ Hash of all Python files in the compiler package. """
+    h = hashlib.sha256()
+    root = os.path.dirname(os.path.abspath(__file__))
+    for dirpath, dirnames, filenames in sorted(os.walk(root)):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(".py"):
+                path = os.path.join(dirpath, filename)
+                h.update(os.path.relpath(path, root).encode())
+                with open(path, "rb") as f:
+                    h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+def file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class CompilationCache:
+    """ Cache entries are directories named after the key containing
+    copies of the output files and a manifest with per-tape hashes as
+    computed by :py:func:`~Compiler.program.Tape.write_bytes`. """
+
+    manifest_name = "manifest.json"
+
+    def __init__(self, prog, options, infile):
+        self.prog = prog
+        self.dir = os.path.join(prog.programs_dir, "Cache")
+        h = hashlib.sha256()
+        with open(infile, "rb") as f:
+            h.update(f.read())
+        h.update(package_hash().encode())
+        opts = dict((key, value) for key, value in vars(options).items()
+                    if key not in ignored_options)
+        h.update(json.dumps(opts, sort_keys=True, default=str).encode())
+        h.update(json.dumps([prog.name] + list(prog.args)).encode())
+        h.update(str(os.getenv("PLAYERS")).encode())
+        self.key = h.hexdigest()
+        self.entry = os.path.join(self.dir, self.key)
+
+    def output_files(self, tape_names):
+        prog = self.prog
+        res = [prog.programs_dir + "/Schedules/%s.sch" % prog.name]
+        res += [prog.programs_dir + "/Bytecode/%s.bc" % name
+                for name in tape_names]
+        return res
+
+    def restore(self):
+        """ Restore output files if present in cache.
+
+        :returns: whether the output could be restored
+        """
+        try:
+            with open(os.path.join(self.entry, self.manifest_name)) as f:
+                manifest = json.load(f)
+            tape_names = [name for name, _ in manifest["tapes"]]
+            sources = [os.path.join(self.entry, os.path.basename(x))
+                       for x in self.output_files(tape_names)]
+            for (name, digest), source in zip(manifest["tapes"], sources[1:]):
+                if file_hash(source) != digest:
+                    print("Cache entry %s corrupted, recompiling" % self.key)
+                    return False
+        except (OSError, ValueError, KeyError):
+            return False
+        for source, dest in zip(sources, self.output_files(tape_names)):
+            print("Restoring", dest)
+            shutil.copyfile(source, dest)
+        if manifest.get("public_input"):
+            dest = self.prog.programs_dir + "/Public-Input/%s" % self.prog.name
+            print("Restoring", dest)
+            shutil.copyfile(os.path.join(self.entry, "public_input"), dest)
+            print("WARNING: %s is required to run the program" % dest)
+        os.utime(self.entry)
+        print("Restored compilation output from cache", self.key)
+        print("Hash:", manifest["hash"])
+        return True
+
+    def store(self):
+        """ Store output files after compilation. """
+        prog = self.prog
+        if prog.input_files:
+            print("Not caching compilation because it writes to Player-Data")
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.dir)
+        h = hashlib.sha256()
+        tapes = []
+        for tape in prog.tapes:
+            tapes.append((tape.name, tape.hash.hex()))
+            h.update(tape.hash)
+        for source in self.output_files(name for name, _ in tapes):
+            shutil.copyfile(source, os.path.join(tmp, os.path.basename(source)))
+        public_input = prog.public_input_file is not None
+        if public_input:
+            shutil.copyfile(prog.public_input_file.name,
+                            os.path.join(tmp, "public_input"))
+        manifest = dict(name=prog.name, tapes=tapes, hash=h.hexdigest(),
+                        argv=sys.argv, public_input=public_input)
+        with open(os.path.join(tmp, self.manifest_name), "w") as f:
+            json.dump(manifest, f)
+        shutil.rmtree(self.entry, ignore_errors=True)
+        try:
+            os.replace(tmp, self.entry)
+        except OSError:
+            # concurrent compilation stored the same entry
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        if prog.verbose:
+            print("Stored compilation output in cache", self.key)
+
+
+class Uncacheable(Exception):
+    pass
+
+
+def stable_name(x):
+    """ Description of a value that is the same across compilations.
+
+    :raises: :py:class:`Uncacheable` if there is none
+    """
+    if x is None or isinstance(x, (bool, int, float, str)):
+        return repr(x)
+    if isinstance(x, (tuple, list)):
+        return "(%s)" % ",".join(stable_name(y) for y in x)
+    if isinstance(x, type) or callable(x):
+        module = getattr(x, "__module__", None) or ""
+        if not module.startswith("Compiler.") or \
+           not hasattr(x, "__qualname__"):
+            raise Uncacheable(x)
+        res = "%s:%s:%s" % (module, x.__qualname__, x.__name__)
+        closure = getattr(x, "__closure__", None) or ()
+        if closure:
+            res += "[%s]" % ",".join(
+                stable_name(cell.cell_contents) for cell in closure)
+        return res
+    raise Uncacheable(x)
+
+
+class TemplateCache:
+    """ Size-limited cache of CISC templates in ``Programs/Cache/CISC``
+    as activated by ``--cisc-cache``. The key covers the merge id of the
+    instruction (function, parameters, and security parameter), the
+    content of the compiler package, the options, and global settings
+    such as the bit length and the fixed-point precision. Templates are
+    only stored if the generation has no side effects other than
+    requirements of bit length and options, output, and warning flags,
+    which are replayed on loading. Least recently used entries are removed when the total
+    size exceeds the limit. """
+
+    def __init__(self, prog, options, max_size):
+        self.prog = prog
+        self.dir = os.path.join(prog.programs_dir, "Cache", "CISC")
+        self.max_size = max_size
+        opts = dict((key, value) for key, value in vars(options).items()
+                    if key not in ignored_options + ("cisc",))
+        self.base = json.dumps([package_hash(), opts], sort_keys=True,
+                               default=str)
+        self.hits = 0
+        self.stores = 0
+
+    def settings(self):
+        from .types import sfix, cfix, sfloat
+        prog = self.prog
+        return [prog.bit_length, prog.prime, prog._use_trunc_pr,
+                prog.use_dabit, prog._edabit, prog._invperm, prog._split,
+                prog._square, prog._always_raw, prog._linear_rounds,
+                prog.use_mulm, prog.use_unsplit,
+                prog.allow_tight_parameters, prog._protect_memory,
+                sfix.k, sfix.f, sfix.round_nearest, cfix.k, cfix.f,
+                sfloat.vlen, sfloat.plen, sfloat.round_nearest]
+
+    # flags set when printing warnings
+    warning_flags = "have_warned_trunc_pr", "warned_about_a2b", \
+        "warned_about_tightness"
+
+    def flags(self):
+        return [getattr(self.prog, flag) for flag in self.warning_flags]
+
+    def filename(self, merge_id):
+        """ Cache file for merge id or None if not cacheable. """
+        try:
+            key = json.dumps([self.base, stable_name(merge_id),
+                              self.settings()], default=str)
+        except Uncacheable:
+            return None
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.dir, name + ".json")
+
+    def load(self, merge_id, tape_name):
+        """ Load template and replay the side effects.
+
+        :returns: instructions, arguments, and number of rounds as
+          produced by ``new_instructions()`` or None
+        """
+        filename = self.filename(merge_id)
+        if filename is None:
+            return None
+        try:
+            with open(filename) as f:
+                entry = json.load(f)
+            classes = [self.find_class(*x) for x in entry["classes"]]
+        except (OSError, ValueError, KeyError, AttributeError):
+            return None
+        if entry["flags"][0] != self.flags():
+            # output would differ
+            return None
+        from .program import Tape
+        prog = self.prog
+        # create tape like the uncached generation
+        tape = Tape(tape_name, prog)
+        old_tape = prog.curr_tape
+        prog.curr_tape = tape
+        try:
+            regs = [Tape.Register(reg_type, tape, size=size)
+                    for reg_type, size in entry["registers"]]
+        finally:
+            prog.curr_tape = old_tape
+        decode = lambda arg: regs[arg[1]] if arg[0] == "r" else arg[1]
+        instructions = []
+        for cls, size, args in entry["instructions"]:
+            inst = object.__new__(classes[cls])
+            inst.args = [decode(arg) for arg in args]
+            inst.caller = None
+            if size is not None:
+                inst.size = size
+            instructions.append(inst)
+        for x, bl, reason in entry["bit_lengths"]:
+            old_tape.require_bit_length(bl - 1, x, reason)
+        prog.relevant_opts.update(entry["relevant_opts"])
+        for flag, value in zip(self.warning_flags, entry["flags"][1]):
+            setattr(prog, flag, value)
+        print(entry["output"], end="")
+        os.utime(filename)
+        self.hits += 1
+        return instructions, [decode(arg) for arg in entry["args"]], \
+            entry["n_rounds"]
+
+    @staticmethod
+    def find_class(module, name):
+        from . import instructions
+        from .GC import instructions as gc_inst
+        # instructions might be replaced by functions such as in vectorize()
+        for x in sys.modules[module], instructions, gc_inst:
+            for attr in name, name + "_class":
+                res = getattr(x, attr, None)
+                res = getattr(res, "std_ins", res)
+                if isinstance(res, type) and res.__name__ == name:
+                    return res
+        raise AttributeError(name)
+
+    @contextlib.contextmanager
+    def record(self):
+        """ Record the side effects of generating a template. The
+        output is passed through. """
+        prog = self.prog
+        recording = dict(relevant_opts=set(prog.relevant_opts),
+                         allocated_mem=dict(prog.allocated_mem),
+                         flags=self.flags(),
+                         output=io.StringIO())
+        try:
+            with contextlib.redirect_stdout(recording["output"]):
+                yield recording
+        finally:
+            print(recording["output"].getvalue(), end="")
+
+    def store(self, merge_id, template, tape, recording):
+        """ Store template unless the generation had other side effects.
+
+        :param template: instructions, arguments, and number of rounds
+        :param tape: tape used for generation
+        :param recording: result of :py:func:`record`
+        """
+        filename = self.filename(merge_id)
+        prog = self.prog
+        if filename is None or \
+           recording["allocated_mem"] != dict(prog.allocated_mem):
+            return
+        instructions, args, n_rounds = template
+        try:
+            entry = self.encode(instructions, args)
+        except Uncacheable:
+            return
+        entry["n_rounds"] = n_rounds
+        entry["bit_lengths"] = [
+            (x, bl, tape.bit_length_reason if x == "p" else "")
+            for x, bl in tape.req_bit_length.items()]
+        entry["relevant_opts"] = sorted(
+            prog.relevant_opts - recording["relevant_opts"])
+        entry["output"] = recording["output"].getvalue()
+        entry["flags"] = recording["flags"], self.flags()
+        os.makedirs(self.dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, filename)
+        self.stores += 1
+
+    def encode(self, instructions, args):
+        from .program import Tape
+        regs = {}
+        classes = {}
+        entry = dict(registers=[], classes=[], instructions=[])
+
+        def encode_arg(arg):
+            if isinstance(arg, Tape.Register):
+                # other register types such as bits copy differently
+                if type(arg).copy is not Tape.Register.copy:
+                    raise Uncacheable(arg)
+                if id(arg) not in regs:
+                    regs[id(arg)] = len(entry["registers"]), arg
+                    entry["registers"].append((arg.reg_type, arg.size))
+                return "r", regs[id(arg)][0]
+            elif arg is None or type(arg) in (bool, int, str):
+                return "v", arg
+            else:
+                raise Uncacheable(arg)
+
+        for inst in instructions:
+            cls = type(inst)
+            if cls not in classes:
+                if self.find_class(cls.__module__, cls.__name__) is not cls:
+                    raise Uncacheable(cls)
+                classes[cls] = len(entry["classes"])
+                entry["classes"].append((cls.__module__, cls.__name__))
+            entry["instructions"].append((
+                classes[cls], getattr(inst, "size", None),
+                [encode_arg(arg) for arg in inst.args]))
+        entry["args"] = [encode_arg(arg) if isinstance(arg, Tape.Register)
+                         else ("v", None) for arg in args]
+        return entry
+
+    def evict(self):
+        """ Remove least recently used entries above the size limit. """
+        try:
+            entries = [os.path.join(self.dir, name)
+                       for name in os.listdir(self.dir)]
+            entries = [(os.stat(x), x) for x in entries]
+        except OSError:
+            return
+        entries.sort(key=lambda x: x[0].st_mtime)
+        total = sum(st.st_size for st, _ in entries)
+        removed = 0
+        while entries and total > self.max_size:
+            st, name = entries.pop(0)
+            with contextlib.suppress(OSError):
+                os.remove(name)
+            total -= st.st_size
+            removed += 1
+        if self.prog.verbose:
+            print("CISC template cache: %d hits, %d stored, %d removed, "
+                  "%.1f MB" % (self.hits, self.stores, removed, total / 2 ** 20))
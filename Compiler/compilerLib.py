@@ -1,8 +1,8 @@
+import contextlib
 import inspect
 import os
 import re
 import sys
-import tempfile
 import subprocess
 from optparse import OptionParser
 
@@ -132,6 +132,12 @@ class Compiler:
             default=defaults.max_parallel_open,
             help="restrict number of parallel opens",
         )
+        parser.add_option(
+            "--max-round-bytes",
+            dest="max_round_bytes",
+            default=defaults.max_round_bytes,
+            help="restrict estimated communication per round in bytes",
+        )
         parser.add_option(
             "-D",
             "--dead-code-elimination",
@@ -147,6 +153,29 @@ class Compiler:
             dest="profile",
             help="profile compilation",
         )
+        parser.add_option(
+            "--phase-profile",
+            action="store_true",
+            dest="phase_profile",
+            default=defaults.phase_profile,
+            help="write time and memory usage of compilation phases "
+            "to Programs/Schedules/<progname>.profile.json",
+        )
+        parser.add_option(
+            "--attribution",
+            action="store_true",
+            dest="attribution",
+            default=defaults.attribution,
+            help="attribute preprocessing, communication, and rounds to "
+            "source lines in Programs/Schedules/<progname>-<metric>.folded",
+        )
+        parser.add_option(
+            "--trace-frames",
+            dest="trace_frames",
+            default=defaults.trace_frames,
+            help="keep track of this many innermost frames and the "
+            "source frames for debugging (faster than -d)",
+        )
         parser.add_option(
             "-s",
             "--stop",
@@ -202,8 +231,8 @@ class Compiler:
             "-b",
             "--budget",
             dest="budget",
-            help="set budget for optimized loop unrolling (default: %d)" % \
-            defaults.budget,
+            help="set budget for optimized loop unrolling (default: %d) "
+            "or 'auto' for choosing per loop" % defaults.budget,
         )
         parser.add_option(
             "-X",
@@ -269,6 +298,83 @@ class Compiler:
             dest="papers",
             help="output recommended reading",
         )
+        parser.add_option(
+            "--jobs",
+            dest="jobs",
+            default=defaults.jobs,
+            help="number of processes for merging and encoding "
+            "large tapes (default: 1)",
+        )
+        parser.add_option(
+            "--cache",
+            action="store_true",
+            dest="cache",
+            default=defaults.cache,
+            help="reuse output of previous compilation with the same source, "
+            "compiler, options, and arguments (stored in Programs/Cache)",
+        )
+        parser.add_option(
+            "--stream",
+            action="store_true",
+            dest="stream",
+            default=defaults.stream,
+            help="optimize and write finished blocks while compiling "
+            "to save memory (requires -u)",
+        )
+        parser.add_option(
+            "--merge-window",
+            dest="merge_window",
+            default=defaults.merge_window,
+            help="merge instructions only within windows of this many "
+            "instructions in larger blocks (faster compilation, more rounds)",
+        )
+        parser.add_option(
+            "--register-allocation",
+            dest="register_allocation",
+            type="choice",
+            choices=["size", "interval"],
+            default=defaults.register_allocation,
+            help="reuse freed registers only for vectors of the same size "
+            "(size, default) or for any size (interval)",
+        )
+        parser.add_option(
+            "--cisc-cache",
+            dest="cisc_cache",
+            default=defaults.cisc_cache,
+            help="store optimized CISC templates in Programs/Cache/CISC "
+            "for later compilations, limited to this many MB",
+        )
+        parser.add_option(
+            "--constant-propagation",
+            action="store_true",
+            dest="constant_propagation",
+            default=defaults.constant_propagation,
+            help="propagate and fold constants in clear registers "
+            "(experimental)",
+        )
+        parser.add_option(
+            "--cse",
+            action="store_true",
+            dest="cse",
+            default=defaults.cse,
+            help="replace repeated computations with the same inputs "
+            "by moves (saves communication and preprocessing)",
+        )
+        parser.add_option(
+            "--licm",
+            action="store_true",
+            dest="licm",
+            default=defaults.licm,
+            help="move loop-invariant computation out of run-time loops",
+        )
+        parser.add_option(
+            "--machine",
+            dest="machine",
+            default=defaults.machine,
+            help="machine profile for n_threads='auto' as number of cores "
+            "and optionally memory in GB, e.g., 16,64 (default: this "
+            "machine)",
+        )
         if self.execute:
             parser.add_option(
                 "-E",
@@ -306,6 +412,10 @@ class Compiler:
         self.options, self.args = self.parser.parse_args(self.custom_args)
         if self.options.verbose:
             self.runtime_args += ["--verbose"]
+        if self.options.stream and not self.options.noreallocate:
+            raise CompilerError("--stream requires -u/--noreallocate")
+        if self.options.stream and self.options.asmoutfile:
+            raise CompilerError("--stream not compatible with -a/--asm-output")
         if self.execute:
             if not self.options.execute:
                 if len(self.args) > 1:
@@ -465,64 +575,28 @@ class Compiler:
         self.prog.sint = self.sint
         self.prog.sfix = self.sfix
 
+        cache = None
+        if self.options.cache and self.options.asmoutfile:
+            print("Not using cache because of assembly output")
+        elif self.options.cache:
+            from .cache import CompilationCache
+            cache = CompilationCache(self.prog, self.options, self.prog.infile)
+            if cache.restore():
+                return self.prog
+
         with open(self.prog.infile, "r") as f:
-            changed = False
-            if self.options.flow_optimization:
-                output = []
-                if_stack = []
-                for line in f:
-                    if if_stack and not re.match(if_stack[-1][0], line):
-                        if_stack.pop()
-                    m = re.match(
-                        r"(\s*)for +([a-zA-Z_]+) +in " r"+range\(([0-9a-zA-Z_.]+)\):",
-                        line,
-                    )
-                    if m:
-                        output.append(
-                            "%s@for_range_opt(%s)\n" % (m.group(1), m.group(3))
-                        )
-                        output.append("%sdef _(%s):\n" % (m.group(1), m.group(2)))
-                        changed = True
-                        continue
-                    m = re.match(r"(\s*)if(\W.*):", line)
-                    if m:
-                        while if_stack and if_stack[-1][0] == m.group(1):
-                            if_stack.pop()
-                        if_stack.append((m.group(1), len(output)))
-                        output.append("%s@if_(%s)\n" % (m.group(1), m.group(2)))
-                        output.append("%sdef _():\n" % (m.group(1)))
-                        changed = True
-                        continue
-                    m = re.match(r"(\s*)elif\s+", line)
-                    if m:
-                        raise CompilerError("elif not supported")
-                    if if_stack:
-                        m = re.match("%selse:" % if_stack[-1][0], line)
-                        if m:
-                            start = if_stack[-1][1]
-                            ws = if_stack[-1][0]
-                            output[start] = re.sub(
-                                r"^%s@if_\(" % ws, r"%s@if_e(" % ws, output[start]
-                            )
-                            output.append("%s@else_\n" % ws)
-                            output.append("%sdef _():\n" % ws)
-                            continue
-                    output.append(line)
-                if changed:
-                    infile = tempfile.NamedTemporaryFile("w+", delete=False)
-                    for line in output:
-                        infile.write(line)
-                    infile.seek(0)
-                else:
-                    infile = open(self.prog.infile)
-            else:
-                infile = open(self.prog.infile)
+            code = f.read()
+        if self.options.flow_optimization:
+            from . import flow
+            code = flow.optimize(code, self.prog.infile) or code
+            self.VARS[flow.NAME] = flow
 
         # make compiler modules directly accessible
         sys.path.insert(0, "%s/Compiler" % self.root)
         # create the tapes
         try:
-            exec(compile(infile.read(), infile.name, "exec"), self.VARS)
+            with self.source_phase():
+                exec(compile(code, self.prog.infile, "exec"), self.VARS)
         except UnboundLocalError:
             raise CompilerError(
                 "The above error might mean that you attempted to assign "
@@ -539,10 +613,10 @@ class Compiler:
             else:
                 raise
 
-        if changed and not self.options.debug:
-            os.unlink(infile.name)
-
-        return self.finalize_compile()
+        self.finalize_compile()
+        if cache:
+            cache.store()
+        return self.prog
 
     def register_function(self, name=None):
         """
@@ -571,9 +645,18 @@ class Compiler:
         print(
             "Compiling: {} from {}".format(self.compile_name, self.compile_func.__name__)
         )
-        self.compile_function()
+        with self.source_phase():
+            self.compile_function()
         self.finalize_compile()
 
+    @contextlib.contextmanager
+    def source_phase(self):
+        from .instructions_base import Instruction
+        n_instructions = Instruction.count
+        with self.prog.phase("source") as phase:
+            yield
+            phase.n_instructions = Instruction.count - n_instructions
+
     def finalize_compile(self):
         self.prog.finalize()
 
@@ -0,0 +1,342 @@
+"""
+Control-flow optimization (``-l``/``--flow-optimization``).
+
+:py:class:`FlowOptimizer` rewrites the syntax tree of a high-level
+program such that Python control flow is executed at run time:
+
+- ``for <name> in range(...)`` becomes
+  :py:func:`~Compiler.library.for_range_opt`, or
+  :py:func:`~Compiler.library.for_range` via :py:func:`for_range` if
+  the loop body contains ``break`` or ``continue``.
+- ``while <condition>`` becomes :py:func:`while_`, which uses
+  :py:func:`~Compiler.library.do_while` if the condition is not known
+  at compile time. Loops with a constant condition or a body assigning
+  to variables used outside of it stay Python loops.
+- ``if``/``elif``/``else`` become :py:func:`~Compiler.library.if_`,
+  :py:func:`~Compiler.library.if_e`, and
+  :py:func:`~Compiler.library.else_`.
+
+Bodies are moved into functions, so assignments to variables from
+outside only have an effect for container types and registers updated
+with ``update()``. Statements containing ``return``, ``yield``,
+``global``, ``nonlocal``, or jumps out of loops that are kept in
+Python are left unchanged, as are loops with ``else`` clauses and
+statements in class bodies.
+"""
+
+import ast
+
+from Compiler import library
+from Compiler.exceptions import CompilerError
+
+# name under which the module is available in the transformed program
+NAME = '_flow'
+
+
+class FlowOptimizer(ast.NodeTransformer):
+    """ Syntax tree transformer for control flow. """
+
+    escapes = (ast.Return, ast.Yield, ast.YieldFrom, ast.Await,
+               ast.Global, ast.Nonlocal)
+    scopes = (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda,
+              ast.ClassDef)
+
+    def __init__(self):
+        # whether enclosing loops are transformed
+        self.loops = []
+        self.class_body = False
+        self.changed = False
+        # names used outside of while loop bodies before transformation
+        self.outside = {}
+
+    @classmethod
+    def walk(cls, nodes, loops=True, skip=()):
+        """ Iterate over nodes in statements without entering nested
+        scopes, the statements in :py:obj:`skip`, and, unless
+        :py:obj:`loops` is set, nested loops. """
+        stack = list(reversed(nodes))
+        while stack:
+            node = stack.pop()
+            if node in skip:
+                continue
+            yield node
+            if isinstance(node, cls.scopes) or \
+               (not loops and isinstance(node, (ast.For, ast.While))):
+                continue
+            stack.extend(reversed(list(ast.iter_child_nodes(node))))
+
+    @classmethod
+    def escapes_from(cls, nodes):
+        return any(isinstance(node, cls.escapes) for node in cls.walk(nodes))
+
+    @classmethod
+    def jumps(cls, nodes):
+        """ Types of jumps out of the current loop. """
+        return set(type(node) for node in cls.walk(nodes, loops=False)
+                   if isinstance(node, (ast.Break, ast.Continue)))
+
+    @classmethod
+    def assigned(cls, nodes):
+        """ Names assigned to in statements. """
+        return set(node.id for node in cls.walk(nodes)
+                   if isinstance(node, ast.Name) and
+                   isinstance(node.ctx, (ast.Store, ast.Del)))
+
+    def prepare(self, scope):
+        """ Collect the names occurring in a scope outside of every
+        while loop body. """
+        args = set()
+        if isinstance(scope, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            a = scope.args
+            args = set(arg.arg for arg in a.posonlyargs + a.args +
+                       a.kwonlyargs + [a.vararg, a.kwarg] if arg)
+        for node in self.walk(scope.body):
+            if isinstance(node, ast.While):
+                self.outside[node] = args | set(
+                    x.id for x in self.walk(scope.body, skip=node.body)
+                    if isinstance(x, ast.Name))
+
+    @staticmethod
+    def constant(node):
+        return not any(isinstance(x, (ast.Name, ast.Call, ast.Attribute,
+                                      ast.Subscript, ast.NamedExpr))
+                       for x in ast.walk(node))
+
+    @staticmethod
+    def flow(name):
+        return ast.Attribute(value=ast.Name(id=NAME, ctx=ast.Load()),
+                             attr=name, ctx=ast.Load())
+
+    def function(self, node, decorator, body, args=()):
+        self.changed = True
+        arguments = ast.arguments(
+            posonlyargs=[], args=[ast.arg(arg=arg) for arg in args],
+            kwonlyargs=[], kw_defaults=[], defaults=[])
+        res = ast.FunctionDef(name='_', args=arguments, body=body,
+                              decorator_list=[decorator], returns=None,
+                              type_params=[])
+        return ast.copy_location(res, node)
+
+    def jump_keywords(self, body):
+        jumps = self.jumps(body)
+        return [ast.keyword(arg='breaks',
+                            value=ast.Constant(ast.Break in jumps)),
+                ast.keyword(arg='continues',
+                            value=ast.Constant(ast.Continue in jumps))]
+
+    def visit_scope(self, node, class_body=False):
+        loops, self.loops = self.loops, []
+        outer, self.class_body = self.class_body, class_body
+        if not class_body and not isinstance(node, ast.Lambda):
+            self.prepare(node)
+        self.generic_visit(node)
+        self.loops, self.class_body = loops, outer
+        return node
+
+    def visit_FunctionDef(self, node):
+        return self.visit_scope(node)
+
+    visit_AsyncFunctionDef = visit_Lambda = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        return self.visit_scope(node, class_body=True)
+
+    def visit_loop(self, node, transform):
+        self.loops.append(transform)
+        self.generic_visit(node)
+        self.loops.pop()
+        return node
+
+    def visit_For(self, node):
+        it = node.iter
+        if self.class_body or node.orelse or \
+           not isinstance(node.target, ast.Name) or \
+           not isinstance(it, ast.Call) or \
+           not isinstance(it.func, ast.Name) or it.func.id != 'range' or \
+           not 1 <= len(it.args) <= 3 or it.keywords or \
+           any(isinstance(arg, ast.Starred) for arg in it.args) or \
+           self.escapes_from(node.body):
+            return self.visit_loop(node, False)
+        has_jumps = self.jumps(node.body)
+        jumps = self.jump_keywords(node.body)
+        self.visit_loop(node, True)
+        if has_jumps:
+            decorator = ast.Call(func=self.flow('for_range'), args=it.args,
+                                 keywords=jumps)
+        else:
+            decorator = ast.Call(func=ast.Name(id='for_range_opt',
+                                               ctx=ast.Load()),
+                                 args=it.args, keywords=[])
+        return self.function(node, decorator, node.body,
+                             args=[node.target.id])
+
+    def visit_While(self, node):
+        # the body cannot rebind names if moved into a function
+        if self.class_body or node.orelse or self.escapes_from(node.body) \
+           or self.constant(node.test) or \
+           self.assigned(node.body) & self.outside[node]:
+            return self.visit_loop(node, False)
+        jumps = self.jump_keywords(node.body)
+        self.visit_loop(node, True)
+        condition = ast.Lambda(args=ast.arguments(
+            posonlyargs=[], args=[], kwonlyargs=[], kw_defaults=[],
+            defaults=[]), body=node.test)
+        decorator = ast.Call(func=self.flow('while_'), args=[condition],
+                             keywords=jumps)
+        return self.function(node, decorator, node.body)
+
+    def visit_jump(self, node, name):
+        if self.loops and self.loops[-1]:
+            call = ast.Call(func=self.flow(name), args=[], keywords=[])
+            return ast.copy_location(ast.Expr(value=call), node)
+        return node
+
+    def visit_Break(self, node):
+        return self.visit_jump(node, 'break_')
+
+    def visit_Continue(self, node):
+        return self.visit_jump(node, 'continue_')
+
+    def visit_If(self, node):
+        body = node.body + node.orelse
+        if self.class_body or self.escapes_from(body) or \
+           (self.jumps(body) and not (self.loops and self.loops[-1])):
+            self.generic_visit(node)
+            return node
+        self.generic_visit(node)
+        name = 'if_e' if node.orelse else 'if_'
+        decorator = ast.Call(func=ast.Name(id=name, ctx=ast.Load()),
+                             args=[node.test], keywords=[])
+        res = [self.function(node, decorator, node.body)]
+        if node.orelse:
+            res.append(self.function(node.orelse[0],
+                                     ast.Name(id='else_', ctx=ast.Load()),
+                                     node.orelse))
+        return res
+
+
+def optimize(source, filename):
+    """ Transform control flow in source code.
+
+    :returns: syntax tree or :py:obj:`None` if nothing has changed
+    """
+    tree = ast.parse(source, filename)
+    optimizer = FlowOptimizer()
+    optimizer.prepare(tree)
+    tree = optimizer.visit(tree)
+    if optimizer.changed:
+        return ast.fix_missing_locations(tree)
+
+
+class Break(Exception):
+    pass
+
+
+class Continue(Exception):
+    pass
+
+
+class Loop:
+    """ Loop with ``break`` or ``continue`` statements. Loops at run
+    time use :py:func:`~Compiler.library.break_loop`. A loop body
+    containing ``continue`` is run in a single-iteration
+    :py:func:`~Compiler.library.do_while`, and ``break`` then sets a
+    flag to break out of the outer loop as well. Loops at compile time
+    use exceptions. """
+
+    # not a module-level list to avoid locking by library._run_and_link
+    stack = []
+
+    def __init__(self, run_time, breaks=False, continues=False):
+        self.run_time = run_time
+        self.breaks = breaks
+        self.continues = continues
+        self.if_states = len(library.get_tape().if_states)
+
+    def __call__(self, body, *args):
+        Loop.stack.append(self)
+        try:
+            if self.run_time and self.continues:
+                if self.breaks:
+                    self.broken = library.regint(0)
+                @library.do_while
+                def _():
+                    body(*args)
+                    return 0
+                if self.breaks:
+                    library.if_(self.broken)(library.break_loop)
+            else:
+                body(*args)
+        except Continue:
+            pass
+        finally:
+            Loop.stack.pop()
+
+    def jump(self, exception):
+        if self.run_time:
+            if self.continues and exception == Break:
+                self.broken.update(1)
+            library.break_loop()
+        elif not all(isinstance(state, bool) for state in
+                     library.get_tape().if_states[self.if_states:]):
+            raise CompilerError(
+                'cannot leave loop with compile-time condition '
+                'depending on run-time branch')
+        else:
+            raise exception()
+
+
+def compile_time(condition):
+    try:
+        bool(condition)
+        return True
+    except CompilerError:
+        return False
+
+
+def for_range(start, stop=None, step=None, breaks=False, continues=False):
+    """ :py:func:`~Compiler.library.for_range` with ``break`` and
+    ``continue``. """
+    def decorator(body):
+        loop = Loop(True, breaks, continues)
+        library.range_loop(lambda i: loop(body, i), start, stop, step)
+        return body
+    return decorator
+
+
+def while_(condition, breaks=False, continues=False):
+    """ Python ``while`` loop if the condition is known at compile
+    time, :py:func:`~Compiler.library.do_while` otherwise. """
+    def decorator(body):
+        pre_condition = condition()
+        if compile_time(pre_condition):
+            loop = Loop(False, breaks, continues)
+            try:
+                while pre_condition:
+                    loop(body)
+                    pre_condition = condition()
+            except Break:
+                pass
+        else:
+            loop = Loop(True, breaks, continues)
+            def loop_fn():
+                loop(body)
+                return condition()
+            library.if_statement(pre_condition, lambda: library.do_while(
+                loop_fn, g=body.__globals__))
+        return body
+    return decorator
+
+
+def break_():
+    try:
+        Loop.stack[-1].jump(Break)
+    except IndexError:
+        raise CompilerError("'break' outside loop")
+
+
+def continue_():
+    try:
+        Loop.stack[-1].jump(Continue)
+    except IndexError:
+        raise CompilerError("'continue' outside loop")
@@ -1,5 +1,8 @@
+import array
+import bisect
 import heapq
 import collections
+import itertools
 from Compiler.exceptions import *
 
 class GraphError(CompilerError):
@@ -101,11 +104,179 @@ class SparseDiGraph(object):
     def degree(self, i):
         return len(self.succ[i])
 
+    def merge_nodes(self, i, j):
+        """ Merge node j into i, removing node j """
+        if j in self[i]:
+            self.remove_edge(i, j)
+        if i in self[j]:
+            self.remove_edge(j, i)
+        self.add_edges_from(list(zip(itertools.cycle([i]), self[j], [self.weights[(j,k)] for k in self[j]])))
+        self.add_edges_from(list(zip(self.pred[j], itertools.cycle([i]), [self.weights[(k,j)] for k in self.pred[j]])))
+        self.get_attr(i, 'merges').append(j)
+        self.remove_node(j)
+
+
+class CompactDiGraph(object):
+    """ Directed graph in compressed sparse row format for large blocks.
+
+    Edges have to be added while adding the nodes in order, and all
+    edges added together with a node have to point to it. This is how
+    :py:class:`~Compiler.allocator.Merger` creates the dependency
+    graph. The edges are then kept in arrays, and later changes are
+    recorded using deletion marks and small dictionaries for new
+    edges. Iteration over successors follows the same order as
+    :py:class:`SparseDiGraph`, which makes the result of
+    :py:func:`topological_sort` identical. Nodes are removed without
+    clearing their outgoing edges, also like :py:class:`SparseDiGraph`.
+    Edge weights and node attributes are not supported.
+    """
+    def __init__(self, max_nodes):
+        self.n = max_nodes
+        self.pred_start = array.array('Q', [0])
+        self.pred_edges = array.array('I')
+        self.current_pred = set()
+        self.succ_start = None
+        self.removed = bytearray(self.n)
+        # edges added after construction
+        self.extra_succ = {}
+        self.extra_pred = {}
+        self.pred = self.PredView(self)
+
+    class PredView:
+        def __init__(self, graph):
+            self.graph = graph
+
+        def __getitem__(self, i):
+            return self.graph.get_pred(i)
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, i):
+        return i >= 0 and i < self.n
+
+    def __getitem__(self, i):
+        """ Iterate over the successors of node i """
+        self.finalize()
+        succ_edges, deleted = self.succ_edges, self.deleted
+        for k in range(self.succ_start[i], self.succ_start[i + 1]):
+            if not deleted[k]:
+                yield succ_edges[k]
+        if i in self.extra_succ:
+            yield from self.extra_succ[i]
+
+    def add_node(self, i, **attr):
+        if i >= self.n:
+            raise CompilerError('Cannot add node %d to graph of size %d' % (i, self.n))
+        if self.succ_start is not None:
+            raise GraphError('cannot add nodes after construction')
+        while len(self.pred_start) <= i:
+            self.pred_start.append(len(self.pred_edges))
+            self.current_pred.clear()
+
+    def add_edge(self, i, j, weight=1):
+        if self.succ_start is None:
+            if j != len(self.pred_start) - 1:
+                raise GraphError('edges have to point to the last node '
+                                 'during construction')
+            if i not in self.current_pred:
+                self.current_pred.add(i)
+                self.pred_edges.append(i)
+        elif not self.has_edge(i, j):
+            self.extra_succ.setdefault(i, {})[j] = None
+            self.extra_pred.setdefault(j, set()).add(i)
+
+    def finalize(self):
+        """ Create successor arrays from predecessor arrays. """
+        if self.succ_start is not None:
+            return
+        n = self.n
+        pred_start, pred_edges = self.pred_start, self.pred_edges
+        while len(pred_start) <= n:
+            pred_start.append(len(pred_edges))
+        self.current_pred = None
+        succ_count = array.array('I', bytes(4 * n))
+        for i in pred_edges:
+            succ_count[i] += 1
+        succ_start = array.array('Q', [0])
+        total = 0
+        for count in succ_count:
+            total += count
+            succ_start.append(total)
+        pos = array.array('Q', succ_start)
+        succ_edges = array.array('I', bytes(4 * total))
+        for j in range(n):
+            for k in range(pred_start[j], pred_start[j + 1]):
+                i = pred_edges[k]
+                succ_edges[pos[i]] = j
+                pos[i] += 1
+        self.succ_count = succ_count
+        self.succ_start = succ_start
+        self.succ_edges = succ_edges
+        self.deleted = bytearray(total)
+
+    def find(self, i, j):
+        """ Position of edge (i,j) in successor array or None """
+        self.finalize()
+        start, end = self.succ_start[i], self.succ_start[i + 1]
+        k = bisect.bisect_left(self.succ_edges, j, start, end)
+        if k < end and self.succ_edges[k] == j and not self.deleted[k]:
+            return k
+
+    def has_edge(self, i, j):
+        return self.find(i, j) is not None or \
+            j in self.extra_succ.get(i, ())
+
+    def get_pred(self, j):
+        """ List of current predecessors of node j """
+        if self.succ_start is None:
+            return self.pred_edges[self.pred_start[j]:]
+        if self.removed[j]:
+            return []
+        removed = self.removed
+        res = [i for i in
+               self.pred_edges[self.pred_start[j]:self.pred_start[j + 1]]
+               if not removed[i] and self.find(i, j) is not None]
+        for i in self.extra_pred.get(j, ()):
+            if not removed[i] and j in self.extra_succ.get(i, ()):
+                res.append(i)
+        return res
+
+    def remove_edge(self, i, j):
+        k = self.find(i, j)
+        if k is None:
+            del self.extra_succ[i][j]
+        else:
+            self.deleted[k] = 1
+            self.succ_count[i] -= 1
+
+    def remove_node(self, i):
+        """ Remove node i and its incoming edges """
+        for j in self.get_pred(i):
+            self.remove_edge(j, i)
+        self.removed[i] = 1
+
+    def degree(self, i):
+        self.finalize()
+        return self.succ_count[i] + len(self.extra_succ.get(i, ()))
+
+    def merge_nodes(self, i, j):
+        """ Merge node j into i, removing node j """
+        if self.has_edge(i, j):
+            self.remove_edge(i, j)
+        if self.has_edge(j, i):
+            self.remove_edge(j, i)
+        for k in list(self[j]):
+            self.add_edge(i, k)
+        for k in self.get_pred(j):
+            self.add_edge(k, i)
+        self.remove_node(j)
+
 
 def topological_sort(G, nbunch=None, pref=None):
-    seen={}
+    seen=bytearray(len(G))
     order_explored=[] # provide order and 
-    explored={}       # fast search without more general priorityDictionary
+    explored=bytearray(len(G)) # fast search
     
     if pref is None:
         def get_children(node):
@@ -126,22 +297,22 @@ def topological_sort(G, nbunch=None, pref=None):
     if nbunch is None:
         nbunch = reversed(list(range(len(G))))
     for v in nbunch:     # process all vertices in G
-        if v in explored: 
+        if explored[v]:
             continue
         fringe=[v]   # nodes yet to look at
         while fringe:
             w=fringe[-1]  # depth first search
-            if w in explored: # already looked down this branch
+            if explored[w]: # already looked down this branch
                 fringe.pop()
                 continue
             seen[w]=1     # mark as seen
             # Check successors for cycles and for new nodes
             new_nodes=[]
             for n in get_children(w):
-                if n not in explored:
-                    if n in seen: #CYCLE !!
+                if not explored[n]:
+                    if seen[n]: #CYCLE !!
                         raise GraphError("Graph contains a cycle at %d (%s,%s)." % \
-                                                        (n, G[n], G.pred[n]))
+                                                        (n, list(G[n]), G.pred[n]))
                     new_nodes.append(n)
             if new_nodes:   # Add new_nodes to fringe
                 fringe.extend(new_nodes)
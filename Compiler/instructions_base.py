@@ -1,4 +1,5 @@
 import itertools
+import array
 from random import randint
 import time
 import inspect
@@ -484,43 +485,21 @@ def cisc(function, n_outputs=1):
 
         def new_instructions(self, size, regs):
             if self.merge_id() not in self.instructions:
-                from Compiler.program import Tape
-                tape = Tape(self.function.__name__, program)
-                old_tape = program.curr_tape
-                program.curr_tape = tape
-                block = tape.BasicBlock(tape, None, None)
-                tape.active_basicblock = block
-                set_global_vector_size(None)
-                args = []
-                for arg in self.args:
-                    try:
-                        args.append(arg.new_vector(size=None))
-                    except:
-                        args.append(arg)
-                program.options.cisc = False
-                old_security = program._security
-                program.security = self.security
-                self.function(*args, **self.kwargs)
-                program.security = old_security
-                program.options.cisc = True
-                reset_global_vector_size()
-                program.curr_tape = old_tape
-                for x, bl in tape.req_bit_length.items():
-                    old_tape.require_bit_length(
-                        bl - 1, x, tape.bit_length_reason if x == 'p' else '')
-                from Compiler.allocator import Merger
-                merger = Merger(block, program.options,
-                                tuple(program.to_merge))
-                for i in range(n_outputs):
-                    args[i].can_eliminate = False
-                merger.eliminate_dead_code()
-                assert int(program.options.max_parallel_open) == 0, \
-                    'merging restriction not compatible with ' \
-                    'mergeable CISC instructions'
-                n_rounds = merger.longest_paths_merge()
-                filtered = filter(lambda x: x is not None, block.instructions)
-                self.instructions[self.merge_id()] = list(filtered), args, \
-                                                     n_rounds
+                cache = program.template_cache
+                template = None
+                if cache:
+                    template = cache.load(self.merge_id(),
+                                          self.function.__name__)
+                if template:
+                    self.instructions[self.merge_id()] = template
+                elif cache:
+                    with cache.record() as recording:
+                        tape = self.new_template()
+                    cache.store(self.merge_id(),
+                                self.instructions[self.merge_id()], tape,
+                                recording)
+                else:
+                    self.new_template()
             template, args, self.n_rounds = self.instructions[self.merge_id()]
             subs = util.dict_by_id()
             from Compiler import types
@@ -532,6 +511,54 @@ def cisc(function, n_outputs=1):
                 inst.copy(size, subs)
             reset_global_vector_size()
 
+        def new_template(self):
+            """ Compile and optimize instructions for one call.
+
+            :returns: tape used for compilation
+            """
+            from Compiler.program import Tape
+            tape = Tape(self.function.__name__, program)
+            old_tape = program.curr_tape
+            program.curr_tape = tape
+            block = tape.BasicBlock(tape, None, None)
+            tape.active_basicblock = block
+            set_global_vector_size(None)
+            args = []
+            for arg in self.args:
+                try:
+                    args.append(arg.new_vector(size=None))
+                except:
+                    args.append(arg)
+            program.options.cisc = False
+            old_security = program._security
+            program.security = self.security
+            self.function(*args, **self.kwargs)
+            program.security = old_security
+            if program.options.cse:
+                from Compiler.allocator import CommonSubexpressionEliminator
+                CommonSubexpressionEliminator(block, count=False).run()
+            program.options.cisc = True
+            reset_global_vector_size()
+            program.curr_tape = old_tape
+            for x, bl in tape.req_bit_length.items():
+                old_tape.require_bit_length(
+                    bl - 1, x, tape.bit_length_reason if x == 'p' else '')
+            from Compiler.allocator import Merger
+            merger = Merger(block, program.options,
+                            tuple(program.to_merge))
+            for i in range(n_outputs):
+                args[i].can_eliminate = False
+            merger.eliminate_dead_code()
+            assert int(program.options.max_parallel_open) == 0 and \
+                int(program.options.max_round_bytes or 0) == 0, \
+                'merging restriction not compatible with ' \
+                'mergeable CISC instructions'
+            n_rounds = merger.longest_paths_merge()
+            filtered = filter(lambda x: x is not None, block.instructions)
+            self.instructions[self.merge_id()] = list(filtered), args, \
+                                                 n_rounds
+            return tape
+
         class Arg:
             def __init__(self, reg):
                 from Compiler.GC.types import bits
@@ -815,6 +842,8 @@ class RegType(object):
 
 class ArgFormat(object):
     is_reg = False
+    # format character for struct, None if variable length
+    struct_code = None
 
     @classmethod
     def check(cls, arg):
@@ -824,8 +853,27 @@ class ArgFormat(object):
     def encode(cls, arg):
         return NotImplemented
 
+    @classmethod
+    def from_value(cls, value):
+        """ Parsed argument from value unpacked with
+        :py:obj:`struct_code`. """
+        res = cls.__new__(cls)
+        res.i = value
+        return res
+
+    @classmethod
+    def read_from(cls, data, offset):
+        """ Parse argument from buffer.
+
+        :returns: argument and offset after it
+        """
+        code = '>' + cls.struct_code
+        value, = struct.unpack_from(code, data, offset)
+        return cls.from_value(value), offset + struct.calcsize(code)
+
 class RegisterArgFormat(ArgFormat):
     is_reg = True
+    struct_code = 'I'
 
     @classmethod
     def check(cls, arg):
@@ -878,6 +926,7 @@ class AnyRegAF(RegisterArgFormat):
 
 class IntArgFormat(ArgFormat):
     n_bits = 32
+    struct_code = 'i'
 
     @classmethod
     def check(cls, arg):
@@ -900,6 +949,7 @@ class IntArgFormat(ArgFormat):
 
 class LongArgFormat(IntArgFormat):
     n_bits = 64
+    struct_code = 'q'
 
     @classmethod
     def encode(cls, arg):
@@ -930,6 +980,7 @@ class PlayerNoAF(IntArgFormat):
 
 class String(ArgFormat):
     length = 16
+    struct_code = '16s'
 
     @classmethod
     def check(cls, arg):
@@ -948,6 +999,12 @@ class String(ArgFormat):
         tmp = f.read(16)
         self.str = str(tmp[0:tmp.find(b'\0')], 'ascii')
 
+    @classmethod
+    def from_value(cls, value):
+        res = cls.__new__(cls)
+        res.str = str(value.split(b'\0', 1)[0], 'ascii')
+        return res
+
     def __str__(self):
         return self.str
 
@@ -965,6 +1022,13 @@ class VarString(ArgFormat):
         length = IntArgFormat(f).i
         self.str = str(f.read(length), 'ascii')
 
+    @classmethod
+    def read_from(cls, data, offset):
+        length, offset = IntArgFormat.read_from(data, offset)
+        res = cls.__new__(cls)
+        res.str = str(data[offset:offset + length.i], 'ascii')
+        return res, offset + length.i
+
     def __str__(self):
         return self.str
 
@@ -1015,6 +1079,8 @@ class Instruction(object):
             program.curr_block.instructions.append(self)
         if program.DEBUG:
             self.caller = [frame[1:] for frame in inspect.stack()[1:]]
+        elif program.call_sites:
+            self.caller = program.call_sites.capture()
         else:
             self.caller = None
         
@@ -1158,14 +1224,151 @@ class Instruction(object):
     def __repr__(self):
         return self.__class__.__name__ + '(' + self.get_pre_arg() + ','.join(str(a) for a in self.args) + ')'
 
+class InstructionEncoder(object):
+    """ Precompiled encoding of instructions with the same argument
+    formats. Values outside the range of :py:mod:`struct` (such as
+    integers between 2^31 and 2^32) are left to
+    :py:func:`Instruction.get_bytes`. """
+    __slots__ = ['struct', 'regs', 'strings', 'var_args']
+
+    # encoders by class, dictionary by argument formats for variable arguments
+    by_class = {}
+    # longest argument list to cache encoders for
+    max_cached_args = 64
+
+    def __init__(self, formats, var_args):
+        codes = ['>q']
+        if var_args:
+            codes.append('I')
+        self.regs = []
+        self.strings = []
+        for i, f in enumerate(formats):
+            arg_format = ArgFormats[f]
+            codes.append(arg_format.struct_code)
+            if arg_format.is_reg:
+                self.regs.append(i)
+            elif issubclass(arg_format, String):
+                self.strings.append(i)
+        self.struct = struct.Struct(''.join(codes))
+        self.var_args = var_args
+
+    @classmethod
+    def get(cls, instruction):
+        """ Encoder for instruction or None if not applicable. """
+        t = type(instruction)
+        try:
+            res = cls.by_class[t]
+        except KeyError:
+            res = cls.by_class[t] = cls.for_class(t, instruction)
+        if isinstance(res, dict):
+            formats = tuple(f for _, f in zip(instruction.args,
+                                              instruction.arg_format))
+            try:
+                return res[formats]
+            except KeyError:
+                pass
+            if None in (ArgFormats[f].struct_code for f in set(formats)):
+                encoder = None
+            else:
+                encoder = cls(formats, True)
+            if len(formats) <= cls.max_cached_args:
+                res[formats] = encoder
+            return encoder
+        return res
+
+    @classmethod
+    def for_class(cls, t, instruction):
+        if t.get_bytes is not Instruction.get_bytes or \
+           t.get_encoding is not Instruction.get_encoding:
+            return None
+        if instruction.has_var_args():
+            return {}
+        if None in (ArgFormats[f].struct_code for f in t.arg_format):
+            return None
+        return cls(t.arg_format, False)
+
+    def pack_into(self, buffer, offset, instruction):
+        args = instruction.args
+        if self.regs or self.strings:
+            args = list(args)
+            for i in self.regs:
+                args[i] = args[i].i
+            for i in self.strings:
+                args[i] = args[i].encode('ascii')
+        if self.var_args:
+            self.struct.pack_into(buffer, offset, instruction.get_code(),
+                                  len(args), *args)
+        else:
+            self.struct.pack_into(buffer, offset, instruction.get_code(),
+                                  *args)
+
+def encode_instructions(instructions):
+    """ Encode a sequence of instructions into one buffer using
+    :py:class:`InstructionEncoder` where possible. Equivalent to
+    concatenating :py:func:`Instruction.get_bytes`.
+
+    :param instructions: iterable of instructions (None is skipped)
+    :returns: bytearray
+    """
+    by_class = InstructionEncoder.by_class
+    instructions = [inst for inst in instructions if inst is not None]
+    encoders = []
+    size = 0
+    for inst in instructions:
+        encoder = by_class.get(type(inst), by_class)
+        if encoder is by_class or type(encoder) is dict:
+            encoder = InstructionEncoder.get(inst)
+        if encoder is None:
+            encoder = inst.get_bytes()
+            size += len(encoder)
+        else:
+            size += encoder.struct.size
+        encoders.append(encoder)
+    res = bytearray(size)
+    offset = 0
+    for inst, encoder in zip(instructions, encoders):
+        if type(encoder) is InstructionEncoder:
+            n = encoder.struct.size
+            try:
+                encoder.pack_into(res, offset, inst)
+            except (struct.error, AttributeError):
+                encoded = inst.get_bytes()
+                assert len(encoded) == n
+                res[offset:offset + n] = encoded
+        else:
+            n = len(encoder)
+            res[offset:offset + n] = encoder
+        offset += n
+    return res
+
 class ParsedInstruction:
+    """ Instruction read from bytecode. """
     reverse_opcodes = {}
+    # precompiled parsing for instructions with fixed arguments
+    decoders = {}
+    code_struct = struct.Struct('>Q')
+    n_args_struct = struct.Struct('>I')
 
     def __init__(self, f):
-        cls = type(self)
-        from Compiler import instructions
-        from Compiler.GC import instructions as gc_inst
+        """ Parse instruction from file. """
+        data = f.read(8)
+        t = self.set_code(self.code_struct.unpack(data)[0])
+        try:
+            n_args = len(t.arg_format)
+            self.var_args = False
+        except:
+            n_args = struct.unpack('>I', f.read(4))[0]
+            self.var_args = True
+        self.args = []
+        arg_format = self.arg_formats()
+        for i in range(n_args):
+            self.args.append(ArgFormats[next(arg_format)](f))
+
+    @classmethod
+    def get_opcodes(cls):
         if not cls.reverse_opcodes:
+            from Compiler import instructions
+            from Compiler.GC import instructions as gc_inst
             for module in instructions, gc_inst:
                 for x, y in inspect.getmodule(module).__dict__.items():
                     if inspect.isclass(y) and y.__name__[0] != 'v':
@@ -1173,24 +1376,92 @@ class ParsedInstruction:
                             cls.reverse_opcodes[y.code] = y
                         except AttributeError:
                             pass
-        read = lambda: struct.unpack('>I', f.read(4))[0]
-        full_code = struct.unpack('>Q', f.read(8))[0]
-        self.code = full_code % (1 << Instruction.code_length)
-        self.size = full_code >> Instruction.code_length
-        self.type = cls.reverse_opcodes[self.code]
-        t = self.type
-        name = t.__name__
+        return cls.reverse_opcodes
+
+    @classmethod
+    def read_from(cls, data, offset):
+        """ Parse instruction from buffer.
+
+        :returns: instruction and offset after it
+        """
+        self = cls.__new__(cls)
+        t = self.set_code(cls.code_struct.unpack_from(data, offset)[0])
+        offset += 8
+        decoder = cls.decoders.get(t)
+        if decoder is None:
+            decoder = cls.get_decoder(t)
+        if decoder:
+            unpacker, formats = decoder
+            self.var_args = False
+            self.args = [f.from_value(x) for f, x in
+                         zip(formats, unpacker.unpack_from(data, offset))]
+            return self, offset + unpacker.size
         try:
             n_args = len(t.arg_format)
             self.var_args = False
         except:
-            n_args = read()
+            n_args = cls.n_args_struct.unpack_from(data, offset)[0]
+            offset += 4
             self.var_args = True
+        self.args = args = []
+        arg_formats = self.arg_formats()
+        # most arguments are 32-bit, so unpack at once until another one
+        words = array.array('I')
+        words.frombytes(data[offset:offset + 4 * n_args])
+        if sys.byteorder == 'little':
+            words.byteswap()
+        new = object.__new__
+        for word in words:
+            f = ArgFormats[next(arg_formats)]
+            code = f.struct_code
+            if code == 'I':
+                arg = new(f)
+                arg.i = word
+            elif code == 'i':
+                arg = new(f)
+                arg.i = word - (word >> 31 << 32)
+            else:
+                arg, offset = f.read_from(data, offset)
+                args.append(arg)
+                break
+            args.append(arg)
+            offset += 4
+        for i in range(len(args), n_args):
+            arg, offset = ArgFormats[next(arg_formats)].read_from(data, offset)
+            args.append(arg)
+        return self, offset
+
+    @classmethod
+    def get_decoder(cls, t):
+        """ Precompiled parsing for an instruction type if possible.
+
+        :returns: :py:class:`struct.Struct` and argument formats or
+          False
+        """
+        try:
+            len(t.arg_format)
+            formats = [ArgFormats[f] for f in t.arg_format]
+            unpacker = struct.Struct(
+                '>' + ''.join(f.struct_code for f in formats))
+        except TypeError:
+            # no fixed format or variable length
+            formats = None
+        res = cls.decoders[t] = formats is not None and (unpacker, formats)
+        return res
+
+    def set_code(self, full_code):
+        self.code = full_code % (1 << Instruction.code_length)
+        self.size = full_code >> Instruction.code_length
+        self.type = self.get_opcodes()[self.code]
+        return self.type
+
+    def arg_formats(self):
+        t = self.type
         try:
-            arg_format = iter(t.arg_format)
+            return iter(t.arg_format)
         except:
-            if name == 'cisc':
-                arg_format = itertools.chain(['str'], itertools.repeat('int'))
+            if t.__name__ == 'cisc':
+                return itertools.chain(['str'], itertools.repeat('int'))
             else:
                 def arg_iter():
                     i = 0
@@ -1200,10 +1471,7 @@ class ParsedInstruction:
                         except AttributeError:
                             yield None
                         i += 1
-                arg_format = t.dynamic_arg_format(arg_iter())
-        self.args = []
-        for i in range(n_args):
-            self.args.append(ArgFormats[next(arg_format)](f))
+                return t.dynamic_arg_format(arg_iter())
 
     def __str__(self):
         name = self.type.__name__
@@ -1218,6 +1486,93 @@ class ParsedInstruction:
     def get_usage(self):
         return self.type.get_usage(self.args)
 
+class BytecodeReader:
+    """ Memory-mapped bytecode file. Iterating yields
+    :py:class:`ParsedInstruction` objects. Indexing and :py:func:`len`
+    use an index of instruction offsets, which is built on first use.
+
+    :param filename: bytecode file
+    :param index: build the index immediately
+    """
+    def __init__(self, filename, index=False):
+        import mmap
+        self.file = open(filename, 'rb')
+        try:
+            self.mmap = mmap.mmap(self.file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            self.data = memoryview(self.mmap)
+        except ValueError:
+            # empty file
+            self.mmap = None
+            self.data = memoryview(b'')
+        self.offsets = None
+        if index:
+            self.build_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.data.release()
+        if self.mmap is not None:
+            self.mmap.close()
+        self.file.close()
+
+    def __iter__(self):
+        return self.read(0)
+
+    def read(self, offset):
+        """ Iterate over instructions starting at byte offset. """
+        data = self.data
+        end = len(data)
+        read_from = ParsedInstruction.read_from
+        while offset < end:
+            inst, offset = read_from(data, offset)
+            yield inst
+
+    def build_index(self):
+        import array
+        offsets = array.array('Q')
+        offset = 0
+        data = self.data
+        end = len(data)
+        read_from = ParsedInstruction.read_from
+        code_struct = ParsedInstruction.code_struct
+        code_mask = (1 << Instruction.code_length) - 1
+        opcodes = ParsedInstruction.get_opcodes()
+        decoders = ParsedInstruction.decoders
+        while offset < end:
+            offsets.append(offset)
+            # skip instructions with fixed arguments without parsing
+            t = opcodes[code_struct.unpack_from(data, offset)[0] & code_mask]
+            decoder = decoders.get(t)
+            if decoder:
+                offset += 8 + decoder[0].size
+            else:
+                offset = read_from(data, offset)[1]
+        self.offsets = offsets
+
+    def __len__(self):
+        if self.offsets is None:
+            self.build_index()
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if self.offsets is None:
+            self.build_index()
+        return ParsedInstruction.read_from(self.data, self.offsets[i])[0]
+
+    def instructions_from(self, i):
+        """ Iterate over instructions starting at index. """
+        if self.offsets is None:
+            self.build_index()
+        if i >= len(self.offsets):
+            return iter(())
+        return self.read(self.offsets[i])
+
 class VarArgsInstruction(Instruction):
     def has_var_args(self):
         return True
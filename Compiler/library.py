@@ -600,6 +600,8 @@ def method_call_tape(function):
             def f(*args, **kwargs):
                 class Dummy(type(self)):
                     __init__ = lambda self: None
+                # for output using the type name
+                Dummy.__name__ = type(self).__name__
                 dummy = Dummy()
                 members = args[:len(member_key)]
                 real_args = args[len(member_key):]
@@ -1028,7 +1030,9 @@ def for_range_opt(start, stop=None, step=None, budget=None):
       any optimization to take place.
 
     :param budget: number of instructions after which to start optimization
-      (default is 1000 or as given with ``--budget``)
+      (default is 1000 or as given with ``--budget``) or ``'auto'``
+      for choosing the number of iterations to unroll from the cost of
+      the first (see ``--budget``)
 
     Example:
 
@@ -1062,8 +1066,173 @@ def for_range_opt(start, stop=None, step=None, budget=None):
         return for_range_opt_multithread(None, n_loops)
     return map_reduce_single(None, n_loops, budget=budget)
 
+def for_range_pipelined(start, stop=None, step=None, n_stages=2):
+    """ Decorator to execute loop bodies with overlapping
+    communication rounds (software pipelining). The body is split
+    into :py:obj:`n_stages` parts of consecutive rounds, and every
+    iteration of the resulting loop runs the first part of one
+    iteration together with the second part of the previous one and
+    so on. This reduces the number of rounds to about the ones of
+    the longest part per iteration at the cost of :py:obj:`n_stages`
+    copies of the body in the program. Unlike
+    :py:func:`for_range_opt`, there is no unrolling, so the program
+    size does not depend on the number of iterations.
+
+    The loop body must not contain any control flow (including
+    :py:func:`update`) and must not return a value. Information has
+    to be passed out via container types such as
+    :py:class:`~Compiler.types.Array`. Later iterations might access
+    memory before earlier ones are done with it. Therefore, a body
+    writing memory of a type (e.g., :py:class:`sint`) also accessed
+    elsewhere in the body is only pipelined with ``-M``
+    (``--preserve-mem-order``), and more than two stages are
+    only used if such writes happen at most one stage apart from all
+    accesses to memory of the same type.
+
+    :param start/stop/step: regint/cint/int (used as in :py:func:`range`)
+    :param n_stages: maximal number of stages (int, default 2)
+
+    Example:
+
+    .. code::
+
+        @for_range_pipelined(n)
+        def _(i):
+            c[i] = (a[i] * b[i] * b[i]).reveal()
+
+    """
+    def decorator(loop_body):
+        get_tape().unused_decorators.pop(decorator)
+        pipelined_loop(loop_body, start, stop, step, n_stages)
+        return loop_body
+    get_tape().unused_decorators[decorator] = 'for_range_pipelined'
+    return decorator
+
+def pipelined_loop(loop_body, start, stop=None, step=None, n_stages=2):
+    from Compiler.allocator import LoopPipeliner
+    start, stop, step = _range_prep(start, stop, step)
+    range_ = stop - start
+    n_loops = ((range_ % step) != 0) + range_ // step
+    block = get_block()
+    index = regint()
+    n_instructions = len(block.instructions)
+    if loop_body(index) is not None:
+        raise CompilerError('pipelined loop bodies cannot return values')
+    if block is not get_block():
+        raise CompilerError('pipelined loop bodies cannot contain '
+                            'control flow, use for_range instead')
+    body = block.instructions[n_instructions:]
+    del block.instructions[n_instructions:]
+    pipeliner = LoopPipeliner(block, body, index, n_stages)
+    n_stages = pipeliner.n_stages
+    if get_program().verbose:
+        print('Pipelining loop body with %d rounds in %d stages%s%s' % (
+            pipeliner.n_rounds, n_stages, ' (not possible with %s)' %
+            pipeliner.reason if pipeliner.reason else '',
+            ' (limited because of %s)' % pipeliner.limitation
+            if pipeliner.limitation else ''))
+    def plain_loop():
+        range_loop(pipeliner.iteration, start, stop, step)
+    if n_stages == 1 or (util.is_constant(n_loops) and n_loops < n_stages):
+        plain_loop()
+        return
+    def step_index(j, stages):
+        return {s: regint.conv(start + (j - s) * step) for s in stages}
+    def pipelined():
+        for j in range(n_stages - 1):
+            break_point('pipeline-prologue')
+            pipeliner.step(j, step_index(j, range(j + 1)))
+        range_loop(lambda j: pipeliner.step(
+            None, step_index(j, range(n_stages))), n_stages - 1, n_loops)
+        for j in range(1, n_stages):
+            break_point('pipeline-epilogue')
+            pipeliner.step(None, step_index(n_loops - 1 + j,
+                                            range(j, n_stages)))
+        break_point('pipeline-end')
+    if util.is_constant(n_loops):
+        pipelined()
+    else:
+        if_then(n_loops >= n_stages)
+        pipelined()
+        else_then()
+        plain_loop()
+        end_if()
+
+def _source_line():
+    frame = inspect.currentframe()
+    while frame and frame.f_code.co_filename != get_program().infile:
+        frame = frame.f_back
+    return frame.f_lineno if frame else '?'
+
+def _unroll_factor(instructions, duration, n_loops):
+    """ Unrolling factor for :py:func:`for_range_opt` with automatic
+    budget (``--budget auto``) based on a probe iteration. Unrolling
+    reduces the number of rounds per iteration, which pays off until
+    the latency of the remaining rounds is small compared to the time
+    for sending the communication of an iteration (using the cost
+    model of the protocol given with ``-E``). Without rounds or
+    communication, for example without ``-E``, the usual budget
+    applies. The factor is limited by the number of
+    instructions and the compile time per loop.
+
+    :param instructions: instructions of the probe iteration
+    :param duration: compile time of the probe iteration in seconds
+    :param n_loops: number of iterations (int/regint)
+    """
+    from Compiler.allocator import Merger
+    program = get_program()
+    probe = copy.copy(get_block())
+    probe.instructions = list(instructions)
+    n_rounds = max(Merger(probe, program.options,
+                          tuple(program.to_merge)).real_depths + [0])
+    req_node = Tape.ReqNode('probe')
+    req_node.num = Tape.ReqNum()
+    for inst in instructions:
+        inst.add_usage(req_node)
+    comm = program.expected_communication(req_node.num).online
+    size = max(1, len(instructions))
+    max_size = _auto_budget['instructions']
+    if not util.is_constant(n_loops):
+        # remainder is unrolled as well
+        max_size //= 2
+    limit = min(max_size // size,
+                int(_auto_budget['compile time'] / max(duration, 1e-6)))
+    if util.is_constant(n_loops):
+        limit = min(limit, n_loops)
+    if n_rounds and comm:
+        factor = math.ceil(_auto_budget['latency ratio'] * n_rounds *
+                           _auto_budget['round latency'] *
+                           _auto_budget['bandwidth'] / comm)
+    else:
+        factor = program.budget // size
+    factor = max(1, min(factor, limit))
+    if program.options.execute:
+        comm_str = '%d bytes' % comm
+    else:
+        comm_str = 'unknown communication without -E'
+    print('Unrolling loop in line %s %d times (%d instructions, %d rounds, '
+          '%s, %.3f seconds per iteration)' % (
+              _source_line(), factor, size, n_rounds, comm_str, duration))
+    return factor
+
+# assumptions and limits for automatic loop unrolling
+_auto_budget = {
+    'instructions': 100000,
+    'compile time': 10,
+    'round latency': 0.05,
+    'bandwidth': 10 ** 8,
+    # maximal ratio of round latency to transmission time
+    'latency ratio': 0.1,
+}
+
 def map_reduce_single(n_parallel, n_loops, initializer=lambda *x: [],
                       reducer=lambda *x: [], mem_state=None, budget=None):
+    # not at module level to avoid shadowing the instruction
+    import time
+    auto_budget = budget == 'auto' or \
+        (budget is None and get_program().auto_budget)
+    if auto_budget:
+        budget = None
     budget = budget or get_program().budget
     if not (isinstance(n_parallel, int) or n_parallel is None):
         raise CompilerError('Number of parallel executions must be constant')
@@ -1125,11 +1294,19 @@ def map_reduce_single(n_parallel, n_loops, initializer=lambda *x: [],
                 block = get_block()
                 assert not isinstance(n_loops, int) or n_loops > 0
                 pre = copy.copy(loop_body.__globals__)
+                factor = None
                 while (not util.is_constant(n_loops) or k < n_loops) \
-                      and (len(get_block()) < budget or k == 0) \
+                      and (len(get_block()) < budget or k == 0
+                           if factor is None else k < factor) \
                       and block is get_block():
                     j = i + k
+                    n_instructions = len(block)
+                    start = time.time()
                     state = reducer(tuplify(loop_body(j)), state)
+                    if auto_budget and k == 0 and block is get_block():
+                        factor = _unroll_factor(
+                            block.instructions[n_instructions:],
+                            time.time() - start, n_loops)
                     k += 1
                 RegintOptimizer().run(block.instructions, get_program())
                 _link(pre, loop_body.__globals__)
@@ -1209,7 +1386,9 @@ def for_range_multithread(n_threads, n_parallel, n_loops, thread_mem_req={},
     Execute :py:obj:`n_loops` loop bodies in up to :py:obj:`n_threads`
     threads, up to :py:obj:`n_parallel` in parallel per thread.
 
-    :param n_threads/n_parallel: compile-time (int)
+    :param n_threads: compile-time (int) or ``'auto'`` (see
+      :py:func:`for_range_opt_multithread`)
+    :param n_parallel: compile-time (int)
     :param n_loops: regint/cint/int
 
     """
@@ -1225,7 +1404,12 @@ def for_range_opt_multithread(n_threads, n_loops, budget=None):
     rudimentary for runtime :py:obj:`n_loops` (regint/cint). Consider
     using :py:func:`for_range_multithread` in this case.
 
-    :param n_threads: compile-time (int)
+    :param n_threads: compile-time (int) or ``'auto'``. The latter
+      compiles for one thread per core of the machine given with
+      ``--machine`` (default: the compiling machine) and runs at most
+      as many threads in parallel as fit into its memory according
+      to the register usage and size of the thread's tape. The
+      choice is recorded in the schedule file.
     :param n_loops: regint/cint/int
 
     The following will execute loop bodies 0-9 in one thread, 10-19 in
@@ -1264,7 +1448,8 @@ def multithread(n_threads, n_items=None, max_size=None):
     :py:obj:`n_threads` threads, but leave the in-thread repetition up
     to the user.
 
-    :param n_threads: compile-time (int)
+    :param n_threads: compile-time (int) or ``'auto'`` (see
+      :py:func:`for_range_opt_multithread`)
     :param n_items: regint/cint/int (default: :py:obj:`n_threads`)
     :param max_size: maximum size to be processed at once (default: no limit)
 
@@ -1278,7 +1463,10 @@ def multithread(n_threads, n_items=None, max_size=None):
             ...
     """
     if n_items is None:
-        n_items = n_threads
+        if n_threads == 'auto':
+            n_items = get_program().auto_threads()
+        else:
+            n_items = n_threads
     if max_size is None or n_items <= max_size:
         return map_reduce(n_threads, None, n_items, initializer=lambda: [],
                           reducer=None, looping=False)
@@ -1298,6 +1486,7 @@ def multithread(n_threads, n_items=None, max_size=None):
 def map_reduce(n_threads, n_parallel, n_loops, initializer, reducer, \
                    thread_mem_req={}, looping=True, budget=None):
     assert(n_threads != 0)
+    auto_threads = n_threads == 'auto'
     if isinstance(n_loops, (list, tuple)):
         split = n_loops
         n_loops = reduce(operator.mul, n_loops)
@@ -1312,6 +1501,8 @@ def map_reduce(n_threads, n_parallel, n_loops, initializer, reducer, \
         new_dec = map_reduce(n_threads, n_parallel, n_loops, initializer, reducer, thread_mem_req)
         return lambda loop_body: new_dec(decorator(loop_body))
     n_loops = MemValue.if_necessary(n_loops)
+    if auto_threads:
+        n_threads = get_program().auto_threads(n_loops)
     if n_threads == None or util.is_one(n_loops):
         if not looping:
             return lambda loop_body: loop_body(0, n_loops)
@@ -1385,9 +1576,15 @@ def map_reduce(n_threads, n_parallel, n_loops, initializer, reducer, \
                 thread_args.append((tape1, i))
         prog.n_running_threads = None
         prog.prevent_breaks = False
-        threads = prog.run_tapes(thread_args)
-        for thread in threads:
-            prog.join_tape(thread)
+        if auto_threads and thread_args:
+            n_concurrent = prog.concurrent_threads(
+                [arg[0] for arg in thread_args], len(thread_args))
+        else:
+            n_concurrent = max(1, len(thread_args))
+        for i in range(0, max(1, len(thread_args)), n_concurrent):
+            threads = prog.run_tapes(thread_args[i:i + n_concurrent])
+            for thread in threads:
+                prog.join_tape(thread)
         prog.free_later()
         prog.prevent_breaks = prevent_breaks
         if len(state):
@@ -1425,7 +1622,8 @@ def map_sum_opt(n_threads, n_loops, types):
 
         result = summer()
 
-    :param n_threads: number of threads (int)
+    :param n_threads: number of threads (int or ``'auto'``, see
+      :py:func:`for_range_opt_multithread`)
     :param n_loops: number of loop runs (regint/cint/int)
     :param types: return type, must match the return statement
         in the loop
@@ -1443,7 +1641,8 @@ def map_sum_simple(n_threads, n_loops, type, size):
 
         result = summer()
 
-    :param n_threads: number of threads (int)
+    :param n_threads: number of threads (int or ``'auto'``, see
+      :py:func:`for_range_opt_multithread`)
     :param n_loops: number of loop runs (regint/cint/int)
     :param type: return type, must match the return statement
         in the loop
@@ -1472,7 +1671,8 @@ def tree_reduce_multithread(n_threads, function, vector):
 
       tree_reduce_multithread(10, lambda x, y: x.max(y), a)
 
-    :param n_threads: number of threads (int)
+    :param n_threads: number of threads (int or ``'auto'``, see
+      :py:func:`for_range_opt_multithread`)
     :param function: reduction function taking exactly two arguments
     :param vector: register vector or array
 
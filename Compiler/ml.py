@@ -61,10 +61,11 @@ an example of how to run MP-SPDZ on TensorFlow graphs.
 import math
 import re
 
-from Compiler import mpc_math, util
+from Compiler import mpc_math, util, cost
 from Compiler.types import *
 from Compiler.types import _unreduced_squant, _single
 from Compiler.library import *
+from Compiler.library import _auto_budget
 from Compiler.util import is_zero, tree_reduce
 from Compiler.comparison import CarryOutRawLE
 from Compiler.GC.types import sbitint
@@ -194,9 +195,30 @@ def progress(x):
         time()
 
 def set_n_threads(n_threads):
+    """ Set the number of threads for layers and optimizers.
+
+    :param n_threads: int or ``'auto'`` for one per core of the
+      machine profile (see
+      :py:func:`~Compiler.library.for_range_opt_multithread`)
+    """
+    if n_threads == 'auto':
+        n_threads = get_program().auto_threads()
     Layer.n_threads = n_threads
     Optimizer.n_threads = n_threads
 
+def set_inference(inference=True):
+    """ Create layers for inference only. Layers created afterwards
+    do not allocate gradients or values only stored for
+    back-propagation, and they cannot be trained. This is the default
+    for Keras models that are built without compiling. Furthermore,
+    :py:func:`Optimizer.forward` frees the output of a layer once all
+    layers using it have been computed, so later layers can reuse the
+    memory.
+
+    :param inference: boolean
+    """
+    Layer.inference = inference
+
 def _no_mem_warnings(function):
     def wrapper(*args, **kwargs):
         get_program().warn_about_mem.append(False)
@@ -252,12 +274,19 @@ class Tensor(MultiArray):
 class Layer:
     n_threads = 1
     inputs = []
+    inference = False
     input_bias = True
     thetas = lambda self: ()
     debug_output = False
     back_batch_size = 128
     print_random_update = False
 
+    def __new__(cls, *args, **kwargs):
+        # keep mode at creation, see set_inference()
+        res = super(Layer, cls).__new__(cls)
+        res.inference = Layer.inference
+        return res
+
     @property
     def shape(self):
         return list(self._Y.sizes)
@@ -324,7 +353,7 @@ class Output(OutputBase):
         self.N = N
         self.X = sfix.Array(N)
         self.Y = sfix.Array(N)
-        self.nabla_X = sfix.Array(N)
+        self.nabla_X = None if self.inference else sfix.Array(N)
         self.l = MemValue(sfix(-1))
         self.e_x = sfix.Array(N)
         self.debug = debug
@@ -433,7 +462,7 @@ class LinearOutput(OutputBase):
             shape = N, n_targets
         self.X = sfix.Tensor(shape)
         self.Y = sfix.Tensor(shape)
-        self.nabla_X = sfix.Tensor(shape)
+        self.nabla_X = None if self.inference else sfix.Tensor(shape)
         self.l = MemValue(sfix(0))
         self.d_out = n_targets
 
@@ -468,7 +497,7 @@ class MultiOutputBase(NoVariableLayer):
     def __init__(self, N, d_out, approx=False, debug=False):
         self.X = sfix.Matrix(N, d_out)
         self.Y = sint.Matrix(N, d_out)
-        self.nabla_X = sfix.Matrix(N, d_out)
+        self.nabla_X = None if self.inference else sfix.Matrix(N, d_out)
         self.l = MemValue(sfix(-1))
         self.losses = sfix.Array(N)
         self.approx = None
@@ -828,6 +857,8 @@ class Dense(DenseBase):
     :param d_out: output dimension
     :param d: (optional) extra dimension
     """
+    fused_relu = False
+
     def __init__(self, N, d_in, d_out, d=1, activation='id', debug=False):
         if activation == 'id':
             self.activation_layer = None
@@ -849,21 +880,24 @@ class Dense(DenseBase):
         self.W = Tensor([d_in, d_out], sfix)
         self.b = sfix.Array(d_out)
 
-        back_N = min(N, self.back_batch_size)
-        self.nabla_Y = Tensor([back_N, d, d_out], sfix)
-        self.nabla_X = Tensor([back_N, d, d_in], sfix)
-        self.nabla_W = Tensor([d_in, d_out], sfix)
-        self.nabla_b = sfix.Array(d_out)
+        if self.inference:
+            self.nabla_Y = self.nabla_X = self.nabla_W = self.nabla_b = None
+        else:
+            back_N = min(N, self.back_batch_size)
+            self.nabla_Y = Tensor([back_N, d, d_out], sfix)
+            self.nabla_X = Tensor([back_N, d, d_in], sfix)
+            self.nabla_W = Tensor([d_in, d_out], sfix)
+            self.nabla_b = sfix.Array(d_out)
 
         self.debug = debug
 
         l = self.activation_layer
         if l:
-            self.f_input = l.X
-            l.Y = self.Y
+            self.f_input = l._X
+            l.Y = self._Y
             l.nabla_Y = self.nabla_Y
         else:
-            self.f_input = self.Y
+            self.f_input = self._Y
 
     def __repr__(self):
         return '%s(%s, %s, %s, %s, activation=%s)' % \
@@ -883,9 +917,25 @@ class Dense(DenseBase):
         if self.input_bias:
             self.b.input_from(player, **kwargs)
 
+    def fold_batch_norm(self, layer):
+        """ Fold batch normalization with running statistics into
+        weights and bias.
+
+        :param layer: :py:class:`BatchNorm` following this layer """
+        factor = layer._factor(layer.var_hat)
+        @for_range_opt_multithread(self.n_threads, self.d_in)
+        def _(i):
+            self.W[i][:] = self.W[i][:] * factor[:]
+        if self.input_bias:
+            bias = self.b[:] - layer.mu_hat[:]
+        else:
+            bias = -layer.mu_hat[:]
+            self.input_bias = True
+        self.b[:] = bias * factor[:] + layer.bias[:]
+
     def compute_f_input(self, batch):
         N = len(batch)
-        if self.input_bias:
+        if self.input_bias and not self.fused_relu:
             prod = MultiArray([N, self.d, self.d_out], sfix)
         else:
             prod = self.f_input
@@ -907,12 +957,17 @@ class Dense(DenseBase):
 
         @multithread(self.n_threads, N * self.d, max_size)
         def _(base, size):
-            result_matrix.assign_part_vector(
-                X_sub.direct_mul(self.W, indices=(
-                    batch_d_indices.get_vector(base, size), regint.inc(self.d_in),
-                    regint.inc(self.d_in), regint.inc(self.d_out))), base)
-
-        if self.input_bias:
+            res = X_sub.direct_mul(self.W, indices=(
+                batch_d_indices.get_vector(base, size), regint.inc(self.d_in),
+                regint.inc(self.d_in), regint.inc(self.d_out)))
+            if self.fused_relu:
+                if self.input_bias:
+                    res += self.b.get(regint.inc(size * self.d_out, 0, 1, 1,
+                                                 self.d_out))
+                res = relu(res)
+            result_matrix.assign_part_vector(res, base)
+
+        if self.input_bias and not self.fused_relu:
             if self.d_out == 1:
                 @multithread(self.n_threads, N)
                 def _(base, size):
@@ -926,6 +981,10 @@ class Dense(DenseBase):
 
         progress('f input')
 
+    def forward(self, batch=None, training=None):
+        self.f_input.alloc()
+        super(Dense, self).forward(batch=batch, training=training)
+
     def _forward(self, batch=None):
         if not issubclass(self.W.value_type, _single) \
            or not issubclass(self.X.value_type, _single):
@@ -937,7 +996,8 @@ class Dense(DenseBase):
             batch.assign(regint.inc(self.N))
         self.compute_f_input(batch=batch)
         if self.activation_layer:
-            self.activation_layer.forward(batch, training=True)
+            self.activation_layer.forward(batch,
+                                          training=not self.inference)
         if self.debug_output:
             print_ln('dense X %s', self.X.reveal_nested())
             print_ln('dense W %s', self.W.reveal_nested())
@@ -1013,14 +1073,18 @@ class QuantizedDense(DenseBase):
         self.H = math.sqrt(1.5 / (d_in + d_out))
 
         self.W = sfix.Matrix(d_in, d_out)
-        self.nabla_W = self.W.same_shape()
         self.T = sint.Matrix(d_in, d_out)
         self.b = sfix.Array(d_out)
-        self.nabla_b = self.b.same_shape()
 
         self.X = Tensor([N, 1, d_in], sfix)
         self.Y = Tensor([N, 1, d_out], sfix)
-        self.nabla_Y = self.Y.same_shape()
+
+        if self.inference:
+            self.nabla_W = self.nabla_b = self.nabla_Y = None
+        else:
+            self.nabla_W = self.W.same_shape()
+            self.nabla_b = self.b.same_shape()
+            self.nabla_Y = self.Y.same_shape()
 
     def reset(self):
         @for_range(self.d_in)
@@ -1073,7 +1137,7 @@ class Dropout(NoVariableLayer):
         self.nabla_Y = Tensor(shape, sfix)
         self.nabla_X = Tensor(shape, sfix)
         self.alpha = alpha
-        self.B = MultiArray(shape, sint)
+        self.B = None if self.inference else MultiArray(shape, sint)
 
     def __repr__(self):
         return '%s(%s, alpha=%s)' % \
@@ -1207,13 +1271,14 @@ class Gelu(ElementWiseLayer):
     def __init__(self, shape, inputs=None, approx=True):
         super(Gelu, self).__init__(shape)
         self.approx = approx
-        self.z0s = MultiArray(shape, sint)
-        self.z1s = MultiArray(shape, sint)
-        self.z2s = MultiArray(shape, sint)
+        if not self.inference:
+            self.z0s = MultiArray(shape, sint)
+            self.z1s = MultiArray(shape, sint)
+            self.z2s = MultiArray(shape, sint)
 
-        self.x2s = MultiArray(shape, sfix)
-        self.x3s = MultiArray(shape, sfix)
-        self.x4s = MultiArray(shape, sfix)
+            self.x2s = MultiArray(shape, sfix)
+            self.x3s = MultiArray(shape, sfix)
+            self.x4s = MultiArray(shape, sfix)
 
         self.poly_f_0_0 = -0.5054031199708174
         self.poly_f_0_1 = -0.42226581151983866
@@ -1253,13 +1318,14 @@ class Gelu(ElementWiseLayer):
         f_0 = self.poly_f_0_0 + self.poly_f_0_1 * x1 + self.poly_f_0_2 * x2 + self.poly_f_0_3 * x3
         f_1 = self.poly_f_1_0 + self.poly_f_1_1 * x1 + self.poly_f_1_2 * x2 + self.poly_f_1_4 * x4 + self.poly_f_1_6 * x6
 
-        self.z0s.assign_vector(z0, base)
-        self.z1s.assign_vector(z1, base)
-        self.z2s.assign_vector(z2, base)
+        if not self.inference:
+            self.z0s.assign_vector(z0, base)
+            self.z1s.assign_vector(z1, base)
+            self.z2s.assign_vector(z2, base)
 
-        self.x2s.assign_vector(x2, base)
-        self.x3s.assign_vector(x3, base)
-        self.x4s.assign_vector(x6, base)
+            self.x2s.assign_vector(x2, base)
+            self.x3s.assign_vector(x3, base)
+            self.x4s.assign_vector(x6, base)
 
         return (z0 * f_0) + (z1 * f_1) + (z2 * x)
 
@@ -1323,12 +1389,14 @@ class Tanh(ElementWiseLayer):
 
     def __init__(self, shape, inputs=None):
         super(Tanh, self).__init__(shape)
-        self.tanh_computations = MultiArray(shape, sfix)
+        if not self.inference:
+            self.tanh_computations = MultiArray(shape, sfix)
 
     def f_part(self, base, size):
         x = self.X.get_vector(base, size)
         res = self.tanh(x)
-        self.tanh_computations.assign_vector(res, base)
+        if not self.inference:
+            self.tanh_computations.assign_vector(res, base)
         return res
 
     def tanh(self, x):
@@ -1386,7 +1454,9 @@ class PoolBase(NoVariableLayer):
     def traverse(self, batch, process):
         need_padding = [self.strides[i] * (self.Y.sizes[i] - 1) + self.ksize[i] >
                         self.X.sizes[i] for i in range(4)]
-        if not program.options.budget:
+        if program.auto_budget:
+            budget = None
+        elif not program.options.budget:
             budget = max(10000, program.budget)
         else:
             budget = program.budget
@@ -1611,8 +1681,13 @@ class BatchNorm(Layer):
         self.X, self.nabla_X, self.nabla_Y = tensors
         arrays = (sfix.Array(shape[2]) for i in range(4))
         self.var, self.mu, self.weights, self.bias = arrays
-        arrays = (sfix.Array(shape[2]) for i in range(4))
-        self.mu_hat, self.var_hat, self.nabla_weights, self.nabla_bias = arrays
+        arrays = (sfix.Array(shape[2]) for i in range(2))
+        self.mu_hat, self.var_hat = arrays
+        if self.inference:
+            self.nabla_weights = self.nabla_bias = None
+        else:
+            arrays = (sfix.Array(shape[2]) for i in range(2))
+            self.nabla_weights, self.nabla_bias = arrays
         self.epsilon = 2 ** (-sfix.f * 2 // 3 + 1)
         self.momentum = 0.1
         if args != None:
@@ -1628,7 +1703,7 @@ class BatchNorm(Layer):
 
     def __repr__(self):
         return '%s(%s, approx=%s)' % \
-            (type(self).__name__, self.X.sizes, self.approx)
+            (type(self).__name__, self._X.sizes, self.approx)
 
     def reset(self):
         self.bias.assign_all(0)
@@ -1636,9 +1711,13 @@ class BatchNorm(Layer):
         self.mu_hat.assign_all(0)
         self.var_hat.assign_all(0)
 
-    def _output(self, batch, mu, var):
-        factor = sfix.Array(len(mu))
+    def _factor(self, var):
+        factor = sfix.Array(len(var))
         factor[:] = self.InvertSqrt(var[:] + self.epsilon) * self.weights[:]
+        return factor
+
+    def _output(self, batch, mu, var):
+        factor = self._factor(var)
         @for_range_opt_multithread(self.n_threads,
                                    [len(batch), self.X.sizes[1]])
         def _(i, j):
@@ -1774,12 +1853,15 @@ class LayerNorm(Layer):  # Changed class name
         batch_shape = [shape[0]] + list(self.X.sizes[1:-1])
         self.mu = sfix.Tensor(batch_shape)
         self.var = sfix.Tensor(batch_shape)
-        self.nabla_weights = sfix.Array(shape[-1])
-        self.nabla_bias = sfix.Array(shape[-1])
+        if self.inference:
+            self.nabla_weights = self.nabla_bias = None
+        else:
+            self.nabla_weights = sfix.Array(shape[-1])
+            self.nabla_bias = sfix.Array(shape[-1])
 
     def __repr__(self):
         return '%s(%s, approx=%s)' % \
-            (type(self).__name__, self.X.sizes, self.approx)
+            (type(self).__name__, self._X.sizes, self.approx)
 
     def reset(self):  # Simplified reset method
         self.bias.assign_all(0)
@@ -2010,6 +2092,16 @@ class ConvBase(BaseLayer):
     use_conv2ds = True
     temp_weights = None
     temp_inputs = None
+    fused_relu = False
+    # None for the switches above, 'auto' for select_strategy()
+    strategy = None
+    strategies = 'conv2ds', 'im2col', 'direct'
+    # instructions per iteration and per summand for estimating rounds
+    strategy_instructions = {
+        'conv2ds': (130, 0),
+        'im2col': (400, 7),
+        'direct': (200, 100),
+    }
     def thetas(self):
         if self.use_bias:
             return self.weights, self.bias
@@ -2072,11 +2164,12 @@ class ConvBase(BaseLayer):
         if self.use_bias:
             self.bias = Array(output_shape[-1], self.bias_squant)
 
-        self.nabla_weights = Tensor(weight_shape, self.weight_squant)
-        if self.use_bias:
-            self.nabla_bias = Array(output_shape[-1], self.bias_squant)
-
-        self.unreduced = Tensor(self.output_shape, sint, address=self.Y.address)
+        if self.inference:
+            self.nabla_weights = self.nabla_bias = None
+        else:
+            self.nabla_weights = Tensor(weight_shape, self.weight_squant)
+            if self.use_bias:
+                self.nabla_bias = Array(output_shape[-1], self.bias_squant)
 
         if tf_weight_format:
             weight_in = weight_shape[2]
@@ -2091,10 +2184,14 @@ class ConvBase(BaseLayer):
 
     def __repr__(self):
         return '%s(%s, %s, %s, %s, %s, padding=%s, tf_weight_format=%s)' % \
-            (type(self).__name__, self.X.sizes, self.weight_shape,
-             self.bias_shape, self.Y.sizes, self.stride, repr(self.padding),
+            (type(self).__name__, self._X.sizes, self.weight_shape,
+             self.bias_shape, self._Y.sizes, self.stride, repr(self.padding),
              self.tf_weight_format)
 
+    @property
+    def unreduced(self):
+        return Tensor(self.output_shape, sint, address=self.Y.address)
+
     def input_from(self, player, **kwargs):
         self.input_params_from(player)
         self.weights.input_from(player, budget=100000, **kwargs)
@@ -2145,18 +2242,135 @@ class ConvBase(BaseLayer):
                 self.weight_squant(),
                 self.output_squant.params,
                 n_summands).reduce_after_mul()
+            if self.fused_relu:
+                res = relu(res)
             res.store_in_mem(self.Y.address + base)
         #stop_timer(2)
 
     def temp_shape(self):
         return list(self.output_shape[1:]) + [self.n_summands()]
 
+    def get_strategy(self, batch_size=1):
+        if self.strategy is None:
+            if self.use_conv2ds:
+                return 'conv2ds'
+            elif self.fewer_rounds:
+                return 'im2col'
+            else:
+                return 'direct'
+        elif self.strategy == 'auto':
+            return self.select_strategy(batch_size)
+        elif self.strategy in self.strategies:
+            return self.strategy
+        else:
+            raise CompilerError('unknown convolution strategy: %s' %
+                                self.strategy)
+
+    def strategy_estimates(self, batch_size=1):
+        """ Estimated cost of the products in this layer for every
+        applicable strategy. :py:obj:`'conv2ds'` uses one convolution
+        instruction per sample and output channel, which corresponds to
+        matrix multiplication preprocessing if the protocol supports it,
+        whereas :py:obj:`'im2col'` and :py:obj:`'direct'` compute a dot
+        product per output, either after gathering the inputs in
+        temporary memory or directly. The latter two only support a
+        single sample. The rounds are estimated from the unrolling of
+        the loops according to the budget. The reduction is the same
+        for all strategies and thus not included.
+
+        :param batch_size: number of samples
+        :returns: dictionary from strategy to rounds, preprocessing
+          (:py:class:`~Compiler.program.Tape.ReqNum`), and additional
+          memory in secret values
+        """
+        program = get_program()
+        n_threads = self.n_threads
+        if not isinstance(n_threads, int):
+            n_threads = program.auto_threads()
+        n_summands = self.n_summands()
+        _, output_h, output_w, _ = self.output_shape
+        n_outputs = batch_size * reduce(operator.mul, self.output_shape[1:])
+
+        def rounds(n_loops, strategy, depth):
+            fixed, per_summand = self.strategy_instructions[strategy]
+            n_instructions = fixed + per_summand * n_summands
+            n_loops = math.ceil(n_loops / n_threads)
+            unroll = min(n_loops, math.ceil(program.budget / n_instructions))
+            return math.ceil(n_loops / unroll) * depth
+
+        products = Tape.ReqNum()
+        products['modp', 'dot product'] = n_outputs
+        products['modp', 'triple'] = n_outputs * n_summands
+        res = {}
+        n_calls = n_outputs // (output_h * output_w)
+        req_num = Tape.ReqNum(products)
+        req_num['matmul', (1, n_summands, output_h * output_w)] = n_calls
+        res['conv2ds'] = rounds(n_calls, 'conv2ds', 1), req_num, 0
+        if batch_size == 1:
+            n_temp = n_outputs * n_summands
+            if self.temp_inputs is not None and \
+               self.temp_inputs.length >= n_temp:
+                n_temp = 0
+            res['im2col'] = rounds(n_outputs, 'im2col', 1), products, \
+                2 * n_temp
+            res['direct'] = rounds(n_outputs, 'direct', 1), products, 0
+        return res
+
+    def select_strategy(self, batch_size=1):
+        """ Select the strategy with the lowest estimated time
+        according to :py:func:`strategy_estimates` and the cost model
+        of the protocol given with ``-E``. The time is estimated using
+        the same latency and bandwidth as the automatic budget. Without
+        communication cost, the number of rounds decides. Ties are
+        broken by memory, and strategies that need more memory than
+        the machine has are not considered.
+
+        :param batch_size: number of samples
+        :returns: :py:obj:`'conv2ds'`, :py:obj:`'im2col'`, or
+          :py:obj:`'direct'`
+        """
+        program = get_program()
+        value_size = 2 * program.element_length()
+        costs = {}
+        for strategy, (rounds, req_num, memory) in \
+            self.strategy_estimates(batch_size).items():
+            # protocols with matrix preprocessing use triples otherwise
+            comm = cost.expected_communication(
+                program.options.execute, req_num, program.element_length(),
+                force_triple_use=strategy != 'conv2ds')
+            time = rounds * _auto_budget['round latency'] + \
+                sum(comm) / _auto_budget['bandwidth']
+            if program.machine_memory and \
+               memory * value_size > program.machine_memory:
+                time = float('inf')
+            costs[strategy] = time, memory, rounds, req_num, sum(comm)
+        res = min(self.strategies, key=lambda x: costs.get(
+            x, (float('inf'),))[:2])
+        if program.verbose:
+            print('Using convolution strategy %s for %s (%s)' % (
+                res, self, ', '.join(
+                    '%s: %d rounds, %d triples, %d matrix products, '
+                    '%d bytes, %d values' % (
+                        strategy, rounds, req_num['modp', 'triple'],
+                        sum(n for key, n in req_num.items()
+                            if key[0] == 'matmul'),
+                        comm, memory)
+                    for strategy, (_, memory, rounds, req_num, comm)
+                    in costs.items())))
+        return res
+
     def prepare_temp(self):
         shape = self.temp_shape()
-        inputs = MultiArray(shape, self.input_squant,
-                            address=self.temp_inputs)
-        weights = MultiArray(shape, self.weight_squant,
-                             address=self.temp_weights)
+        if self.temp_inputs is None or \
+           self.temp_inputs.length < reduce(operator.mul, shape):
+            # not covered by init_temp()
+            inputs = MultiArray(shape, self.input_squant)
+            weights = MultiArray(shape, self.weight_squant)
+        else:
+            inputs = MultiArray(shape, self.input_squant,
+                                address=self.temp_inputs)
+            weights = MultiArray(shape, self.weight_squant,
+                                 address=self.temp_weights)
         return inputs, weights
 
 class Conv2d(ConvBase):
@@ -2183,7 +2397,10 @@ class Conv2d(ConvBase):
         stride_h, stride_w = self.stride
         padding_h, padding_w = self.padding
 
-        if self.use_conv2ds:
+        strategy = self.get_strategy(len(batch))
+        fewer_rounds = strategy == 'im2col'
+
+        if strategy == 'conv2ds':
             part_size = 1
             @for_range_opt_multithread(self.n_threads,
                                        [len(batch), n_channels_out])
@@ -2223,7 +2440,7 @@ class Conv2d(ConvBase):
             return
         else:
             assert len(batch) == 1
-            if self.fewer_rounds:
+            if fewer_rounds:
                 inputs, weights = self.prepare_temp()
 
         @for_range_opt_multithread(self.n_threads,
@@ -2247,13 +2464,13 @@ class Conv2d(ConvBase):
                                        [in_x * inside_x][in_c]]
                                 wv += [self.weights[out_c][filter_y][filter_x][in_c]]
                                 wv[-1] *= inside
-                    if self.fewer_rounds:
+                    if fewer_rounds:
                         inputs[out_y][out_x][out_c].assign(iv)
                         weights[out_y][out_x][out_c].assign(wv)
                     else:
                         self.dot_product(iv, wv, out_y, out_x, out_c)
 
-        if self.fewer_rounds:
+        if fewer_rounds:
             @for_range_opt_multithread(self.n_threads,
                                        list(self.output_shape[1:]))
             def _(out_y, out_x, out_c):
@@ -2285,6 +2502,27 @@ class FixConv2d(Conv2d, FixBase):
     :param tf_weight_format: weight shape format is (height, width, input channels, output channels) instead of the default (output channels, height, width, input channels)
     """
 
+    def fold_batch_norm(self, layer):
+        """ Fold batch normalization with running statistics into
+        weights and bias.
+
+        :param layer: :py:class:`BatchNorm` following this layer """
+        assert not self.tf_weight_format
+        factor = layer._factor(layer.var_hat)
+        n_per_channel = reduce(operator.mul, self.weight_shape[1:])
+        @for_range_opt_multithread(self.n_threads, self.weight_shape[0])
+        def _(i):
+            self.weights[i].assign_vector(
+                self.weights[i].get_vector() *
+                factor.expand_to_vector(i, n_per_channel))
+        if self.use_bias:
+            bias = self.bias[:] - layer.mu_hat[:]
+        else:
+            bias = -layer.mu_hat[:]
+            self.bias = Array(self.output_shape[-1], self.bias_squant)
+            self.use_bias = True
+        self.bias[:] = bias * factor[:] + layer.bias[:]
+
     def reset(self):
         assert not self.tf_weight_format
         n_in = reduce(operator.mul, self.weight_shape[1:])
@@ -2418,7 +2656,10 @@ class QuantDepthwiseConv2d(QuantConvBase, Conv2d):
 
         depth_multiplier = 1
 
-        if self.use_conv2ds:
+        strategy = self.get_strategy()
+        fewer_rounds = strategy == 'im2col'
+
+        if strategy == 'conv2ds':
             assert depth_multiplier == 1
             assert self.weight_shape[0] == 1
             @for_range_opt_multithread(self.n_threads, n_channels_in)
@@ -2438,7 +2679,7 @@ class QuantDepthwiseConv2d(QuantConvBase, Conv2d):
             self.reduction()
             return
         else:
-            if self.fewer_rounds:
+            if fewer_rounds:
                 inputs, weights = self.prepare_temp()
 
         @for_range_opt_multithread(self.n_threads,
@@ -2461,13 +2702,13 @@ class QuantDepthwiseConv2d(QuantConvBase, Conv2d):
                                 iv += [self.X[0][in_y][in_x][in_c]]
                                 wv += [self.weights[0][filter_y][filter_x][oc]]
                                 wv[-1] *= inside
-                        if self.fewer_rounds:
+                        if fewer_rounds:
                             inputs[out_y][out_x][oc].assign(iv)
                             weights[out_y][out_x][oc].assign(wv)
                         else:
                             self.dot_product(iv, wv, out_y, out_x, oc)
 
-        if self.fewer_rounds:
+        if fewer_rounds:
             @for_range_opt_multithread(self.n_threads,
                                        list(self.output_shape[1:]))
             def _(out_y, out_x, out_c):
@@ -3004,13 +3245,14 @@ class MultiHeadAttention(BertBase):
 
         self.output = BertOutput(internal_shape, hidden_size, hidden_size, seq_len, dropout, layernorm_eps, rsqrt_approx)
         self.context = sfix.Tensor([internal_shape, self.seq_len, hidden_size])
-        self.nabla_context = sfix.Tensor([internal_shape, self.seq_len, hidden_size])
 
         # self.context_nabla
 
         self.attention_scores = MultiArray([internal_shape, self.num_attention_heads, self.seq_len, self.seq_len], sfix)
-        self.nabla_attention_scores = MultiArray([internal_shape, self.num_attention_heads, self.seq_len, self.seq_len], sfix)
-        self.nabla_preattention_scores = MultiArray([internal_shape, self.num_attention_heads, self.seq_len, self.seq_len], sfix)
+        if not self.inference:
+            self.nabla_context = sfix.Tensor([internal_shape, self.seq_len, hidden_size])
+            self.nabla_attention_scores = MultiArray([internal_shape, self.num_attention_heads, self.seq_len, self.seq_len], sfix)
+            self.nabla_preattention_scores = MultiArray([internal_shape, self.num_attention_heads, self.seq_len, self.seq_len], sfix)
 
     @_layer_method_call_tape
     def forward(self, batch=None, hidden_state=None, training=None):
@@ -3225,6 +3467,139 @@ class MultiHeadAttention(BertBase):
 
         return nabla_y_hidden_state
 
+class DataSource:
+    """ Base class for training data that is loaded batch by batch
+    during training instead of being held in memory as a whole. Use
+    :py:obj:`N` as the number of examples when creating the first and
+    the last layer and pass the data source instead of the training
+    data to :py:func:`Optimizer.fit`::
+
+        source = ml.PersistenceData(60000, 128)
+        layers = [ml.Dense(source.N, 784, 128, activation='relu'),
+                  ml.Dense(source.N, 128, 10),
+                  ml.MultiOutput(source.N, 10)]
+        ml.SGD(layers).fit(source, None, epochs=10, batch_size=128)
+
+    The optimizer then uses the first and the second half of the
+    layer buffers for alternating batches while a separate thread
+    loads the next batch into the other half. Batches are used in
+    the order of the data, and an incomplete batch at the end is
+    skipped.
+
+    :param n_samples: number of training examples
+    :param batch_size: number of examples per batch
+    """
+    def __init__(self, n_samples, batch_size):
+        if n_samples < batch_size:
+            raise CompilerError('not enough samples for one batch')
+        self.n_samples = n_samples
+        self.batch_size = batch_size
+        self.tape = None
+        self.threads = set()
+
+    @property
+    def N(self):
+        """ Number of examples in the layers, that is, space for two
+        batches. """
+        return 2 * self.batch_size
+
+    @property
+    def n_batches(self):
+        """ Number of batches per epoch. """
+        return self.n_samples // self.batch_size
+
+    def load(self, X, Y, i_batch):
+        """ Load batch into buffers (to be implemented by subclasses).
+
+        :param X: sample buffer with :py:obj:`batch_size` examples
+        :param Y: label buffer with :py:obj:`batch_size` examples
+        :param i_batch: batch number in the epoch (regint)
+        """
+        raise NotImplementedError()
+
+    def prepare(self, X, Y):
+        """ Compile the thread loading batches.
+
+        :param X: sample tensor of the first layer
+        :param Y: label tensor of the last layer
+        """
+        B = self.batch_size
+        self.i_batch = regint.Array(1)
+        def load():
+            i_batch = self.i_batch[0]
+            base = i_batch % 2 * B
+            self.load(X.get_part(base, B), Y.get_part(base, B), i_batch)
+        self.tape = get_program().new_tape(load, name='load',
+                                           single_thread=True)
+
+    def start(self, i_batch):
+        """ Start loading a batch into the buffer half given by the
+        parity of the batch number. """
+        self.i_batch[0] = i_batch
+        self.thread = get_program().run_tape(self.tape, 0)
+        if self.thread not in self.threads:
+            self.threads.add(self.thread)
+            print('Loading training data in thread %d' % self.thread)
+
+    def wait(self):
+        """ Wait for loading the batch started last. """
+        get_program().join_tape(self.thread)
+
+class PersistenceData(DataSource):
+    """ Training data read from the persistence files
+    (``Persistence/Transactions-P<playerno>.data``) as stored by
+    :py:func:`~Compiler.types.MultiArray.write_to_file`. Positions are
+    given as the number of shares (one per :py:class:`sfix` value)
+    before the data. The data can be used for any number of epochs.
+
+    :param n_samples: number of training examples
+    :param batch_size: number of examples per batch
+    :param X_start: position of the samples (default: 0)
+    :param Y_start: position of the labels (default: after the samples)
+    """
+    def __init__(self, n_samples, batch_size, X_start=0, Y_start=None):
+        super(PersistenceData, self).__init__(n_samples, batch_size)
+        self.X_start = X_start
+        self.Y_start = Y_start
+
+    def load(self, X, Y, i_batch):
+        B = self.batch_size
+        x_size = X.total_size() // B
+        y_size = Y.total_size() // B
+        Y_start = self.Y_start
+        if Y_start is None:
+            Y_start = self.X_start + self.n_samples * x_size
+        X.read_from_file(self.X_start + i_batch * B * x_size)
+        Y.read_from_file(Y_start + i_batch * B * y_size)
+
+class InputData(DataSource):
+    """ Training data input by one or two parties while training. The
+    loading thread reads from ``Player-Data/Input-P<playerno>-<thread>``
+    where the compiler outputs the thread number. The files have to
+    contain the samples and the labels respectively in the order of
+    the batches once for every epoch.
+
+    :param n_samples: number of training examples
+    :param batch_size: number of examples per batch
+    :param player: party inputting the samples (default: 0)
+    :param label_player: party inputting the labels (default: same)
+    """
+    def __init__(self, n_samples, batch_size, player=0, label_player=None):
+        super(InputData, self).__init__(n_samples, batch_size)
+        self.player = player
+        if label_player is None:
+            label_player = player
+        self.label_player = label_player
+
+    def load(self, X, Y, i_batch):
+        X.input_from(self.player)
+        Y.input_from(self.label_player)
+
+    def start(self, i_batch):
+        super(InputData, self).start(i_batch)
+        if len(self.threads) > 1:
+            raise CompilerError('input loaded in several threads')
+
 class Optimizer:
     """ Base class for graphs of layers. """
     n_threads = Layer.n_threads
@@ -3238,6 +3613,8 @@ class Optimizer:
     output_stats = False
     print_accuracy = True
     time_training = True
+    data_source = None
+    planned = frozenset()
 
     @staticmethod
     def from_args(program, layers):
@@ -3298,6 +3675,18 @@ class Optimizer:
             prev = layer
             self.thetas.extend(layer.thetas())
 
+    @property
+    def inference(self):
+        """ Whether any layer has been created for inference only
+        (see :py:func:`set_inference`). """
+        return any(layer.inference for layer in self.layers)
+
+    def check_training(self):
+        if self.inference:
+            raise CompilerError('layers created for inference only, '
+                                'use set_inference(False) before creating '
+                                'layers for training')
+
     def set_layers_with_inputs(self, layers):
         """ Construct graph from :py:obj:`inputs` members of list of layers. """
         self._layers = layers
@@ -3307,6 +3696,147 @@ class Optimizer:
             layer.last_used = list(filter(lambda x: x not in used, inputs))
             used.update(inputs)
 
+    def plan_memory(self, training=None):
+        """ Place the outputs and gradients of layers in shared
+        memory wherever their lifetimes do not overlap. Every layer
+        otherwise keeps its own tensors for the whole program. This has
+        to be called before running any layer, and only tensors that
+        have not been allocated at that point are considered.
+
+        Planning for training covers a forward and backward pass of
+        consecutive layers where the gradients can reuse the memory of
+        outputs that are not needed anymore. Otherwise, outputs of
+        layers not used by later layers are overwritten in the forward
+        pass, so intermediate results are not available afterwards
+        (similar to :py:obj:`keep_intermediate=False` in
+        :py:func:`forward`).
+
+        :param training: plan for training (default: unless the
+          layers are for inference only)
+        :returns: number of values before and after planning
+
+        """
+        if training is None:
+            training = not self.inference
+        layers = self.layers
+        n = len(layers)
+        # lifetime in steps of forward pass followed by backward pass
+        lifetimes = {}
+        def live(tensor, start, end):
+            if isinstance(tensor, Tensor) and tensor.array._address is None:
+                key = id(tensor)
+                if key in lifetimes:
+                    _, old_start, old_end = lifetimes[key]
+                    start, end = min(start, old_start), max(end, old_end)
+                lifetimes[key] = tensor, start, end
+        if training:
+            for i, layer in enumerate(layers):
+                if (layer.inputs or []) != ([layers[i - 1]] if i else []):
+                    raise CompilerError('memory planning for training only '
+                                        'supports consecutive layers')
+            for i, layer in enumerate(layers[:-1]):
+                # output needed for the backward pass of this and the
+                # next layer, last one also for accuracy after update
+                live(layer._Y, i, 2 * n if i == n - 2 else 2 * n - 1 - i)
+                if i:
+                    # from own backward pass to the one of the previous
+                    live(layer.nabla_X, 2 * n - 1 - i, 2 * n - i)
+        else:
+            index = dict((layer, i) for i, layer in enumerate(layers))
+            end = [n] * n
+            for i, layer in enumerate(layers):
+                for x in layer.inputs or []:
+                    if x in index:
+                        end[index[x]] = i
+            for i, layer in enumerate(layers):
+                # outputs of layers not used otherwise live until the end
+                live(layer._Y, i, max(end[i], i))
+        by_type = {}
+        for tensor, start, end in lifetimes.values():
+            # fixed-point and quantized values share integer memory
+            value_type = getattr(tensor.value_type, 'int_type',
+                                 tensor.value_type)
+            by_type.setdefault(value_type, []).append(
+                (tensor.total_size(), start, end, tensor))
+        before = after = 0
+        for value_type, tensors in by_type.items():
+            placed = []
+            for size, start, end, tensor in sorted(
+                    tensors, key=lambda x: (-x[0], x[1])):
+                offset = 0
+                for other, other_size in sorted(
+                        (other, other_size)
+                        for other, other_size, other_start, other_end, _
+                        in placed
+                        if other_start <= end and start <= other_end):
+                    if offset + size <= other:
+                        break
+                    offset = max(offset, other + other_size)
+                placed.append((offset, size, start, end, tensor))
+            size = max(offset + size for offset, size, _, _, _ in placed)
+            arena = Array(size, value_type)
+            for offset, _, _, _, tensor in placed:
+                tensor.address = arena.get_address(offset)
+            before += sum(x[0] for x in tensors)
+            after += size
+        self.planned = frozenset(lifetimes)
+        print('Memory planning for %s: %d values for %d tensors instead of %d'
+              % ('training' if training else 'inference', after,
+                 len(lifetimes), before))
+        return before, after
+
+    def fuse_layers(self):
+        """ Fuse layers for inference. Batch normalization with running
+        statistics is folded into the weights and bias of a preceding
+        dense or convolution layer, and ReLU is computed by such a
+        layer in the same pass as its output, which saves a pass over
+        an intermediate tensor. This has to be called after
+        setting the parameters and before running the layers, and the
+        fused layers cannot be trained anymore. Batch normalization
+        that cannot be folded uses the running statistics as well
+        afterwards. """
+        consumers = {}
+        for layer in self.layers:
+            for x in layer.inputs or []:
+                consumers.setdefault(x, []).append(layer)
+            if isinstance(layer, BatchNorm):
+                layer.is_trained = True
+        fused = {}
+        layers = []
+        for layer in self.layers:
+            original = layer.inputs or []
+            inputs = [fused.get(x, x) for x in original]
+            if inputs:
+                layer.inputs = inputs
+            if isinstance(layer, Dense) and layer.activation == 'relu':
+                print('Fusing ReLU into %s' % layer)
+                layer.activation_layer = None
+                layer.f_input = layer._Y
+                layer.fused_relu = True
+                layer.inference = True
+            prev = inputs[0] if len(inputs) == 1 else None
+            if prev in layers and len(consumers[original[0]]) == 1 \
+               and layer is not self.layers[-1] and \
+               all(len(x.inputs) == 1 for x in consumers.get(layer, [])) \
+               and isinstance(prev, (Dense, FixConv2d)) \
+               and not prev.fused_relu \
+               and layer._Y.total_size() == prev._Y.total_size():
+                if isinstance(layer, BatchNorm) \
+                   and not getattr(prev, 'tf_weight_format', False):
+                    print('Folding %s into %s' % (layer, prev))
+                    prev.fold_batch_norm(layer)
+                elif isinstance(layer, Relu):
+                    print('Fusing %s into %s' % (layer, prev))
+                    prev.fused_relu = True
+                else:
+                    layers.append(layer)
+                    continue
+                prev.inference = True
+                fused[layer] = prev
+            else:
+                layers.append(layer)
+        self.layers = layers
+
     def set_learning_rate(self, lr):
         print('Setting learning rate to', lr)
         self.gamma = MemValue(cfix(lr))
@@ -3328,18 +3858,24 @@ class Optimizer:
             return batch
 
     @_no_mem_warnings
-    def forward(self, N=None, batch=None, keep_intermediate=True,
+    def forward(self, N=None, batch=None, keep_intermediate=None,
                 model_from=None, training=False, run_last=True,
                 delete_params=False):
         """ Compute graph.
 
         :param N: batch size (used if batch not given)
         :param batch: indices for computation (:py:class:`~Compiler.types.Array` or list)
-        :param keep_intermediate: do not free memory of intermediate results after use
+        :param keep_intermediate: do not free memory of intermediate
+          results after use (default: only with layers for training),
+          except for the inputs of the last layer, which are always kept
         """
         if batch is None:
             batch = regint.Array(N)
             batch.assign(regint.inc(N))
+        if keep_intermediate is None:
+            keep_intermediate = not self.inference
+        if not keep_intermediate:
+            self.set_layers_with_inputs(self.layers)
         for i, layer in enumerate(self.layers):
             if layer.inputs and len(layer.inputs) == 1 and layer.inputs[0] is not None:
                 layer._X.address = layer.inputs[0].Y.address
@@ -3349,7 +3885,10 @@ class Optimizer:
             break_point('pre-forward-layer-%d' % i)
             if self.time_layers:
                 start_timer(100 + i)
-            if i != len(self.layers) - 1 or run_last:
+            if layer.inference and isinstance(layer, OutputBase):
+                # only computing the loss
+                pass
+            elif i != len(self.layers) - 1 or run_last:
                 for theta in layer.thetas():
                     theta.alloc()
                 layer.forward(batch=self.batch_for(layer, batch),
@@ -3374,7 +3913,11 @@ class Optimizer:
             break_point('post-forward-layer-%d' % i)
             if not keep_intermediate:
                 for l in layer.last_used:
-                    l.Y.delete()
+                    # the inputs of the last layer are read afterwards
+                    # by eval() and reveal_correctness()
+                    if id(l._Y) not in self.planned and \
+                       l not in (self.layers[-1].inputs or []):
+                        l.Y.delete()
             if delete_params:
                 for theta in layer.thetas():
                     theta.delete()
@@ -3397,7 +3940,6 @@ class Optimizer:
                 res = sfix.Array(len(data))
         else:
             res = sfix.Matrix(len(data), self.layers[-1].d_out)
-        self.set_layers_with_inputs(self.layers)
         def f(start, batch_size, batch):
             batch.assign_vector(regint.inc(batch_size, start))
             self.forward(batch=batch, run_last=False, keep_intermediate=False)
@@ -3413,6 +3955,7 @@ class Optimizer:
     @_no_mem_warnings
     def backward(self, batch):
         """ Compute backward propagation. """
+        self.check_training()
         for i, layer in reversed(list(enumerate(self.layers))):
             assert len(batch) <= layer.back_batch_size
             if self.time_layers:
@@ -3535,18 +4078,33 @@ class Optimizer:
         i = self.i_epoch
         n_iterations = MemValue(0)
         self.n_correct = MemValue(0)
+        source = self.data_source
+        if source:
+            if N != source.batch_size:
+                raise CompilerError('batch size has to match data source')
+            if self.layers[0]._X.sizes[0] != source.N:
+                raise CompilerError(
+                    'layers have to be created with %d examples' % source.N)
+            source.prepare(self.layers[0].X, self.layers[-1].Y)
         @for_range(self.n_epochs)
         def _(_):
-            if self.X_by_label is None:
-                self.X_by_label = [[None] * self.layers[0].N]
-            assert len(self.X_by_label) in (1, 2)
-            assert N % len(self.X_by_label) == 0
-            n = N // len(self.X_by_label)
-            n_per_epoch = int(math.ceil(1. * max(len(X) for X in
-                                                 self.X_by_label) / n))
+            if source:
+                X_by_label = []
+                n_per_epoch = source.n_batches
+                source.start(0)
+                source.wait()
+            else:
+                if self.X_by_label is None:
+                    self.X_by_label = [[None] * self.layers[0].N]
+                X_by_label = self.X_by_label
+                assert len(X_by_label) in (1, 2)
+                assert N % len(X_by_label) == 0
+                n = N // len(X_by_label)
+                n_per_epoch = int(math.ceil(1. * max(len(X) for X in
+                                                     X_by_label) / n))
             print('%d runs per epoch' % n_per_epoch)
             indices_by_label = []
-            for label, X in enumerate(self.X_by_label):
+            for label, X in enumerate(X_by_label):
                 indices = regint.Array(n * n_per_epoch)
                 indices_by_label.append(indices)
                 indices.assign(regint.inc(len(X)))
@@ -3562,15 +4120,25 @@ class Optimizer:
             @for_range(n_per_epoch)
             def _(j):
                 n_iterations.iadd(1)
+                if source:
+                    @if_(j + 1 < n_per_epoch)
+                    def _():
+                        source.start(j + 1)
                 batch = regint.Array(N)
-                for label, X in enumerate(self.X_by_label):
+                if source:
+                    batch.assign(regint.inc(N, j % 2 * N))
+                for label, X in enumerate(X_by_label):
                     indices = indices_by_label[label]
                     batch.assign(indices.get_vector(j * n, n) +
-                                 regint(label * len(self.X_by_label[0]), size=n),
+                                 regint(label * len(X_by_label[0]), size=n),
                                  label * n)
                 self.forward(batch=batch, training=True)
                 self.backward(batch=batch)
                 self.update(i, j, batch=batch)
+                if source:
+                    @if_(j + 1 < n_per_epoch)
+                    def _():
+                        source.wait()
                 loss_sum.iadd(self.layers[-1].l)
                 if self.print_loss_reduction:
                     before = self.layers[-1].average_loss(N)
@@ -3699,6 +4267,8 @@ class Optimizer:
         self.time_layers = 'time_layers' in program.args
         self.revealing_correctness &= not 'no_acc' in program.args
         self.layers[-1].compute_loss = not 'no_loss' in program.args
+        if 'plan_memory' in program.args:
+            self.plan_memory()
         if 'full_cisc' in program.args:
             program.options.keep_cisc = 'FPDiv,exp2_fx,log2_fx'
         model_input = 'model_input' in program.args
@@ -3755,8 +4325,11 @@ class Optimizer:
                     stop_timer(1)
             if 'no_acc' in program.args:
                 return
-            N = self.layers[0].X.sizes[0]
-            n_trained = (N + batch_size - 1) // batch_size * batch_size
+            if self.data_source:
+                n_trained = self.data_source.n_batches * batch_size
+            else:
+                N = self.layers[0].X.sizes[0]
+                n_trained = (N + batch_size - 1) // batch_size * batch_size
             if not acc_first and self.print_accuracy and \
                self.revealing_correctness:
                 print_ln('train_acc: %s (%s/%s)',
@@ -3808,8 +4381,10 @@ class Optimizer:
             sample_mask=None):
         """ Train model.
 
-        :param X: training sample data (sfix tensor)
-        :param Y: training labels (sint/sfix tensor)
+        :param X: training sample data (sfix tensor) or
+          :py:class:`DataSource` to load batches while training
+        :param Y: training labels (sint/sfix tensor, ignored with
+          data source)
         :param epochs: number of epochs (int)
         :param batch_size: batch size (int)
         :param validation_data: tuple of test sample data and labels for
@@ -3823,8 +4398,11 @@ class Optimizer:
           only for 0/1 labels, 0 means ignore sample)
 
         """
-        self.layers[0].X = X
-        self.layers[-1].Y = Y
+        if isinstance(X, DataSource):
+            self.data_source = X
+        else:
+            self.layers[0].X = X
+            self.layers[-1].Y = Y
         if sample_mask:
             self.layers[-1].set_sample_mask(sample_mask)
         self.revealing_correctness = print_accuracy
@@ -3891,6 +4469,7 @@ class Adam(Optimizer):
             print_both('Normalize gradient')
 
         self.layers = layers
+        self.check_training()
         self.ms = []
         self.vs = []
         self.gs = []
@@ -3967,6 +4546,7 @@ class SGD(Optimizer):
         super(SGD, self).__init__(report_loss=report_loss)
         self.momentum = 0.9
         self.layers = layers
+        self.check_training()
         self.n_epochs = n_epochs
         self.nablas = []
         self.momentum_values = []
@@ -4167,6 +4747,9 @@ class keras:
                 if input_shape == None:
                     raise Exception('must specify number of samples')
                 Layer.back_batch_size = batch_size
+                inference = Layer.inference
+                if self.optimizer[0] == 'inference':
+                    Layer.inference = True
                 layers = []
                 for i, layer in enumerate(self.layers):
                     name = layer[0]
@@ -4177,7 +4760,7 @@ class keras:
                         else:
                             N = batch_size
                             n_units = reduce(operator.mul,
-                                             layers[-1].Y.sizes[1:])
+                                             layers[-1]._Y.sizes[1:])
                         if i == len(self.layers) - 1:
                             activation = layer[2].get('activation', None)
                             if activation in ('softmax', 'sigmoid'):
@@ -4187,7 +4770,7 @@ class keras:
                                     'softmax requires more than one output neuron')
                         layers.append(Dense(N, n_units, layer[1][0],
                                             **layer[2]))
-                        input_shape = layers[-1].Y.sizes
+                        input_shape = layers[-1]._Y.sizes
                     elif name == 'conv2d':
                         input_shape = list(input_shape) + \
                             [1] * (4 - len(input_shape))
@@ -4199,7 +4782,7 @@ class keras:
                         layers.append(easyConv2d(
                             input_shape, batch_size, filters, kernel_size,
                             strides, padding))
-                        output_shape = layers[-1].Y.sizes
+                        output_shape = layers[-1]._Y.sizes
                         input_shape = output_shape
                         print('conv output shape', output_shape)
                     elif name == 'maxpool':
@@ -4208,22 +4791,22 @@ class keras:
                         padding = layer[1]['padding']
                         layers.append(easyMaxPool(input_shape, pool_size,
                                                   strides, padding))
-                        input_shape = layers[-1].Y.sizes
+                        input_shape = layers[-1]._Y.sizes
                     elif name == 'avgpool':
                         layers.append(FixAveragePool2d(input_shape, None, **layer[1]))
-                        input_shape = layers[-1].Y.sizes
+                        input_shape = layers[-1]._Y.sizes
                     elif name == 'dropout':
                         layers.append(Dropout([batch_size] + [reduce(
-                            operator.mul, layers[-1].Y.sizes[1:])],
+                            operator.mul, layers[-1]._Y.sizes[1:])],
                                               alpha=layer[1]))
-                        input_shape = layers[-1].Y.sizes
+                        input_shape = layers[-1]._Y.sizes
                     elif name == 'flatten':
                         pass
                     elif name == 'relu':
-                        layers.append(Relu(layers[-1].Y.sizes))
+                        layers.append(Relu(layers[-1]._Y.sizes))
                     elif name == 'batchnorm':
-                        input_shape = layers[-1].Y.sizes
-                        layers.append(BatchNorm(layers[-1].Y.sizes))
+                        input_shape = layers[-1]._Y.sizes
+                        layers.append(BatchNorm(layers[-1]._Y.sizes))
                     else:
                         raise Exception(layer[0] + ' not supported')
                 if layers[-1].d_out == 1:
@@ -4234,6 +4817,7 @@ class keras:
                         layers.append(MultiOutput.from_args(program, *shape))
                     else:
                         layers.append(MultiOutput(*shape))
+                Layer.inference = inference
                 if self.optimizer[1]:
                     raise Exception('use keyword arguments for optimizer')
                 opt = self.optimizer[0]
@@ -4296,6 +4880,8 @@ class keras:
                     raise Exception('need to run fit() or build() first')
                 if batch_size != None:
                     batch_size = min(batch_size, self.batch_size)
+                if 'fuse' in get_program().args:
+                    self.opt.fuse_layers()
                 return self.opt.eval(x, batch_size=batch_size)
 
 def layers_from_torch(model, data_input_shape, batch_size, input_via=None,
@@ -4399,7 +4985,7 @@ def layers_from_torch(model, data_input_shape, batch_size, input_via=None,
             layers.append(easyConv2d(input_shape, batch_size, item.out_channels,
                                      item.kernel_size, item.stride,
                                      item.padding, item.bias is not None, **layer_args.get(item, {})))
-            input_shape = layers[-1].Y.shape
+            input_shape = layers[-1]._Y.shape
             if input_via is not None:
                 if item.bias is not None:
                     shapes = [x.shape for x in
@@ -4454,7 +5040,7 @@ def layers_from_torch(model, data_input_shape, batch_size, input_via=None,
         elif name == 'Flatten':
             return
         elif name == 'BatchNorm2d' or name == 'BatchNorm1d':
-            layers.append(BatchNorm(layers[-1].Y.sizes))
+            layers.append(BatchNorm(layers[-1]._Y.sizes))
             if input_via is not None:
                 layers[-1].epsilon = item.eps
                 layers[-1].weights = sfix.input_tensor_via(input_via,
@@ -4470,9 +5056,9 @@ def layers_from_torch(model, data_input_shape, batch_size, input_via=None,
             if alpha == 0.1:
                 print('WARNING: dropout rate 0.1 not supported, using 0.125')
                 alpha = 0.125
-            layers.append(Dropout([input_shape[0]] + list(layers[-1].Y.sizes[1:]),
+            layers.append(Dropout([input_shape[0]] + list(layers[-1]._Y.sizes[1:]),
                                   alpha=alpha))
-            input_shape = layers[-1].Y.sizes
+            input_shape = layers[-1]._Y.sizes
         elif name == 'BertForSequenceClassification':
             process(item.bert)
             process(item.dropout)
@@ -4605,7 +5191,7 @@ def layers_from_torch(model, data_input_shape, batch_size, input_via=None,
                 pass
             if len(inputs) == 1:
                 if isinstance(inputs[0], (Dropout, BatchNorm)):
-                    input_shape = inputs[0].inputs[0].Y.shape
+                    input_shape = inputs[0].inputs[0]._Y.shape
                 else:
                     input_shape = inputs[0]._Y.shape
             else:
@@ -0,0 +1,96 @@
+"""
+Timing and memory usage of the compilation phases per tape as
+activated by ``compile.py --phase-profile``.
+"""
+
+import contextlib
+import json
+import sys
+import time
+import types
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    """ Peak resident set size of the process in MB (None if unknown). """
+    if resource is None:
+        return None
+    res = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes instead of kilobytes
+        res /= 1024
+    return res / 1024
+
+
+def null_phase(n_instructions=0):
+    """ Context manager for a phase without profiling. """
+    return contextlib.nullcontext(
+        types.SimpleNamespace(n_instructions=n_instructions))
+
+
+class PhaseProfile:
+    """ Accumulates time, number of calls, and number of instructions
+    per phase and tape. Nested phases are included in the time of the
+    outer phase but not in its self time. """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.entries = {}
+        self.stack = []
+
+    @contextlib.contextmanager
+    def phase(self, name, tape=None, n_instructions=0):
+        """ Context manager for one call of a phase. The number of
+        instructions can be changed via the result.
+
+        :param name: phase name
+        :param tape: tape name or None for the whole program
+        :param n_instructions: number of instructions processed
+        """
+        key = name, tape
+        if key not in self.entries:
+            self.entries[key] = dict(
+                phase=name, tape=tape, calls=0, time=0, self_time=0,
+                instructions=0)
+        entry = self.entries[key]
+        start = time.perf_counter()
+        self.stack.append(0)
+        res = types.SimpleNamespace(n_instructions=n_instructions)
+        try:
+            yield res
+        finally:
+            duration = time.perf_counter() - start
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += duration
+            entry["calls"] += 1
+            entry["time"] += duration
+            entry["self_time"] += duration - nested
+            entry["instructions"] += res.n_instructions
+            entry["peak_rss_mb"] = peak_rss()
+
+    def totals(self):
+        """ Self time, calls, and instructions per phase over all tapes. """
+        res = {}
+        for entry in self.entries.values():
+            total = res.setdefault(entry["phase"], dict(
+                phase=entry["phase"], calls=0, self_time=0, instructions=0))
+            for key in "calls", "self_time", "instructions":
+                total[key] += entry[key]
+        return list(res.values())
+
+    def write(self, filename, **info):
+        """ Write JSON report with phases in order of first occurrence. """
+        res = dict(info)
+        res["date"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        res["total_time"] = time.perf_counter() - self.start
+        res["peak_rss_mb"] = peak_rss()
+        res["totals"] = self.totals()
+        res["phases"] = list(self.entries.values())
+        with open(filename, "w") as f:
+            json.dump(res, f, indent=1)
+        print("Writing phase profile to", filename)
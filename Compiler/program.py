@@ -4,7 +4,9 @@ blocks and registers. Most relevant is the central :py:class:`Program`
 object that holds various properties of the computation.
 """
 
+import contextlib
 import inspect
+import io
 import itertools
 import math
 import os
@@ -23,6 +25,8 @@ from Compiler.exceptions import CompilerError
 from Compiler.instructions_base import RegType
 
 from . import allocator as al
+from . import attribution
+from . import profiling
 from . import util
 from .papers import *
 from .cost import expected_communication
@@ -38,6 +42,9 @@ data_types = dict(
     open=7,
 )
 
+# assumed memory per thread for preprocessing buffers etc. in bytes
+thread_memory_overhead = 2 ** 26
+
 field_types = dict(
     modp=0,
     gf2n=1,
@@ -65,12 +72,26 @@ class defaults:
     merge_opens = True
     preserve_mem_order = False
     max_parallel_open = 0
+    max_round_bytes = 0
     dead_code_elimination = False
     noreallocate = False
     asmoutfile = None
     stop = False
     insecure = False
     keep_cisc = False
+    cache = False
+    jobs = None
+    stream = False
+    phase_profile = False
+    attribution = False
+    trace_frames = 0
+    merge_window = 0
+    register_allocation = "size"
+    cisc_cache = 0
+    cse = False
+    constant_propagation = False
+    licm = False
+    machine = None
 
 
 class Program(object):
@@ -88,9 +109,24 @@ class Program(object):
 
         self.options = options
         self.verbose = options.verbose
+        if options.phase_profile:
+            self.phase_profile = profiling.PhaseProfile()
+        else:
+            self.phase_profile = None
+        if options.attribution or int(options.trace_frames or 0):
+            self.call_sites = attribution.CallSites(
+                int(options.trace_frames or 0))
+        else:
+            self.call_sites = None
         self.args = args
         self.name = name
         self.init_names(args)
+        if options.cisc_cache and float(options.cisc_cache) > 0:
+            from .cache import TemplateCache
+            self.template_cache = TemplateCache(
+                self, options, float(options.cisc_cache) * 2 ** 20)
+        else:
+            self.template_cache = None
         self._security = 40
         self.used_security = 0
         self.prime = None
@@ -171,17 +207,22 @@ class Program(object):
         self.allocated_mem_blocks = {}
         self.saved = 0
         self.req_num = None
+        self.cse_saved = Tape.ReqNum()
         self.tape_stack = []
         self.n_threads = 1
         self.public_input_file = None
         self.types = {}
-        if self.options.budget:
+        # per-loop unrolling for for_range_opt() based on a cost model
+        self.auto_budget = self.options.budget == "auto"
+        if self.options.budget and not self.auto_budget:
             self.budget = int(self.options.budget)
         else:
             if self.options.optimize_hard:
                 self.budget = 100000
             else:
                 self.budget = defaults.budget
+        self.init_machine()
+        self.thread_choices = []
         self.to_merge = [
             Compiler.instructions.asm_open_class,
             Compiler.instructions.gasm_open_class,
@@ -275,6 +316,72 @@ class Program(object):
     def get_args(self):
         return self.args
 
+    def init_machine(self):
+        """ Machine profile for ``n_threads='auto'``: cores and memory
+        of the machine running the virtual machine, by default the
+        compiling one. """
+        if self.options.machine:
+            profile = self.options.machine.split(",")
+            self.machine_cores = int(profile[0])
+            if len(profile) > 1:
+                self.machine_memory = int(float(profile[1]) * 2 ** 30)
+            else:
+                self.machine_memory = None
+        else:
+            self.machine_cores = os.cpu_count() or 1
+            try:
+                self.machine_memory = os.sysconf("SC_PAGE_SIZE") * \
+                    os.sysconf("SC_PHYS_PAGES")
+            except (ValueError, OSError, AttributeError):
+                self.machine_memory = None
+
+    def auto_threads(self, n_items=None):
+        """ Number of threads to compile for ``n_threads='auto'``,
+        which is one per core but not more than items. """
+        res = self.machine_cores
+        if util.is_constant(n_items):
+            res = min(res, n_items)
+        return max(1, res)
+
+    def thread_memory(self, tape):
+        """ Estimated memory in bytes for running a tape in a thread
+        using its register usage and size. """
+        if self.options.ring:
+            length = int(self.options.ring) // 8
+        else:
+            length = 16
+        reg_bytes = {
+            RegType.ClearModp: length,
+            RegType.SecretModp: 2 * length,
+            RegType.ClearGF2N: 16,
+            RegType.SecretGF2N: 32,
+            RegType.ClearInt: 8,
+        }
+        res = thread_memory_overhead + 16 * len(tape)
+        for reg_type, n in (tape.reg_usage or {}).items():
+            res += n * reg_bytes.get(reg_type, 16)
+        return res
+
+    def concurrent_threads(self, tapes, n_threads):
+        """ Number of threads to run in parallel for
+        ``n_threads='auto'`` such that the threads fit into the memory
+        of the machine.
+
+        :param tapes: tape handles
+        :param n_threads: number of tape runs
+        """
+        res = min(n_threads, self.machine_cores)
+        if self.machine_memory:
+            memory = max(self.thread_memory(self.tapes[tape])
+                         for tape in tapes)
+            res = min(res, self.machine_memory // memory)
+        res = max(1, res)
+        self.thread_choices.append((self.tapes[tapes[0]].name, n_threads, res))
+        if self.verbose:
+            print("Running %d threads with at most %d in parallel" %
+                  (n_threads, res))
+        return res
+
     def max_par_tapes(self):
         """Upper bound on number of tapes that will be run in parallel.
         (Excludes empty tapes)"""
@@ -449,6 +556,7 @@ class Program(object):
             self.req_num = tape.req_num
         else:
             self.req_num += tape.req_num
+        self.cse_saved += tape.cse_saved
 
     def required_bit_length(self, t):
         return max(x.req_bit_length[t] for x in self.tapes)
@@ -492,6 +600,10 @@ class Program(object):
                     exp.sanitize() + (exp.n_parties,)))
         else:
             sch_file.write('no expections\n')
+        if self.thread_choices:
+            sch_file.write("threads: %s machine:%d,%d\n" % (
+                " ".join("%s:%d/%d" % x for x in self.thread_choices),
+                self.machine_cores, self.machine_memory or 0))
         sch_file.close()
         h = hashlib.sha256()
         for tape in self.tapes:
@@ -622,10 +734,32 @@ class Program(object):
             for tape in self.tapes:
                 tape.write_str(self.options.asmoutfile + "-" + tape.name)
 
+        if self.template_cache:
+            self.template_cache.evict()
+
+        if self.phase_profile:
+            self.phase_profile.write(
+                self.programs_dir + "/Schedules/%s.profile.json" % self.name,
+                name=self.name, argv=sys.argv,
+                tapes=dict((tape.name, len(tape)) for tape in self.tapes))
+
+        if self.options.attribution:
+            self.call_sites.write(
+                self.curr_tape.attribute(),
+                self.programs_dir + "/Schedules/%s" % self.name)
+
         # Making sure that the public_input_file has been properly closed
         if self.public_input_file is not None:
             self.public_input_file.close()
 
+    def phase(self, name, tape=None, n_instructions=0):
+        """ Context manager for recording a compilation phase with
+        :option:`--phase-profile`. """
+        if self.phase_profile:
+            return self.phase_profile.phase(name, tape, n_instructions)
+        else:
+            return profiling.null_phase(n_instructions)
+
     def finalize_memory(self):
         self.curr_tape.start_new_basicblock(None, "memory-usage",
                                             req_node=self.curr_tape.req_tree)
@@ -847,7 +981,9 @@ class Program(object):
 
     def use_cisc(self):
         return self.options.cisc and (not self.prime or self.rabbit_gap()) \
-            and not self.options.max_parallel_open
+            and not self.options.max_parallel_open \
+            and not int(self.options.max_round_bytes or 0) \
+            and not self.options.attribution
 
     def rabbit_gap(self):
         assert self.prime
@@ -915,7 +1051,9 @@ class Program(object):
                 concept, papers.get(reference) or reference, suffix))
             self.recommended.add(key)
 
-    def expected_communication(self):
+    def element_length(self):
+        """ Number of bytes per arithmetic share as used by the
+        virtual machine. """
         if self.options.ring:
             bit_length = int(self.options.ring)
         elif self.options.prime:
@@ -924,13 +1062,60 @@ class Program(object):
             # check against OnlineOptions.cpp
             bit_length = max(self.required_bit_length("p"), 128)
             bit_length = int(math.ceil(bit_length / 64) * 64)
-        length = int(math.ceil(bit_length / 8))
-        return expected_communication(
-            self.options.execute, self.req_num or Tape.ReqNum(), length)
+        return int(math.ceil(bit_length / 8))
+
+    def element_bytes(self, reg_type):
+        """ Estimated number of bytes communicated per element of a
+        register type in one round, zero for types without
+        communication. """
+        if reg_type in ("s", "c"):
+            return self.element_length()
+        elif reg_type in ("sg", "cg"):
+            return int(math.ceil(self.galois_length / 8))
+        elif reg_type in ("sb", "cb"):
+            return 8
+        else:
+            return 0
+
+    def expected_communication(self, req_num=None):
+        if req_num is None:
+            req_num = self.req_num or Tape.ReqNum()
+        return expected_communication(self.options.execute, req_num,
+                                      self.element_length())
+
+def _merge_block_forked(i):
+    tape, options = Tape.forked
+    block = tape.basicblocks[i]
+    positions = dict((id(inst), k) for k, inst in enumerate(block.instructions))
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        merger = tape.merge_block(i, block, options)
+    return dict(
+        output=output.getvalue(),
+        merged=merger.merged,
+        eliminated=merger.eliminated,
+        order=[positions[id(inst)] for inst in block.instructions],
+        n_rounds=block.n_rounds,
+        n_to_merge=block.n_to_merge,
+        rounds=dict(block.rounds),
+        site_usage=None if block.site_usage is None
+        else dict(block.site_usage),
+        warned_about_mem=tape.warned_about_mem,
+    )
+
+
+def _encode_forked(chunk):
+    instructions = Tape.forked[chunk[0]:chunk[1]]
+    return inst_base.encode_instructions(instructions)
+
 
 class Tape:
     """A tape contains a list of basic blocks, onto which instructions are added."""
 
+    # minimum number of instructions for using --jobs
+    pool_threshold = 100000
+    forked = None
+
     def __init__(self, name, program, thread_pool=None):
         """Set prime p and the initial instructions and registers."""
         self.program = program
@@ -943,6 +1128,12 @@ class Tape:
         self.block_counter = 0
         self.active_basicblock = None
         self.old_allocated_mem = program.allocated_mem.copy()
+        self.open_scopes = 0
+        self.streamed = []
+        self.n_streamed = 0
+        self.stream_mark = None
+        self.stream_file = None
+        self.streaming = False
         self.start_new_basicblock(req_node=self.req_tree)
         self._is_empty = False
         self.merge_opens = True
@@ -955,9 +1146,12 @@ class Tape:
         self.free_threads = set() if thread_pool is None else thread_pool
         self.loop_breaks = []
         self.warned_about_mem = False
+        self.cse_saved = Tape.ReqNum()
         self.return_values = []
         self.ran_threads = False
+        self.reg_usage = None
         self.unused_decorators = {}
+        self.stream_mark = 0
 
     class BasicBlock(object):
         def __init__(self, parent, name, scope, exit_condition=None,
@@ -980,6 +1174,8 @@ class Tape:
             self.n_rounds = 0
             self.n_to_merge = 0
             self.rounds = Tape.ReqNum()
+            # usage by call site with --attribution
+            self.site_usage = None
             self.warn_about_mem = parent.program.warn_about_mem[-1]
             self.req_node = req_node
             self.used_from_scope = set()
@@ -1049,6 +1245,16 @@ class Tape:
             req_node.num["all", "inv"] += self.n_to_merge
             req_node.num += self.rounds
 
+        def summarize_usage(self):
+            """Replace the instructions retained by :py:func:`purge`
+            by their total usage."""
+            req_node = Tape.ReqNode("")
+            req_node.num = Tape.ReqNum()
+            self.add_usage(req_node)
+            self.usage_instructions = []
+            self.n_rounds = self.n_to_merge = 0
+            self.rounds = req_node.num
+
         def expand_cisc(self):
             if self.parent.program.options.keep_cisc is not None:
                 skip = ["LTZ", "Trunc", "EQZ"]
@@ -1113,6 +1319,91 @@ class Tape:
         self.basicblocks.append(sub)
         self.active_basicblock = sub
         # print 'Compiling basic block', sub.name
+        if self.open_scopes == 0:
+            self.stream()
+
+    def stream(self):
+        """Optimize and write the blocks that cannot change anymore
+        and free their instructions (option :option:`--stream`). These
+        are the blocks that were closed before the last time a block
+        was started outside any loop, branch, or function. Dead-code
+        elimination is not applied to them because later code might
+        still read their registers."""
+        program = self.program
+        if not program.options.stream or self.streaming or \
+           self.stream_mark is None or not self.singular or \
+           self.function_basicblocks or self.if_states or \
+           self.loop_breaks or program.curr_tape is not self:
+            return
+        mark = self.stream_mark
+        self.stream_mark = len(self.basicblocks) - 1
+        blocks = self.basicblocks[:mark]
+        if not blocks:
+            return
+        next_block = self.basicblocks[mark]
+        members = set(blocks)
+        # jumps must not cross the boundary except to the next block
+        for block in blocks:
+            if block.exit_block not in members and \
+               block.exit_block not in (None, next_block):
+                return
+        for block in self.basicblocks[mark:]:
+            if block.exit_block in members:
+                return
+        self.stream_mark -= mark
+        options = program.options
+        self.streaming = True
+        try:
+            for block in blocks:
+                if options.constant_propagation:
+                    al.RegintOptimizer().run(block.instructions, self.program)
+                al.determine_scope(block, options)
+                if options.cse:
+                    self.eliminate_common_subexpressions(block)
+            if options.merge_opens and self.merge_opens:
+                for i, block in enumerate(blocks):
+                    self.merge_block(i, block, options, eliminate=False)
+            tail = self.basicblocks
+            active = self.active_basicblock
+            if options.cisc:
+                self.basicblocks = blocks
+                self.expand_cisc(next_block)
+                blocks = self.basicblocks
+                self.basicblocks = tail
+                self.active_basicblock = active
+        finally:
+            self.streaming = False
+        offset = 0
+        for block in blocks:
+            if block.exit_condition is not None:
+                block.add_jump()
+            block.offset = offset
+            offset += len(block.instructions)
+        next_block.offset = offset
+        for block in blocks:
+            if block.exit_block is not None:
+                block.adjust_jump()
+        if self.stream_file is None:
+            # renamed by write_bytes() so that a failed compilation
+            # does not leave a truncated file
+            print("Writing to", self.outfile + ".tmp")
+            self.stream_file = open(self.outfile + ".tmp", "wb")
+            self.stream_hash = hashlib.sha256()
+        for block in blocks:
+            b = inst_base.encode_instructions(block.instructions)
+            self.stream_file.write(b)
+            self.stream_hash.update(b)
+            self.n_streamed += len(block.instructions)
+            instructions = block.instructions
+            block.purge()
+            block.summarize_usage()
+            # the list might be shared with a block left by expand_cisc()
+            instructions.clear()
+        self.streamed += blocks
+        del self.basicblocks[:mark]
+        if program.verbose:
+            print("Streamed %d blocks with %d instructions in total from %s" %
+                  (len(blocks), self.n_streamed, self.name))
 
     def init_registers(self):
         self.reg_counter = RegType.create_dict(lambda: 0)
@@ -1125,7 +1416,8 @@ class Tape:
         if self.purged:
             return self.size
         else:
-            return sum(len(block) for block in self.basicblocks)
+            return sum(len(block) for block in self.basicblocks) + \
+                self.n_streamed
 
     def purge(self):
         self.size = len(self)
@@ -1146,6 +1438,9 @@ class Tape:
 
     @unpurged
     def optimize(self, options):
+        # no streaming from here on
+        self.stream_mark = None
+
         if len(self.basicblocks) == 0:
             print("Tape %s is empty" % self.name)
             return
@@ -1169,68 +1464,41 @@ class Tape:
                 "Processing tape", self.name, "with %d blocks" % len(self.basicblocks)
             )
 
-        for block in self.basicblocks:
-            al.determine_scope(block, options)
+        if options.constant_propagation:
+            with self.program.phase("constant_propagation", self.name,
+                                    len(self)):
+                for block in self.basicblocks:
+                    al.RegintOptimizer().run(block.instructions, self.program)
+
+        if options.licm:
+            with self.program.phase("loop_invariants", self.name, len(self)):
+                self.hoist_loop_invariants()
+
+        with self.program.phase("determine_scope", self.name, len(self)):
+            for block in self.basicblocks:
+                al.determine_scope(block, options)
+
+        if options.cse:
+            with self.program.phase("common_subexpressions", self.name,
+                                    len(self)):
+                for block in self.basicblocks:
+                    self.eliminate_common_subexpressions(block)
 
         # merge open instructions
         # need to do this if there are several blocks
         if (options.merge_opens and self.merge_opens) or options.dead_code_elimination:
-            for i, block in enumerate(self.basicblocks):
-                if len(block.instructions) > 0 and self.program.verbose:
-                    print(
-                        "Processing basic block %s, %d/%d, %d instructions"
-                        % (
-                            block.name,
-                            i,
-                            len(self.basicblocks),
-                            len(block.instructions),
-                        )
-                    )
-                # the next call is necessary for allocation later even without merging
-                merger = al.Merger(block, options, tuple(self.program.to_merge))
-                if options.dead_code_elimination:
-                    if len(block.instructions) > 1000000:
-                        print("Eliminate dead code...")
-                    merger.eliminate_dead_code()
-                else:
-                    merger.eliminate_dead_code(only_ldint=True)
-                if options.merge_opens and self.merge_opens:
-                    if len(block.instructions) == 0:
-                        block.used_from_scope = util.set_by_id()
-                        continue
-                    if len(block.instructions) > 1000000:
-                        print("Merging instructions...")
-                    numrounds = merger.longest_paths_merge()
-                    block.n_rounds = numrounds
-                    block.n_to_merge = len(merger.open_nodes)
-                    if options.verbose:
-                        block.rounds = merger.req_num
-                    if merger.counter and self.program.verbose:
-                        print(
-                            "Block requires",
-                            ", ".join(
-                                "%d %s" % (y, x.__name__)
-                                for x, y in list(merger.counter.items())
-                            ),
-                        )
-                    if merger.counter and self.program.verbose:
-                        print(
-                            "Block requires %s rounds"
-                            % ", ".join(
-                                "%d %s" % (y, x.__name__)
-                                for x, y in list(merger.rounds.items())
-                            )
-                        )
-                # free memory
-                merger = None
-                block.instructions = [
-                    x for x in block.instructions if x is not None
-                ]
+            if self.use_pool(options, sum(len(block) for block in self.basicblocks)):
+                with self.program.phase("merge_in_pool", self.name, len(self)):
+                    self.merge_blocks_in_pool(options)
+            else:
+                for i, block in enumerate(self.basicblocks):
+                    self.merge_block(i, block, options)
         if not (options.merge_opens and self.merge_opens):
             print("Not merging instructions in tape %s" % self.name)
 
         if options.cisc:
-            self.expand_cisc()
+            with self.program.phase("expand_cisc", self.name, len(self)):
+                self.expand_cisc()
 
         # add jumps
         offset = 0
@@ -1251,6 +1519,7 @@ class Tape:
         # allocate registers
         reg_counts = self.count_regs()
         if options.noreallocate:
+            self.reg_usage = dict(reg_counts)
             if self.program.verbose:
                 print("Tape register usage:", dict(reg_counts))
         else:
@@ -1309,7 +1578,9 @@ class Tape:
                     ):
                         alloc_loop(block.exit_block.scope)
                 usage = allocator.max_usage.copy()
-                allocator.process(block.instructions, block.alloc_pool)
+                with self.program.phase("allocate", self.name,
+                                        len(block.instructions)):
+                    allocator.process(block.instructions, block.alloc_pool)
                 if self.program.verbose and usage != allocator.max_usage:
                     print("Allocated registers in %s " % block.name, end="")
                     for t, n in allocator.max_usage.items():
@@ -1317,20 +1588,30 @@ class Tape:
                             print("%s:%d " % (t, n - usage[t]), end="")
                     print()
             allocator.finalize(options)
+            self.reg_usage = dict(allocator.max_usage)
             if self.program.verbose:
                 print("Tape register usage:", dict(allocator.max_usage))
                 scopes = set(block.alloc_pool for block in self.basicblocks)
                 n_fragments = sum(scope.n_fragments() for scope in scopes)
                 print("%d register fragments in %d scopes" % (n_fragments, len(scopes)))
+                wasted = defaultdict(lambda: 0)
+                for scope in scopes:
+                    for t, n in scope.n_wasted().items():
+                        wasted[t] += n
+                print("Registers lost to fragmentation:", dict(wasted))
 
         # offline data requirements
         if self.program.verbose:
             print("Compile offline data requirements...")
-        for block in self.basicblocks:
-            block.req_node.add_block(block)
-        self.req_num = self.req_tree.aggregate()
+        with self.program.phase("requirements", self.name, len(self)):
+            for block in self.streamed + self.basicblocks:
+                block.req_node.add_block(block)
+            self.req_num = self.req_tree.aggregate()
         if self.program.verbose:
             print("Tape requires", self.req_num)
+            if self.cse_saved:
+                print("Common subexpression elimination saved",
+                      self.cse_saved)
         for req, num in sorted(self.req_num.items()):
             if num == float("inf") or num >= 2**64:
                 num = -1
@@ -1389,9 +1670,205 @@ class Tape:
                        if self.bit_length_reason else ''))
                 print("Tape requires galois bit length", self.req_bit_length["2"])
 
+    def use_pool(self, options, n_instructions):
+        return options.jobs and int(options.jobs) > 1 and \
+            n_instructions >= self.pool_threshold
+
+    def merge_blocks_in_pool(self, options):
+        """ Run :py:func:`merge_block` for all blocks in forked processes
+        and replay the changes here. """
+        import multiprocessing
+        if self.program.verbose:
+            print("Merging %d blocks using %s processes" %
+                  (len(self.basicblocks), options.jobs))
+        Tape.forked = self, options
+        try:
+            with multiprocessing.get_context("fork").Pool(
+                    int(options.jobs)) as pool:
+                plans = pool.imap(_merge_block_forked,
+                                  range(len(self.basicblocks)))
+                for block, plan in zip(self.basicblocks, plans):
+                    self.apply_merge_plan(block, plan, options)
+        finally:
+            Tape.forked = None
+
+    def apply_merge_plan(self, block, plan, options):
+        print(plan["output"], end="")
+        instructions = block.instructions
+        for i in plan["eliminated"]:
+            for reg in instructions[i].get_def():
+                self.program.base_addresses.pop(reg)
+        for merge in plan["merged"]:
+            for i in merge[1:]:
+                instructions[merge[0]].merge(instructions[i])
+        if options.merge_opens and self.merge_opens and not instructions:
+            block.used_from_scope = util.set_by_id()
+        block.instructions = [instructions[i] for i in plan["order"]]
+        block.n_rounds = plan["n_rounds"]
+        block.n_to_merge = plan["n_to_merge"]
+        block.rounds = Tape.ReqNum(plan["rounds"])
+        if plan["site_usage"] is not None:
+            block.site_usage = Tape.ReqNum(plan["site_usage"])
+        self.warned_about_mem |= plan["warned_about_mem"]
+
+    def encode_in_pool(self):
+        """ Encode instructions in forked processes.
+
+        :returns: iterator of byte strings
+        """
+        import multiprocessing
+        n_jobs = int(self.program.options.jobs)
+        instructions = list(self._get_instructions())
+        n_chunks = 4 * n_jobs
+        chunks = [(len(instructions) * i // n_chunks,
+                   len(instructions) * (i + 1) // n_chunks)
+                  for i in range(n_chunks)]
+        Tape.forked = instructions
+        try:
+            with multiprocessing.get_context("fork").Pool(n_jobs) as pool:
+                for res in pool.imap(_encode_forked, chunks):
+                    yield res
+        finally:
+            Tape.forked = None
+
+    def eliminate_common_subexpressions(self, block):
+        """ Run :py:class:`Compiler.allocator.CommonSubexpressionEliminator`
+        on a block and record the savings. """
+        cse = al.CommonSubexpressionEliminator(block)
+        cse.run()
+        self.cse_saved += cse.saved.num
+
+    def hoist_loop_invariants(self):
+        """ Run :py:class:`Compiler.allocator.LoopInvariantHoister`
+        on all blocks and report the moved instructions per loop. """
+        hoister = al.LoopInvariantHoister(self)
+        total = hoister.run()
+        if self.program.verbose:
+            for name, n in hoister.hoisted:
+                print("Moved %d loop-invariant instructions out of loop %s"
+                      % (n, name))
+            if total:
+                print("Moved %d loop-invariant instructions out of %d loops "
+                      "in tape %s" % (total, len(hoister.hoisted), self.name))
+
+    def merge_block(self, i, block, options, eliminate=True):
+        """ Eliminate dead code and merge instructions in one block.
+
+        :param eliminate: whether to eliminate dead code
+        :returns: merger object describing the changes
+        """
+        if len(block.instructions) > 0 and self.program.verbose:
+            print(
+                "Processing basic block %s, %d/%d, %d instructions"
+                % (
+                    block.name,
+                    i,
+                    len(self.basicblocks),
+                    len(block.instructions),
+                )
+            )
+        merge = options.merge_opens and self.merge_opens
+        window = int(options.merge_window or 0)
+        if merge and 0 < window < len(block.instructions):
+            merger = al.WindowMerger(block, options,
+                                     tuple(self.program.to_merge), window)
+            with self.program.phase("window_merge", self.name,
+                                    len(block.instructions)):
+                numrounds = merger.run(
+                    eliminate,
+                    only_ldint=not options.dead_code_elimination)
+            if self.program.verbose:
+                print("Merged in %d windows of %d instructions, "
+                      "%d rounds, at most %d per window" % (
+                          merger.n_windows, window, numrounds,
+                          merger.max_window_rounds))
+            n_to_merge = merger.n_to_merge
+            block.site_usage = merger.site_usage
+        else:
+            # the next call is necessary for allocation later even
+            # without merging
+            merger = al.Merger(block, options, tuple(self.program.to_merge))
+            with self.program.phase("eliminate_dead_code", self.name,
+                                    len(block.instructions)):
+                if not eliminate:
+                    pass
+                elif options.dead_code_elimination:
+                    if len(block.instructions) > 1000000:
+                        print("Eliminate dead code...")
+                    merger.eliminate_dead_code()
+                else:
+                    merger.eliminate_dead_code(only_ldint=True)
+            if options.attribution:
+                block.site_usage = merger.attribute()
+        if merge:
+            if len(block.instructions) == 0:
+                block.used_from_scope = util.set_by_id()
+                return merger
+            if isinstance(merger, al.Merger):
+                if len(block.instructions) > 1000000:
+                    print("Merging instructions...")
+                with self.program.phase("longest_paths_merge", self.name,
+                                        len(block.instructions)):
+                    numrounds = merger.longest_paths_merge()
+                n_to_merge = len(merger.open_nodes)
+            block.n_rounds = numrounds
+            block.n_to_merge = n_to_merge
+            if options.verbose:
+                block.rounds = merger.req_num
+            if merger.counter and self.program.verbose:
+                print(
+                    "Block requires",
+                    ", ".join(
+                        "%d %s" % (y, x.__name__)
+                        for x, y in list(merger.counter.items())
+                    ),
+                )
+            if merger.counter and self.program.verbose:
+                print(
+                    "Block requires %s rounds"
+                    % ", ".join(
+                        "%d %s" % (y, x.__name__)
+                        for x, y in list(merger.rounds.items())
+                    )
+                )
+            if merger.round_profile and self.program.verbose:
+                self.print_round_profile(merger.round_profile)
+            if merger.oversized:
+                print(
+                    "WARNING: %d instructions in block %s communicate more "
+                    "than %d bytes on their own, consider smaller vectors"
+                    % (merger.oversized, block.name,
+                       int(options.max_round_bytes))
+                )
+        block.instructions = [
+            x for x in block.instructions if x is not None
+        ]
+        return merger
+
+    @staticmethod
+    def print_round_profile(profile):
+        """ Output the estimated communication of the rounds in a block.
+
+        :param profile: list of instruction name and bytes per round
+        """
+        by_type = defaultdict(lambda: [0, 0, 0])
+        for name, n_bytes in profile:
+            x = by_type[name]
+            x[0] += 1
+            x[1] += n_bytes
+            x[2] = max(x[2], n_bytes)
+        total = sum(n_bytes for name, n_bytes in profile)
+        print(
+            "Block communicates %d bytes in %d rounds, at most %d per "
+            "round: %s" % (
+                total, len(profile), max(n for name, n in profile),
+                ", ".join("%s %d rounds, %d bytes, at most %d" % (
+                    name, x[0], x[1], x[2])
+                          for name, x in by_type.items())))
+
     @unpurged
-    def expand_cisc(self):
-        mapping = {None: None}
+    def expand_cisc(self, next_block=None):
+        mapping = {None: None, next_block: next_block}
         blocks = self.basicblocks[:]
         self.basicblocks = []
         for block in blocks:
@@ -1403,7 +1880,8 @@ class Tape:
         for block in self.basicblocks:
             block.exit_block = mapping[block.exit_block]
             if block.exit_block is not None:
-                assert block.exit_block in self.basicblocks
+                assert block.exit_block in self.basicblocks or \
+                    block.exit_block is next_block
             if block.previous_block and mapping[block] != block:
                 mapping[block].previous_block = block.previous_block
                 mapping[block].sub_block = block.sub_block
@@ -1422,9 +1900,7 @@ class Tape:
     @unpurged
     def get_bytes(self):
         """Get the byte encoding of the program as an actual string of bytes."""
-        return b"".join(
-            i.get_bytes() for i in self._get_instructions() if i is not None
-        )
+        return bytes(inst_base.encode_instructions(self._get_instructions()))
 
     @unpurged
     def write_encoding(self, filename):
@@ -1458,16 +1934,30 @@ class Tape:
             filename += ".bc"
         if "Bytecode" not in filename:
             filename = self.program.programs_dir + "/Bytecode/" + filename
-        print("Writing to", filename)
-        sys.stdout.flush()
-        f = open(filename, "wb")
-        h = hashlib.sha256()
-        for i in self._get_instructions():
-            if i is not None:
-                b = i.get_bytes()
+        streamed = bool(self.stream_file)
+        if streamed:
+            # continue file started by stream()
+            assert filename == self.outfile
+            f, h = self.stream_file, self.stream_hash
+            self.stream_file = None
+        else:
+            print("Writing to", filename)
+            sys.stdout.flush()
+            f = open(filename, "wb")
+            h = hashlib.sha256()
+        if self.use_pool(self.program.options, len(self)):
+            encoded = self.encode_in_pool()
+        else:
+            encoded = (inst_base.encode_instructions(block.instructions)
+                       for block in self.basicblocks)
+        with self.program.phase("write_bytes", self.name, len(self)):
+            for b in encoded:
                 f.write(b)
                 h.update(b)
         f.close()
+        if streamed:
+            print("Renaming to", filename)
+            os.replace(filename + ".tmp", filename)
         self.hash = h.digest()
 
     def new_reg(self, reg_type, size=None):
@@ -1640,15 +2130,50 @@ class Tape:
             self.nodes.append(new_node)
             return new_node
 
+    def attribute(self):
+        """ Aggregate the usage by call site in the same way as
+        :py:obj:`req_num`, including the tapes run from this one.
+
+        :returns: :py:class:`ReqNum` by call site and metric
+        """
+        active = set()
+
+        def sites(num):
+            # without entries added by ReqNum.set_all()
+            return Tape.ReqNum((key, n) for key, n in num.items()
+                               if isinstance(key[0], int))
+
+        def aggregate(node):
+            if id(node) in active:
+                return Tape.ReqNum()
+            active.add(id(node))
+            res = Tape.ReqNum()
+            for block in node.blocks:
+                if block.site_usage is not None:
+                    res += block.site_usage
+            for child in node._children:
+                if isinstance(child, Tape.ReqNode):
+                    # tape run from here
+                    res += aggregate(child)
+                else:
+                    res += sites(child.aggregator(
+                        [aggregate(x) for x in child.nodes]))
+            active.remove(id(node))
+            return res
+
+        return sites(aggregate(self.req_tree))
+
     def open_scope(self, aggregator, scope=False, name=""):
         req_node = self.active_basicblock.req_node
         child = self.ReqChild(aggregator, req_node)
         req_node.children.append(child)
         node = child.add_node(self, "%s-%d" % (name, len(self.basicblocks)))
+        self.open_scopes += 1
         self.start_new_basicblock(name=name, req_node=node)
         return child
 
     def close_scope(self, outer_scope, parent_req_node, name):
+        self.open_scopes -= 1
         self.start_new_basicblock(outer_scope, name, req_node=parent_req_node)
 
     def require_bit_length(self, bit_length, t="p", reason=None):
@@ -1671,9 +2196,9 @@ class Tape:
 
     @staticmethod
     def read_instructions(tapename):
-        tape = open("Programs/Bytecode/%s.bc" % tapename, "rb")
-        while tape.peek():
-            yield inst_base.ParsedInstruction(tape)
+        with inst_base.BytecodeReader(
+                "Programs/Bytecode/%s.bc" % tapename) as reader:
+            yield from reader
 
     class _no_truth(object):
         __slots__ = []
@@ -1766,6 +2291,9 @@ class Tape:
             self.dup_count = None
             if Program.prog.DEBUG:
                 self.caller = [frame[1:] for frame in inspect.stack()[1:]]
+            elif Program.prog.call_sites and \
+                 Program.prog.call_sites.n_frames:
+                self.caller = Program.prog.call_sites.capture()
             else:
                 self.caller = None
 
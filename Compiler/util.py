@@ -6,6 +6,11 @@ from Compiler.exceptions import *
 def format_trace(trace, prefix='  '):
     if trace is None:
         return '<omitted>'
+    elif isinstance(trace, int):
+        # call site recorded with --attribution
+        from Compiler.program import Program
+        return format_trace(Program.prog.call_sites.trace(trace) or None,
+                            prefix)
     else:
         return ''.join('\n%sFile "%s", line %s, in %s\n%s  %s' %
                        (prefix,i[0],i[1],i[2],prefix,i[3][0].strip()) \
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Compare the number of instructions in the bytecode with and without
+# constant propagation for clear values (--constant-propagation)
+# and the time of running the result in the emulator if it has been
+# built (make emulate.x), which requires compiling with -R 64.
+#
+# Usage: Scripts/constant-propagation-benchmark.py [compile.py options]
+#            <program>
+
+import sys, os
+import re
+import time
+import subprocess
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(sys.argv[0]) + '/..')
+
+from Compiler.instructions_base import BytecodeReader
+
+if len(sys.argv) < 2:
+    print('Usage: %s [compile.py options] <program>' % sys.argv[0],
+          file=sys.stderr)
+    sys.exit(1)
+
+def run(propagate):
+    cmd = [sys.executable, 'compile.py']
+    if propagate:
+        cmd.append('--constant-propagation')
+    start = time.time()
+    res = subprocess.run(cmd + sys.argv[1:], stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, universal_newlines=True)
+    duration = time.time() - start
+    if res.returncode:
+        print(res.stdout[-2000:])
+        raise SystemExit('compilation failed')
+    counts = defaultdict(lambda: 0)
+    name = None
+    for line in res.stdout.splitlines():
+        m = re.match(r'Writing to (\S+\.bc)$', line)
+        if m:
+            with BytecodeReader(m.group(1)) as reader:
+                for inst in reader:
+                    counts[inst.type.__name__] += 1
+        m = re.match(r'Writing to Programs/Schedules/(\S+)\.sch$', line)
+        if m:
+            name = m.group(1)
+    return duration, counts, name
+
+def emulate(name):
+    if not os.path.exists('emulate.x'):
+        return None
+    start = time.time()
+    res = subprocess.run(['./emulate.x', name], stdout=subprocess.DEVNULL,
+                         stderr=subprocess.STDOUT)
+    if res.returncode:
+        raise SystemExit('emulation failed')
+    return time.time() - start
+
+results = {}
+for propagate in False, True:
+    duration, counts, name = run(propagate)
+    vm_time = emulate(name)
+    results[propagate] = counts
+    label = 'with' if propagate else 'without'
+    if vm_time is None:
+        vm_str = 'no emulate.x, VM time skipped'
+    else:
+        vm_str = '%.2f s VM time' % vm_time
+    print('%s constant propagation: %.1f s compilation, '
+          '%d instructions, %s' % (label, duration, sum(counts.values()),
+                                   vm_str))
+
+before, after = results[False], results[True]
+diff = {x: after[x] - before[x] for x in set(before) | set(after)
+        if after[x] != before[x]}
+print('instruction count changes:',
+      dict(sorted(diff.items(), key=lambda x: x[1])))
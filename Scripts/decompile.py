@@ -1,24 +1,40 @@
 #!/usr/bin/env python3
 
 import sys, os
+import itertools
 
 sys.path.append('.')
 
-from Compiler.instructions_base import Instruction
+from Compiler.instructions_base import Instruction, BytecodeReader
 from Compiler.program import *
 
 if len(sys.argv) <= 1:
-    print('Usage: %s <program>' % sys.argv[0])
+    print('Usage: %s <program> [<first instruction>[:<last instruction>]]'
+          % sys.argv[0])
 
-def run(tapename):
+def run(tapename, start=0, stop=None):
     filename = 'Programs/Bytecode/%s.asm' % tapename
     print('Creating', filename)
-    with open(filename, 'w') as out:
-        for i, inst in enumerate(Tape.read_instructions(tapename)):
+    with BytecodeReader('Programs/Bytecode/%s.bc' % tapename) as reader, \
+         open(filename, 'w') as out:
+        if start:
+            instructions = reader.instructions_from(start)
+        else:
+            instructions = iter(reader)
+        if stop is not None:
+            instructions = itertools.islice(instructions, stop - start)
+        for i, inst in enumerate(instructions, start):
             print(inst, '#', i, file=out)
 
+if len(sys.argv) > 2:
+    bounds = sys.argv[2].split(':')
+    start = int(bounds[0] or 0)
+    stop = int(bounds[1]) if len(bounds) > 1 and bounds[1] else None
+else:
+    start, stop = 0, None
+
 if sys.argv[1].endswith('.bc'):
-    run(os.path.basename(sys.argv[1][:-3]))
+    run(os.path.basename(sys.argv[1][:-3]), start, stop)
 else:
     for tapename in Program.read_tapes(sys.argv[1]):
-        run(tapename)
+        run(tapename, start, stop)
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+# Compare the time of encoding the main tape of a program with
+# Instruction.get_bytes and with encode_instructions.
+# Usage: Scripts/encode-benchmark.py [compile options] <program> [args]
+
+import os, sys, time
+
+sys.path.insert(0, os.path.dirname(sys.argv[0]) + '/..')
+
+from Compiler.compilerLib import Compiler
+from Compiler.instructions_base import encode_instructions
+
+compiler = Compiler()
+compiler.prep_compile()
+prog = compiler.compile_file()
+
+for tape in prog.tapes:
+    if tape.purged:
+        continue
+    instructions = list(tape._get_instructions())
+    start = time.time()
+    old = b"".join(i.get_bytes() for i in instructions if i is not None)
+    middle = time.time()
+    new = encode_instructions(instructions)
+    end = time.time()
+    assert old == new
+    print('%s: %d instructions, %d bytes, %.2f s with get_bytes, '
+          '%.2f s precompiled (%.1fx)' % (
+              tape.name, len(instructions), len(new), middle - start,
+              end - middle, (middle - start) / (end - middle)))
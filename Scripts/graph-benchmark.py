@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Compare time and peak memory of the dependency graph implementations
+# on a synthetic basic block. Every node depends on its predecessor in
+# one of several streams and on a random earlier node, and every tenth
+# node is merged with others of the same depth like in Merger.
+
+import sys, os
+import time
+import random
+import resource
+import subprocess
+from collections import defaultdict
+
+sys.path.append('.')
+
+from Compiler.graph import SparseDiGraph, CompactDiGraph, topological_sort
+
+def run(graph_type, n):
+    random.seed(0)
+    start = time.time()
+    G = graph_type(n)
+    depths = [0] * n
+    last = [-1] * 64
+    opens = []
+    for i in range(n):
+        G.add_node(i)
+        stream = random.randrange(len(last))
+        preds = [last[stream]]
+        if i > 1000:
+            preds.append(i - random.randrange(1, 1000))
+        for j in preds:
+            if j >= 0:
+                G.add_edge(j, i)
+                depths[i] = max(depths[i], depths[j])
+        if i % 10 == 0:
+            G.add_node(i, merges=[])
+            depths[i] += 1
+            opens.append(i)
+        last[stream] = i
+    build = time.time()
+    removed = set()
+    for i in range(n - 1, n - 1 - n // 100, -1):
+        if not G.degree(i):
+            G.remove_node(i)
+            removed.add(i)
+    merges = defaultdict(list)
+    for i in opens:
+        if i not in removed:
+            merges[depths[i]].append(i)
+    for merge in merges.values():
+        for j in merge[1:]:
+            G.merge_nodes(merge[0], j)
+    merge = time.time()
+    order = topological_sort(G)
+    end = time.time()
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print('%s: %.1f s build, %.1f s merge, %.1f s sort, %.0f MB peak' % (
+        graph_type.__name__, build - start, merge - build, end - merge,
+        maxrss))
+    return order
+
+if len(sys.argv) > 2:
+    graph_types = dict((x.__name__, x) for x in (SparseDiGraph, CompactDiGraph))
+    run(graph_types[sys.argv[2]], int(sys.argv[1]))
+else:
+    if len(sys.argv) > 1:
+        n = sys.argv[1]
+    else:
+        n = str(5000000)
+    print('Using %s nodes' % n)
+    for graph_type in 'SparseDiGraph', 'CompactDiGraph':
+        res = subprocess.run([sys.executable, sys.argv[0], n, graph_type])
+        if res.returncode:
+            print('%s: failed with exit code %d (out of memory?)' % (
+                graph_type, res.returncode))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# Compare compile time, peak memory, and the number of rounds of full
+# merging with merging in windows (--merge-window).
+#
+# Usage: Scripts/merge-window-benchmark.py <window size>[,<size>...]
+#            [compile.py options] <program>
+
+import sys, os
+import re
+import time
+import subprocess
+
+if len(sys.argv) < 3:
+    print('Usage: %s <window size>[,<size>...] [compile.py options] '
+          '<program>' % sys.argv[0], file=sys.stderr)
+    sys.exit(1)
+
+windows = [None] + sys.argv[1].split(',')
+args = sys.argv[2:]
+
+def run(window):
+    cmd = [sys.executable, 'compile.py']
+    if window:
+        cmd.append('--merge-window=%s' % window)
+    start = time.time()
+    proc = subprocess.Popen(cmd + args, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True)
+    output = proc.stdout.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    duration = time.time() - start
+    if status:
+        print(output[-2000:])
+        raise SystemExit('compilation failed')
+    maxrss = usage.ru_maxrss / 1024
+    m = re.search(r'(\d+) virtual machine rounds', output)
+    return duration, maxrss, int(m.group(1)) if m else None
+
+full_rounds = None
+for window in windows:
+    duration, maxrss, rounds = run(window)
+    if window is None:
+        full_rounds = rounds
+        name = 'full'
+    else:
+        name = 'window %s' % window
+    if rounds is None:
+        rounds_str = 'unknown rounds'
+    elif full_rounds:
+        rounds_str = '%d rounds (%.2fx)' % (rounds, rounds / full_rounds)
+    else:
+        rounds_str = '%d rounds' % rounds
+    print('%s: %.1f s, %.0f MB peak, %s' % (name, duration, maxrss,
+                                              rounds_str))
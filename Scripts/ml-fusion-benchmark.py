@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# Compare the cost of machine learning inference with and without
+# fusing layers (ml.Optimizer.fuse_layers) as activated by the
+# program argument 'fuse'. Reports the rounds, integer triples and
+# bits output by the compiler as well as the secret memory.
+#
+# Usage: Scripts/ml-fusion-benchmark.py [<compiler options>] [-- <program>...]
+#
+# The programs default to the Keras and PyTorch prediction examples.
+# Programs that fail to compile, for example for lack of PyTorch,
+# are reported as such.
+
+import sys
+import re
+import subprocess
+
+programs = ['keras_mnist_dense_predict', 'keras_mnist_lenet_predict',
+            'torch_mnist_lenet_predict']
+options = sys.argv[1:]
+if '--' in options:
+    i = options.index('--')
+    options, programs = options[:i], options[i + 1:]
+
+metrics = ('virtual machine rounds', 'integer triples', 'integer bits')
+
+def call(cmd):
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True)
+    return proc.returncode, proc.stdout
+
+def run(program, fuse):
+    args = [program] + (['fuse'] if fuse else [])
+    status, output = call([sys.executable, 'compile.py'] + options + args)
+    if status:
+        return None
+    res = {}
+    for metric in metrics:
+        m = re.search(r'(\d+) %s' % metric, output)
+        res[metric] = int(m.group(1)) if m else 0
+    _, usage = call([sys.executable, 'Scripts/memory-usage.py',
+                     '-'.join(args)])
+    m = re.search(r'(\d+) sint', usage)
+    res['sint memory'] = int(m.group(1)) if m else 0
+    return res
+
+for program in programs:
+    results = [run(program, fuse) for fuse in (False, True)]
+    if None in results:
+        print('%s: compilation failed' % program)
+        continue
+    print('%s:' % program)
+    for metric in metrics + ('sint memory',):
+        before, after = (x[metric] for x in results)
+        change = (after - before) / before * 100 if before else 0
+        print('  %s: %d -> %d (%+.1f%%)' % (metric, before, after, change))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Compare training with all data in memory to loading batches while
+# training (ml.DataSource) using Programs/Source/ml_streaming.mpc.
+# Reports the secret memory of the compiled program as well as the
+# wall time per epoch and the peak memory of running it with random
+# data in Player-Data.
+#
+# Usage: Scripts/ml-streaming-benchmark.py <samples> <batch size> <epochs>
+#            [<run script>]
+#
+# The run script defaults to Scripts/emulate.sh.
+
+import sys, os
+import re
+import time
+import random
+import subprocess
+
+if len(sys.argv) < 4:
+    print('Usage: %s <samples> <batch size> <epochs> [<run script>]' %
+          sys.argv[0], file=sys.stderr)
+    sys.exit(1)
+
+n_samples, batch_size, n_epochs = (int(x) for x in sys.argv[1:4])
+script = sys.argv[4] if len(sys.argv) > 4 else 'Scripts/emulate.sh'
+n_features = 100
+
+random.seed(0)
+samples = [[random.uniform(-1, 1) for j in range(n_features)]
+           for i in range(n_samples)]
+labels = [int(sum(x) > 0) for x in samples]
+
+def call(cmd):
+    start = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True)
+    output = proc.stdout.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    duration = time.time() - start
+    if status:
+        print(output[-2000:])
+        raise SystemExit('%s failed' % ' '.join(cmd))
+    return output, duration, usage.ru_maxrss / 1024
+
+def write_input(filename, parts):
+    with open(filename, 'w') as out:
+        for part in parts:
+            print(' '.join(str(x) for x in part), file=out)
+
+def run(stream):
+    args = ['%d' % x for x in (n_samples, batch_size, n_epochs)]
+    if stream:
+        args.append('stream')
+    output, _, _ = call([sys.executable, 'compile.py', 'ml_streaming'] +
+                        args)
+    name = '-'.join(['ml_streaming'] + args)
+    usage, _, _ = call([sys.executable, 'Scripts/memory-usage.py', name])
+    m = re.search(r'(\d+) sint', usage)
+    secret_memory = int(m.group(1)) if m else None
+    os.makedirs('Player-Data', exist_ok=True)
+    if stream:
+        thread = int(re.search(r'Loading training data in thread (\d+)',
+                               output).group(1))
+        n_batches = n_samples // batch_size
+        parts = []
+        for i in range(n_epochs):
+            for j in range(n_batches):
+                batch = slice(j * batch_size, (j + 1) * batch_size)
+                parts += samples[batch] + [labels[batch]]
+        write_input('Player-Data/Input-P0-%d' % thread, parts)
+    else:
+        write_input('Player-Data/Input-P0-0', samples + [labels])
+    try:
+        output, duration, maxrss = call([script, name])
+        if 'bias' not in output:
+            raise SystemExit(output[-2000:])
+    except (OSError, SystemExit) as e:
+        print('running %s failed: %s' % (name, e), file=sys.stderr)
+        duration = maxrss = None
+    return secret_memory, duration, maxrss
+
+for stream in False, True:
+    secret_memory, duration, maxrss = run(stream)
+    res = '%s: %s secret values in memory' % (
+        'streaming' if stream else 'in memory', secret_memory)
+    if duration is not None:
+        res += ', %.2f s per epoch, %.0f MB peak' % (duration / n_epochs,
+                                                      maxrss)
+    print(res)
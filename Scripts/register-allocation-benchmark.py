@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Compare the register usage of the register allocation strategies
+# (--register-allocation). The virtual machine allocates the registers
+# of a tape for every thread running it, so the maximum over the tapes
+# indicates the memory needed per thread.
+#
+# Usage: Scripts/register-allocation-benchmark.py [compile.py options] <program>
+
+import sys, os
+import re
+import ast
+import time
+import subprocess
+from collections import defaultdict
+
+if len(sys.argv) < 2:
+    print('Usage: %s [compile.py options] <program>' % sys.argv[0],
+          file=sys.stderr)
+    sys.exit(1)
+
+def run(strategy):
+    cmd = [sys.executable, 'compile.py', '-v',
+           '--register-allocation=%s' % strategy] + sys.argv[1:]
+    start = time.time()
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                         universal_newlines=True)
+    duration = time.time() - start
+    if res.returncode:
+        print(res.stdout[-2000:])
+        raise SystemExit('compilation failed')
+    usage = {}
+    wasted = defaultdict(lambda: 0)
+    tape = None
+    for line in res.stdout.splitlines():
+        m = re.match(r'Processing tape (\S+)', line)
+        if m:
+            tape = m.group(1)
+        m = re.match(r'Tape register usage: (.*)', line)
+        if m:
+            usage[tape] = ast.literal_eval(m.group(1))
+        m = re.match(r'Registers lost to fragmentation: (.*)', line)
+        if m:
+            for t, n in ast.literal_eval(m.group(1)).items():
+                wasted[t] += n
+    return duration, usage, wasted
+
+def summary(usage):
+    total = defaultdict(lambda: 0)
+    peak = defaultdict(lambda: 0)
+    for tape_usage in usage.values():
+        for t, n in tape_usage.items():
+            total[t] += n
+            peak[t] = max(peak[t], n)
+    return dict(peak), dict(total)
+
+for strategy in 'size', 'interval':
+    duration, usage, wasted = run(strategy)
+    peak, total = summary(usage)
+    print('%s: %.1f s, %d tapes' % (strategy, duration, len(usage)))
+    print('  peak per tape:', peak)
+    print('  total:', total)
+    print('  lost to fragmentation:', dict(wasted))
@@ -0,0 +1,5 @@
+#!/bin/bash
+
+# bankers_bonus has loops with an unknown number of iterations
+# (do_while, for_range with regint), which are reported in verbose mode
+./compile.py --attribution -v bankers_bonus || exit 1
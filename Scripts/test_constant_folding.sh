@@ -0,0 +1,7 @@
+#!/bin/bash
+
+# the program crashes if a folded result is wrong
+for opt in "" --constant-propagation; do
+    ./compile.py $opt test_constant_folding || exit 1
+    Scripts/rep-field.sh test_constant_folding || exit 1
+done
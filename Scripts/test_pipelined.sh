@@ -0,0 +1,7 @@
+#!/bin/bash
+
+# the program crashes if pipelining changes a result
+for opt in "" -M; do
+    ./compile.py -v $opt test_pipelined | grep Pipelining || exit 1
+    Scripts/rep-field.sh test_pipelined || exit 1
+done